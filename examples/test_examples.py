@@ -33,6 +33,9 @@ def test_all(example_dir, tmp_path):
             verbose=False,
             include_paths=None,
             write_debug_map=True,
+            cache=True,
+            rediscover=False,
+            jobs=2,
         )
 
     stdout_str = stdout.getvalue()
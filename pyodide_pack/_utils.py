@@ -4,12 +4,14 @@ import shutil
 import sys
 import tempfile
 import urllib.request
+from collections.abc import Iterable
 from contextlib import contextmanager
 from pathlib import Path
 
 from pyodide_lock import PyodideLockSpec
 
 from pyodide_pack.archive import ArchiveFile
+from pyodide_pack.compression import find_precompressed
 
 
 def match_suffix(file_paths: list[str], suffix: str) -> str | None:
@@ -42,6 +44,58 @@ def match_suffix(file_paths: list[str], suffix: str) -> str | None:
             return results[0]
 
 
+class _SuffixIndexNode:
+    __slots__ = ("children", "shortest")
+
+    def __init__(self) -> None:
+        self.children: dict[str, _SuffixIndexNode] = {}
+        self.shortest: str | None = None
+
+
+class SuffixIndex:
+    """Index of file paths by their trailing path components.
+
+    This is an equivalent of :func:`match_suffix` for repeated lookups in the
+    same list of paths: paths are stored in a trie of their reversed
+    components, so that a lookup costs about the number of components of the
+    suffix, independently of the number of indexed paths. Unlike
+    ``match_suffix``, a suffix only matches full path components.
+
+    Examples
+    --------
+    >>> index = SuffixIndex(['/usr/a.py', '/usr/b/d.py', '/usr/b/a.py'])
+    >>> index.match('d.py')
+    '/usr/b/d.py'
+    >>> index.match('b/a.py')
+    '/usr/b/a.py'
+    >>> index.match('c.py')
+    >>> index.match('sr/a.py')
+    >>> index.match('a.py')
+    '/usr/a.py'
+    """
+
+    def __init__(self, file_paths: Iterable[str]):
+        self._root = _SuffixIndexNode()
+        for path in file_paths:
+            node = self._root
+            for part in reversed(path.split("/")):
+                node = node.children.setdefault(part, _SuffixIndexNode())
+                # If there are multiple matches, we keep the shortest one as less
+                # likely to be a vendored package (see match_suffix). On ties the
+                # first path wins.
+                if node.shortest is None or len(path) < len(node.shortest):
+                    node.shortest = path
+
+    def match(self, suffix: str) -> str | None:
+        """Return the shortest indexed path ending with suffix, or None"""
+        node = self._root
+        for part in reversed(suffix.split("/")):
+            if (child := node.children.get(part)) is None:
+                return None
+            node = child
+        return node.shortest
+
+
 # Adapted from pyodide conftest.py
 
 
@@ -72,9 +126,32 @@ def run_web_server(q: multiprocessing.Queue, log_filepath, dist_dir):
                 )
             )
 
+        content_encoding = None
+
+        def translate_path(self, path):
+            # Serve precompressed files written next to the requested file, when
+            # the client accepts their encoding
+            fs_path = super().translate_path(path)
+            self.content_encoding = None
+            precompressed = find_precompressed(
+                fs_path, self.headers.get("Accept-Encoding", "")
+            )
+            if precompressed is None:
+                return fs_path
+            fs_path, self.content_encoding = precompressed
+            return fs_path
+
+        def guess_type(self, path):
+            if self.content_encoding is not None:
+                path = os.path.splitext(path)[0]
+            return super().guess_type(path)
+
         def end_headers(self):
             # Enable Cross-Origin Resource Sharing (CORS)
             self.send_header("Access-Control-Allow-Origin", "*")
+            if self.content_encoding is not None:
+                self.send_header("Content-Encoding", self.content_encoding)
+                self.send_header("Vary", "Accept-Encoding")
             super().end_headers()
 
     with socketserver.TCPServer(("", 0), Handler) as httpd:
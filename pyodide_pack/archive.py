@@ -1,18 +1,111 @@
 from __future__ import annotations
 
 import functools
-import gzip
+import mmap
+import posixpath
+import struct
 import tarfile
 import zipfile
+import zlib
 from collections.abc import Callable
+from dataclasses import dataclass
 from pathlib import Path
 
+from pyodide_pack.size_estimation import estimate_compressed_size
+
+# Timestamp of files written in the output archives, so that the output only
+# depends on the input files.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Private attributes of zipfile.ZipFile used by write_raw
+_ZIPFILE_WRITE_ATTRS = ("_lock", "_seekable", "_writecheck", "_didModify", "start_dir")
+
+# Layout of a zip local file header, as in zipfile.structFileHeader
+_LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")
+
+
+@dataclass(frozen=True)
+class ArchiveMember:
+    """Location and metadata of a file in an archive
+
+    For tar archives, members are never compressed and have no CRC.
+    """
+
+    name: str
+    data_offset: int
+    file_size: int
+    compress_size: int
+    compress_type: int
+    CRC: int | None
+    is_file: bool
+    info: zipfile.ZipInfo | tarfile.TarInfo
+
+
+def _index_zip(file_path: Path, buffer: mmap.mmap | bytes) -> dict[str, ArchiveMember]:
+    """Index the members of a zip file from its central directory"""
+    index: dict[str, ArchiveMember] = {}
+    with zipfile.ZipFile(file_path) as fh:
+        infolist = fh.infolist()
+    for info in infolist:
+        header = _LOCAL_FILE_HEADER.unpack_from(buffer, info.header_offset)
+        # Data starts after the file name and the extra field of the local header
+        data_offset = info.header_offset + _LOCAL_FILE_HEADER.size
+        data_offset += header[10] + header[11]
+        index[info.filename] = ArchiveMember(
+            name=info.filename,
+            data_offset=data_offset,
+            file_size=info.file_size,
+            compress_size=info.compress_size,
+            compress_type=info.compress_type,
+            CRC=info.CRC,
+            is_file=not info.is_dir(),
+            info=info,
+        )
+    return index
+
+
+def _index_tar(file_path: Path) -> dict[str, ArchiveMember]:
+    """Index the members of an uncompressed tar file
+
+    Links are resolved to the data of their target, like TarFile.extractfile does.
+    """
+    with tarfile.open(file_path) as fh:
+        members = fh.getmembers()
+    by_name = {member.name: member for member in members}
+    index: dict[str, ArchiveMember] = {}
+    for member in members:
+        target: tarfile.TarInfo | None = member
+        for _ in range(len(members)):
+            if target is None or not (target.islnk() or target.issym()):
+                break
+            link_name = target.linkname
+            if target.issym():
+                link_name = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(target.name), link_name)
+                )
+            target = by_name.get(link_name)
+        is_file = target is not None and target.isfile()
+        index[member.name] = ArchiveMember(
+            name=member.name,
+            data_offset=target.offset_data if target is not None else 0,
+            file_size=target.size if is_file else 0,  # type: ignore[union-attr]
+            compress_size=target.size if is_file else 0,  # type: ignore[union-attr]
+            compress_type=zipfile.ZIP_STORED,
+            CRC=None,
+            is_file=is_file,
+            info=member,
+        )
+    return index
+
 
 class ArchiveFile:
     """A wrapper to access .zip, .whl and .tar files with the same API
 
     We are only interested in reading archive files, not writing them.
     The archive is assumed to be immutable.
+
+    The list of members is indexed once when opening the archive, and the file
+    is memory-mapped, so that accessing a member is a slice of the mapping,
+    regardless of its position in the archive.
     """
 
     def __init__(self, file_path: Path, name: str | None):
@@ -21,35 +114,128 @@ class ArchiveFile:
             self.name = name
         else:
             self.name = file_path.name
-        if file_path.suffix in [".whl", ".zip"]:
-            self.opener = zipfile.ZipFile(file_path)
-        elif file_path.suffix in [".tar"]:
-            self.opener = tarfile.TarFile(file_path)  # type: ignore
-        else:
+        if file_path.suffix not in [".whl", ".zip", ".tar"]:
             raise NotImplementedError
 
-    def namelist(self):
-        if isinstance(self.opener, zipfile.ZipFile):
-            return self.opener.namelist()
+        self._buffer: mmap.mmap | bytes
+        with open(file_path, "rb") as fh:
+            try:
+                self._buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be memory-mapped
+                self._buffer = b""
+
+        if file_path.suffix in [".whl", ".zip"]:
+            self._index = _index_zip(file_path, self._buffer)
         else:
-            return self.opener.getnames()
+            self._index = _index_tar(file_path)
+        self._names = list(self._index)
+
+    def namelist(self) -> list[str]:
+        """List of member names, in archive order
+
+        The returned list is shared between calls and must not be modified.
+        """
+        return self._names
+
+    def infolist(self) -> list[ArchiveMember]:
+        """List of indexed members, in archive order"""
+        return list(self._index.values())
+
+    def getmember(self, name: str) -> ArchiveMember:
+        """Get the indexed member for a given name
+
+        Raises a KeyError if there is no such member.
+        """
+        return self._index[name]
+
+    def close(self) -> None:
+        if isinstance(self._buffer, mmap.mmap):
+            try:
+                self._buffer.close()
+            except BufferError:
+                # Some memoryview slices are still in use, the mapping
+                # will be released once they are garbage collected.
+                pass
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.opener.close()
+        self.close()
+
+    def _slice(self, member: ArchiveMember) -> memoryview:
+        """Zero-copy view of the stored (possibly compressed) member data"""
+        start = member.data_offset
+        return memoryview(self._buffer)[start : start + member.compress_size]
 
-    def read(self, name: str, **kwargs):
-        if isinstance(self.opener, zipfile.ZipFile):
-            with self.opener.open(name, **kwargs) as fh:
-                return fh.read()
+    def read_view(self, name: str) -> memoryview | None:
+        """Read the uncompressed content of a member as a memoryview
+
+        For members that are not compressed (tar archives, stored zip members)
+        this is a zero-copy view of the memory-mapped archive. Returns None for
+        directories and other members without content.
+        """
+        member = self._index[name]
+        if not member.is_file:
+            return None
+        if member.compress_type == zipfile.ZIP_STORED:
+            view = self._slice(member)
+        elif member.compress_type == zipfile.ZIP_DEFLATED:
+            view = memoryview(zlib.decompress(self._slice(member), -zlib.MAX_WBITS))
         else:
-            fh = self.opener.extractfile(name, **kwargs)
-            if fh is not None:
-                return fh.read()
-            else:
-                return None
+            # Other compression methods are rarely used, defer to zipfile
+            with zipfile.ZipFile(self.file_path) as fh:
+                return memoryview(fh.read(member.info))  # type: ignore[arg-type]
+        if member.CRC is not None and zlib.crc32(view) != member.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {name!r}")
+        return view
+
+    def read(self, name: str) -> bytes | None:
+        """Read the uncompressed content of a member
+
+        Returns None for directories and other members without content.
+        """
+        view = self.read_view(name)
+        if view is None:
+            return None
+        return bytes(view)
+
+    def read_head(self, name: str, size: int) -> bytes | None:
+        """Read the first bytes of the uncompressed content of a member
+
+        Only the beginning of deflated members is decompressed. Returns None for
+        directories and other members without content.
+        """
+        member = self._index[name]
+        if not member.is_file:
+            return None
+        if member.compress_type == zipfile.ZIP_STORED:
+            return bytes(self._slice(member)[:size])
+        if member.compress_type == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return decompressor.decompress(self._slice(member), size)
+        view = self.read_view(name)
+        assert view is not None
+        return bytes(view[:size])
+
+    def read_raw(self, name: str) -> tuple[zipfile.ZipInfo, memoryview] | None:
+        """Read the deflated bytes of a zip member without decompressing them
+
+        Returns the member metadata and the raw deflate stream, or None if the
+        member can't be copied as is (tar archives, members that are not
+        deflated or encrypted). The result can be written to another zip
+        file with :func:`write_raw`.
+        """
+        member = self._index[name]
+        info = member.info
+        if (
+            not isinstance(info, zipfile.ZipInfo)
+            or member.compress_type != zipfile.ZIP_DEFLATED
+            or info.flag_bits & 0x1
+        ):
+            return None
+        return info, self._slice(member)
 
     def filter_to_zip(
         self, output_path: Path, func: Callable, compression=zipfile.ZIP_DEFLATED
@@ -61,12 +247,12 @@ class ArchiveFile:
         """
         with zipfile.ZipFile(output_path, "w", compression=compression) as fh:
             for name in self.namelist():
-                if func(name):
-                    fh.writestr(name, self.read(name))
+                if func(name) and (content := self.read(name)) is not None:
+                    fh.writestr(name, content)
         return ArchiveFile(output_path, self.name)
 
     @functools.cache
-    def total_size(self, compressed: bool = False) -> int:
+    def total_size(self, compressed: bool = False, encoding: str = "gzip") -> int:
         """Get total size of files in the archive in bytes
 
         This ignores the archive metadata, so size might differ slightly from a
@@ -75,15 +261,68 @@ class ArchiveFile:
         Parameters
         ----------
         compressed
-            if True total size if returned for gzip compressed files.
-            Otherwise size is for uncompressed files.
+            if True total size if returned for files compressed with encoding.
+            Otherwise size is for uncompressed files. For deflated zip
+            members, the gzip size is estimated from the zip metadata
+            (see :func:`pyodide_pack.size_estimation.estimate_compressed_size`).
+        encoding
+            transfer encoding used for the compressed size (gzip, brotli or zstd)
         """
-        size = 0
-        for name in self.namelist():
-            stream = self.read(name)
-            if stream is None:
-                continue
-            if compressed:
-                stream = gzip.compress(stream)
-            size += len(stream)
-        return size
+        if compressed:
+            return estimate_compressed_size(self, encoding)
+        return sum(member.file_size for member in self._index.values())
+
+
+def write_raw(
+    fh_out: zipfile.ZipFile, name: str, info: zipfile.ZipInfo, raw: bytes | memoryview
+) -> None:
+    """Write an already deflated member to a zip file opened for writing
+
+    Members compressed differently from the output file (e.g. deflated members
+    written to a zip file with stored members) are decompressed and written
+    with the compression of the output file. The same happens if the
+    ``zipfile`` internals used to copy the compressed data are missing.
+
+    Parameters
+    ----------
+    fh_out
+        output zip file
+    name
+        name of the member in the output zip file
+    info
+        metadata of the member in the input zip file (CRC and sizes)
+    raw
+        deflated member data, as returned by :meth:`ArchiveFile.read_raw`
+    """
+    zinfo = zipfile.ZipInfo(name, date_time=info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    zinfo.external_attr = info.external_attr
+    zinfo.create_system = info.create_system
+    if info.compress_type != fh_out.compression or not all(
+        hasattr(fh_out, attr) for attr in _ZIPFILE_WRITE_ATTRS
+    ):
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            raw = zlib.decompress(raw, -zlib.MAX_WBITS)
+        zinfo.compress_type = fh_out.compression
+        with fh_out.open(zinfo, "w") as fh:
+            fh.write(raw)
+        return
+    # zipfile has no public API to add pre-compressed data. This mirrors what
+    # ZipFile.writestr does once the data is compressed. The local header is
+    # written with the final CRC and sizes, so no data descriptor is needed.
+    fp = fh_out.fp
+    assert fp is not None
+    with fh_out._lock:  # type: ignore[attr-defined]
+        if fh_out._seekable:  # type: ignore[attr-defined]
+            fp.seek(fh_out.start_dir)
+        zinfo.header_offset = fp.tell()
+        fh_out._writecheck(zinfo)  # type: ignore[attr-defined]
+        fh_out._didModify = True  # type: ignore[attr-defined]
+        fp.write(zinfo.FileHeader())
+        fp.write(raw)
+        fh_out.start_dir = fp.tell()
+        fh_out.filelist.append(zinfo)
+        fh_out.NameToInfo[zinfo.filename] = zinfo
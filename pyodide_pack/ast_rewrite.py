@@ -1,28 +1,202 @@
 import ast
+import copy
 import fnmatch
+import importlib.util
+import itertools
+import json
+import keyword
 import shutil
+import string
+import symtable
 import sys
 import zipfile
+from collections import Counter
+from collections.abc import Generator
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from time import perf_counter
+from typing import Any
 
 import typer
 
+from pyodide_pack.archive import ZIP_DATE_TIME, ArchiveFile, write_raw
+from pyodide_pack.cache import (
+    ContentCache,
+    JSONCache,
+    file_digest,
+    get_cache_dir,
+)
 from pyodide_pack.config import PyPackConfig
 
+# Bump when the output of the AST rewrites changes, to invalidate cached results
+AST_REWRITE_VERSION = "3"
+
+# Maximal depth of the expressions unparsed by a single call of ast.unparse,
+# which recurses a few times per level of the tree
+UNPARSE_MAX_DEPTH = 64
+
+# Tree shaking levels, see PyPackConfig.tree_shake
+TREE_SHAKE_FETCH = 1
+TREE_SHAKE_RAISE = 2
+
+# Names of libraries and functions which use annotations at runtime. Annotations
+# are kept in modules referencing any of them.
+ANNOTATION_INTROSPECTION_NAMES = {
+    "__annotations__",
+    "attr",
+    "attrs",
+    "dataclass",
+    "dataclasses",
+    "fastapi",
+    "get_annotations",
+    "get_type_hints",
+    "NamedTuple",
+    "pydantic",
+    "singledispatch",
+    "singledispatchmethod",
+    "typer",
+    "TypedDict",
+    "validate_arguments",
+    "validate_call",
+}
+
+# Builtins giving access to local variables by name. Local names are not
+# minified in functions referencing them (or in their enclosing functions).
+DYNAMIC_SCOPE_NAMES = {"dir", "eval", "exec", "locals", "vars"}
+# Attributes used to access the local variables of frames
+FRAME_ATTRIBUTES = {"_getframe", "currentframe", "f_locals"}
+
 STRIP_DOCSTRING_EXCLUDES: list[str] = []
 STRIP_DOCSTRING_MODULE_EXCLUDES: list[str] = [
     "numpy/*"  # known issue for v1.25 to double check for v1.26
 ]
 
 
-class _StripDocstringsTransformer(ast.NodeTransformer):
+class _StackTransformer:
+    """Transform an AST like ast.NodeTransformer, using an explicit work stack
+
+    ast.NodeTransformer recurses for each level of the tree, and raises a
+    RecursionError on deeply nested code (e.g. long chains of binary operations).
+
+    Here, ``enter_<class name>`` methods are called before transforming the
+    children of a node, and ``leave_<class name>`` methods after. As for the
+    ``visit_<class name>`` methods of ast.NodeTransformer, the return value of
+    ``leave_*`` replaces the node: None removes it, and a list of nodes is
+    inserted in place of it in lists of statements. Nodes without fields
+    (operators and expression contexts) are not visited.
+    """
+
+    # (enter, leave) methods by transformer and node class
+    _hooks: dict[tuple[type, type], tuple[Any, Any]] = {}
+
+    def _get_hooks(self, node_cls: type) -> tuple[Any, Any]:
+        key = (type(self), node_cls)
+        if (hooks := self._hooks.get(key)) is None:
+            name = node_cls.__name__
+            hooks = self._hooks[key] = (
+                getattr(type(self), f"enter_{name}", None),
+                getattr(type(self), f"leave_{name}", None),
+            )
+        return hooks
+
+    def leave(self, node: ast.AST) -> Any:
+        if leave := self._get_hooks(type(node))[1]:
+            return leave(self, node)
+        return node
+
+    def _start(self, node: ast.AST, slot: tuple[dict[str, Any], str, bool]) -> tuple:
+        """Enter a node, and create its frame in the work stack
+
+        The frame has the node, the (field name, is a list, value) of children
+        left to transform in reverse order, the new values of fields, and the
+        slot where to store the transformed node as (new values of the parent
+        fields, field name, is a list).
+        """
+        if enter := self._get_hooks(type(node))[0]:
+            enter(self, node)
+        pending: list[tuple[str, bool, Any]] = []
+        fields: dict[str, Any] = {}
+        for name in node._fields:
+            value = getattr(node, name, None)
+            if isinstance(value, list):
+                fields[name] = []
+                pending += [(name, True, item) for item in value]
+            elif isinstance(value, ast.AST) and value._fields:
+                pending.append((name, False, value))
+        pending.reverse()
+        return node, pending, fields, slot
+
+    def _finish(self, frame: tuple) -> None:
+        """Update the fields of a node once its children are transformed, and
+        store the transformed node in its parent fields"""
+        node, _, fields, (parent_fields, field, is_list) = frame
+        for name, value in fields.items():
+            if value is None:
+                delattr(node, name)
+            else:
+                setattr(node, name, value)
+        new_node = self.leave(node)
+        if not is_list:
+            parent_fields[field] = new_node
+        elif isinstance(new_node, ast.AST):
+            parent_fields[field].append(new_node)
+        elif new_node is not None:
+            parent_fields[field].extend(new_node)
+
+    def visit(self, tree: ast.AST) -> Any:
+        output: dict[str, Any] = {}
+        stack = [self._start(tree, (output, "tree", False))]
+        while stack:
+            frame = stack[-1]
+            _, pending, fields, _ = frame
+            while pending:
+                name, child_is_list, child = pending.pop()
+                if isinstance(child, ast.AST) and child._fields:
+                    child_frame = self._start(child, (fields, name, child_is_list))
+                    if child_frame[1]:
+                        stack.append(child_frame)
+                        break
+                    # No children to transform
+                    self._finish(child_frame)
+                else:
+                    # e.g. None keys of dict unpacking in ast.Dict
+                    fields[name].append(child)
+            else:
+                stack.pop()
+                self._finish(frame)
+        return output["tree"]
+
+
+def _walk_statements(tree: ast.AST) -> Generator[ast.AST, None, None]:
+    """Walk the statements of a tree in order, using an explicit work stack
+
+    Exception handlers and match cases are also yielded. The children of a
+    node are looked up once the caller is done with it, so that it can modify
+    its body.
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        for name in ("cases", "finalbody", "orelse", "handlers", "body"):
+            block = getattr(node, name, None)
+            if isinstance(block, list):
+                stack.extend(reversed(block))
+
+
+class _StripDocstringsTransformer:
     """Strip docstring in an AST tree.
 
     AST parsing also strips comments.
     """
 
-    def visit_FunctionDef(self, node):
+    def visit(self, tree: ast.AST) -> Any:
+        for node in _walk_statements(tree):
+            if isinstance(node, ast.FunctionDef | ast.AsyncFunctionDef | ast.ClassDef):
+                self.strip_docstring(node)
+        return tree
+
+    def strip_docstring(self, node):
         """Remove the docstring from the function definition"""
         if ast.get_docstring(node, clean=False) is not None:
             del node.body[0]
@@ -30,12 +204,956 @@ class _StripDocstringsTransformer(ast.NodeTransformer):
                 # Nothing left in the body, add a pass statement
                 node.body.append(ast.Pass())
 
-        # Continue processing the function's body
-        self.generic_visit(node)
+
+def _function_first_line(node: ast.FunctionDef | ast.AsyncFunctionDef) -> int:
+    """First line of a function definition, as in the co_firstlineno of its code
+
+    This is the line of the first decorator for decorated functions.
+    """
+    return min([node.lineno] + [dec.lineno for dec in node.decorator_list])
+
+
+def _functions_with_free_variables(code: str) -> set[tuple[int, str]]:
+    """Find functions with free variables, by (def line, name)
+
+    Such functions (closures, methods using super()) can't be re-created from
+    their code object alone.
+    """
+    output = set()
+    tables = [symtable.symtable(code, "<string>", "exec")]
+    while tables:
+        table = tables.pop()
+        if isinstance(table, symtable.Function) and table.get_frees():
+            output.add((table.get_lineno(), table.get_name()))
+        tables.extend(table.get_children())
+    return output
+
+
+def _is_generator(node: ast.FunctionDef | ast.AsyncFunctionDef) -> bool:
+    """Check if a function contains yield, excluding nested scopes"""
+    nodes: list[ast.AST] = list(node.body)
+    while nodes:
+        child = nodes.pop()
+        if isinstance(child, ast.Yield | ast.YieldFrom):
+            return True
+        if not isinstance(
+            child, ast.FunctionDef | ast.AsyncFunctionDef | ast.ClassDef | ast.Lambda
+        ):
+            nodes.extend(ast.iter_child_nodes(child))
+    return False
+
+
+def _forward_arguments(func: ast.expr, args: ast.arguments) -> ast.Call:
+    """Call func with all the arguments of a function definition
+
+    Examples
+    --------
+    >>> args = ast.parse("def f(a, /, b, *c, d, **e): pass").body[0].args
+    >>> ast.unparse(_forward_arguments(ast.Name("g"), args))
+    'g(a, b, *c, d=d, **e)'
+    """
+    positional: list[ast.expr] = [
+        ast.Name(arg.arg) for arg in args.posonlyargs + args.args
+    ]
+    if args.vararg is not None:
+        positional.append(ast.Starred(ast.Name(args.vararg.arg)))
+    keywords = [ast.keyword(arg.arg, ast.Name(arg.arg)) for arg in args.kwonlyargs]
+    if args.kwarg is not None:
+        keywords.append(ast.keyword(None, ast.Name(args.kwarg.arg)))
+    return ast.Call(func=func, args=positional, keywords=keywords)
+
+
+class _StubUnusedFunctionsTransformer:
+    """Replace the body of functions that were not executed with a stub
+
+    With the TREE_SHAKE_FETCH level, the stub loads the original function
+    from the unmodified source with pyodide_pack_loader and calls it. With the
+    TREE_SHAKE_RAISE level, it raises a RuntimeError.
+
+    Parameters
+    ----------
+    executed_functions
+        (first line, name) of the functions executed at runtime in this file
+    runtime_path
+        path of the file in Pyodide
+    level
+        tree shaking level
+    code
+        source code of the file, used to detect closures with TREE_SHAKE_FETCH
+    """
+
+    def __init__(
+        self,
+        executed_functions: set[tuple[int, str]],
+        runtime_path: str,
+        level: int,
+        code: str,
+    ):
+        self.executed_functions = executed_functions
+        self.runtime_path = runtime_path
+        self.level = level
+        self.closures = (
+            _functions_with_free_variables(code) if level == TREE_SHAKE_FETCH else set()
+        )
+        self.n_stubs = 0
+
+    def _make_stub(self, node: ast.FunctionDef | ast.AsyncFunctionDef) -> ast.stmt:
+        first_line = _function_first_line(node)
+        if self.level == TREE_SHAKE_RAISE:
+            return ast.Raise(
+                exc=ast.Call(
+                    func=ast.Name("RuntimeError"),
+                    args=[
+                        ast.Constant(
+                            f"{node.name} ({self.runtime_path}:{first_line}) was "
+                            "removed by pyodide-pack as it was not executed"
+                        )
+                    ],
+                    keywords=[],
+                )
+            )
+        load_function = ast.parse(
+            f"__import__('pyodide_pack_loader').load_function(globals(), "
+            f"{self.runtime_path!r}, {first_line}, {node.name!r})",
+            mode="eval",
+        ).body
+        call: ast.expr = _forward_arguments(load_function, node.args)
+        if isinstance(node, ast.AsyncFunctionDef):
+            call = ast.Await(call)
+        return ast.Return(call)
+
+    def _can_stub(self, node: ast.FunctionDef | ast.AsyncFunctionDef) -> bool:
+        if (_function_first_line(node), node.name) in self.executed_functions:
+            return False
+        body = node.body
+        if len(body) == 1 and not hasattr(body[0], "body"):
+            # A single simple statement, the stub would not be smaller
+            return False
+        if self.level == TREE_SHAKE_FETCH and (
+            (node.lineno, node.name) in self.closures
+            # Removing yield would turn async generators into coroutines
+            or (isinstance(node, ast.AsyncFunctionDef) and _is_generator(node))
+        ):
+            return False
+        return True
+
+    def visit(self, tree: ast.AST) -> Any:
+        for node in _walk_statements(tree):
+            if isinstance(node, ast.FunctionDef | ast.AsyncFunctionDef) and (
+                self._can_stub(node)
+            ):
+                node.body = [self._make_stub(node)]
+                self.n_stubs += 1
+        return tree
+
+
+def _module_level_bindings(tree: ast.Module) -> Counter[str]:
+    """Count the statements binding each name in the module scope
+
+    Names bound in comprehensions are also counted, which only makes callers
+    more conservative.
+    """
+    bindings: Counter[str] = Counter()
+    nodes: list[ast.AST] = list(tree.body)
+    while nodes:
+        node = nodes.pop()
+        match node:
+            case ast.FunctionDef() | ast.AsyncFunctionDef() | ast.ClassDef():
+                bindings[node.name] += 1
+                # Only decorators, default values and base classes are evaluated
+                # in the module scope
+                nodes.extend(getattr(node, "decorator_list", []))
+                if isinstance(node, ast.ClassDef):
+                    nodes.extend(node.bases)
+                    nodes.extend(node.keywords)
+                else:
+                    nodes.append(node.args)
+                continue
+            case ast.Lambda():
+                nodes.append(node.args)
+                continue
+            case ast.Import() | ast.ImportFrom():
+                for alias in node.names:
+                    bindings[alias.asname or alias.name.split(".")[0]] += 1
+                continue
+            case ast.Name(ctx=ast.Store() | ast.Del()):
+                bindings[node.id] += 1
+            case ast.ExceptHandler(name=str(name)):
+                bindings[name] += 1
+        nodes.extend(ast.iter_child_nodes(node))
+    return bindings
+
+
+def _global_name_uses(
+    code: str,
+) -> tuple[set[str], dict[tuple[int, str], set[str]], set[str]]:
+    """Find where global names are used, with symtable
+
+    Returns
+    -------
+    top_level_uses
+        names used when the module is executed: in the module scope, class
+        bodies, and comprehensions or lambdas outside of functions
+    function_uses
+        names used in each function defined outside of other functions,
+        identified by (def line, name). This includes uses in nested scopes.
+    declared_global
+        names declared global in a function
+    """
+    top_level_uses: set[str] = set()
+    function_uses: dict[tuple[int, str], set[str]] = {}
+    declared_global: set[str] = set()
+
+    module_table = symtable.symtable(code, "<string>", "exec")
+    top_level_uses.update(
+        sym.get_name() for sym in module_table.get_symbols() if sym.is_referenced()
+    )
+    stack: list[tuple[symtable.SymbolTable, tuple[int, str] | None]] = [
+        (child, None) for child in module_table.get_children()
+    ]
+    while stack:
+        table, function_key = stack.pop()
+        if (
+            function_key is None
+            and isinstance(table, symtable.Function)
+            and not table.get_name().startswith("<")
+        ):
+            function_key = (table.get_lineno(), table.get_name())
+        for sym in table.get_symbols():
+            if sym.is_declared_global():
+                declared_global.add(sym.get_name())
+            if not (sym.is_referenced() and sym.is_global()):
+                continue
+            if function_key is None:
+                top_level_uses.add(sym.get_name())
+            else:
+                function_uses.setdefault(function_key, set()).add(sym.get_name())
+        stack.extend((child, function_key) for child in table.get_children())
+    return top_level_uses, function_uses, declared_global
+
+
+def _top_level_functions(
+    tree: ast.Module,
+) -> dict[tuple[int, str], ast.FunctionDef | ast.AsyncFunctionDef]:
+    """Functions defined outside of other functions, by (def line, name)"""
+    functions = {}
+    nodes: list[ast.AST] = list(tree.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, ast.FunctionDef | ast.AsyncFunctionDef):
+            functions[(node.lineno, node.name)] = node
+        elif isinstance(node, ast.stmt):
+            nodes.extend(ast.iter_child_nodes(node))
+    return functions
+
+
+def _insert_after_docstring(body: list[ast.stmt], stmts: list[ast.stmt]) -> None:
+    idx = 0
+    if (
+        body
+        and isinstance(body[0], ast.Expr)
+        and isinstance(body[0].value, ast.Constant)
+        and isinstance(body[0].value.value, str)
+    ):
+        idx = 1
+    body[idx:idx] = stmts
+
+
+def _defer_imports(
+    tree: ast.Module,
+    code: str,
+    module_name: str,
+    is_package: bool,
+    slow_modules: frozenset[str],
+) -> ast.Module:
+    """Defer top-level imports of slow modules until they are used
+
+    Imports of slow modules, bound to names only used in functions, are moved
+    into these functions. In package ``__init__`` files, imports of names that
+    are not used at all (i.e. re-exports) are also deferred. Deferred names
+    stay available as module attributes through a module ``__getattr__``
+    (PEP 562).
+
+    Imports are kept if their name is used when the module is executed, is
+    bound more than once, or if the module already defines ``__getattr__``.
+
+    Parameters
+    ----------
+    tree
+        module to rewrite
+    code
+        source code of the module
+    module_name
+        name of the module, used to resolve relative imports
+    is_package
+        whether the module is the ``__init__`` of a package
+    slow_modules
+        modules which are worth deferring
+    """
+    package = module_name if is_package else module_name.rpartition(".")[0]
+    bindings = _module_level_bindings(tree)
+    if bindings["__getattr__"]:
+        return tree
+
+    # Imports that can be deferred, as a single-name import statement
+    candidates: dict[str, ast.Import | ast.ImportFrom] = {}
+    # Submodules of the package implicitly set as attributes by these imports
+    submodules: dict[str, set[str]] = {}
+    for stmt in tree.body:
+        if isinstance(stmt, ast.Import):
+            for alias in stmt.names:
+                name = alias.asname or alias.name.split(".")[0]
+                if alias.name in slow_modules and bindings[name] == 1:
+                    candidates[name] = ast.Import(names=[alias])
+        elif isinstance(stmt, ast.ImportFrom):
+            if stmt.module == "__future__" or stmt.names[0].name == "*":
+                continue
+            try:
+                resolved = importlib.util.resolve_name(
+                    "." * stmt.level + (stmt.module or ""), package
+                )
+            except (ImportError, ValueError):
+                continue
+            for alias in stmt.names:
+                name = alias.asname or alias.name
+                targets = {resolved, f"{resolved}.{alias.name}"}
+                if targets & slow_modules and bindings[name] == 1:
+                    candidates[name] = ast.ImportFrom(
+                        module=stmt.module, names=[alias], level=stmt.level
+                    )
+                    if is_package and resolved.startswith(package + "."):
+                        submodule = resolved[len(package) + 1 :].split(".")[0]
+                        submodules.setdefault(submodule, set()).add(name)
+    if not candidates:
+        return tree
+
+    top_level_uses, function_uses, declared_global = _global_name_uses(code)
+    used_in_functions = set().union(*function_uses.values())
+    deferred = {
+        name
+        for name in candidates
+        if name not in top_level_uses
+        and name not in declared_global
+        and (name in used_in_functions or is_package)
+    }
+    if not deferred:
+        return tree
+
+    # Remove deferred imports from the module scope
+    body = []
+    for stmt in tree.body:
+        if isinstance(stmt, ast.Import | ast.ImportFrom) and stmt.names[0].name != "*":
+            stmt.names = [
+                alias
+                for alias in stmt.names
+                if (alias.asname or alias.name.split(".")[0]) not in deferred
+            ]
+            if not stmt.names:
+                continue
+        body.append(stmt)
+    tree.body = body
+
+    # and add them to the functions using them
+    for key, node in _top_level_functions(tree).items():
+        if names := function_uses.get(key, set()) & deferred:
+            _insert_after_docstring(
+                node.body, [copy.deepcopy(candidates[name]) for name in sorted(names)]
+            )
+
+    # Module attributes, for other modules to access them
+    lazy_imports = {name: candidates[name] for name in deferred}
+    for submodule, names in submodules.items():
+        if bindings[submodule] == 0 and names & deferred:
+            lazy_imports[submodule] = ast.ImportFrom(
+                module=None, names=[ast.alias(submodule)], level=1
+            )
+    lines = ["def __getattr__(name):"]
+    for name in sorted(lazy_imports):
+        lines += [
+            f"    if name == {name!r}:",
+            f"        {ast.unparse(lazy_imports[name])}",
+            f"        globals()[{name!r}] = {name}",
+            f"        return {name}",
+        ]
+    lines.append(
+        "    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')"
+    )
+    tree.body.extend(ast.parse("\n".join(lines)).body)
+    return tree
+
+
+def _affects_enclosing_scope(stmts: list[ast.stmt]) -> bool:
+    """Check if removing statements could change the enclosing scope
+
+    This is the case if they contain yield (which makes a function a generator),
+    global or nonlocal declarations.
+    """
+    nodes: list[ast.AST] = list(stmts)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, ast.Yield | ast.YieldFrom | ast.Global | ast.Nonlocal):
+            return True
+        if not isinstance(
+            node, ast.FunctionDef | ast.AsyncFunctionDef | ast.ClassDef | ast.Lambda
+        ):
+            nodes.extend(ast.iter_child_nodes(node))
+    return False
+
+
+def _is_type_checking(node: ast.expr) -> bool:
+    """Check if an expression is TYPE_CHECKING or typing.TYPE_CHECKING"""
+    return (isinstance(node, ast.Name) and node.id == "TYPE_CHECKING") or (
+        isinstance(node, ast.Attribute) and node.attr == "TYPE_CHECKING"
+    )
+
+
+def _constant_value(node: ast.expr) -> tuple[bool, Any]:
+    """Evaluate an expression if it's constant
+
+    Returns (True, value) for constant expressions, (False, None) otherwise.
+
+    Examples
+    --------
+    >>> _constant_value(ast.parse("not TYPE_CHECKING and 1", mode="eval").body)
+    (True, 1)
+    >>> _constant_value(ast.parse("x or True", mode="eval").body)
+    (False, None)
+    """
+    match node:
+        case ast.Constant(value=value):
+            return True, value
+        case ast.UnaryOp(op=ast.Not(), operand=operand):
+            is_constant, value = _constant_value(operand)
+            return is_constant, not value if is_constant else None
+        case ast.BoolOp(op=op, values=values):
+            evaluated = [_constant_value(value) for value in values]
+            if not all(is_constant for is_constant, _ in evaluated):
+                return False, None
+            result = evaluated[0][1]
+            for _, value in evaluated[1:]:
+                if isinstance(op, ast.And):
+                    result = result and value
+                else:
+                    result = result or value
+            return True, result
+    if _is_type_checking(node):
+        return True, False
+    return False, None
+
+
+def _introspects_annotations(tree: ast.Module) -> bool:
+    """Check if a module may introspect annotations at runtime
+
+    This looks for names related to libraries using annotations at runtime,
+    such as dataclasses or pydantic.
+    """
+    for node in ast.walk(tree):
+        match node:
+            case ast.Name(id=name) | ast.Attribute(attr=name):
+                if name in ANNOTATION_INTROSPECTION_NAMES:
+                    return True
+            case ast.Import(names=names) | ast.ImportFrom(names=names):
+                for alias in names:
+                    if alias.name.split(".")[0] in ANNOTATION_INTROSPECTION_NAMES:
+                        return True
+                module = getattr(node, "module", None) or ""
+                if module.split(".")[0] in ANNOTATION_INTROSPECTION_NAMES:
+                    return True
+    return False
+
+
+def _is_registered(node: ast.FunctionDef | ast.AsyncFunctionDef) -> bool:
+    """Check if a function is decorated with ``<x>.register``
+
+    ``functools.singledispatch`` reads the annotations of registered functions
+    at runtime to find the dispatch type.
+
+    >>> tree = ast.parse("@fun.register\\ndef _(arg: int): pass")
+    >>> _is_registered(tree.body[0])
+    True
+    """
+    for decorator in node.decorator_list:
+        if isinstance(decorator, ast.Call):
+            decorator = decorator.func
+        if isinstance(decorator, ast.Attribute) and decorator.attr == "register":
+            return True
+    return False
+
+
+class _OptimizeTransformer(_StackTransformer):
+    """Remove code that is not needed at runtime, similar to ``python -O``
+
+    This removes assert statements, ``if __debug__:`` and ``if TYPE_CHECKING:``
+    blocks, and folds conditions that are constant. With strip_annotations,
+    function annotations are also removed, except for functions registered
+    with ``<x>.register``, as well as annotations of variables outside of
+    class bodies.
+    """
+
+    def __init__(self, strip_annotations: bool = False):
+        self.strip_annotations = strip_annotations
+        self._scopes: list[type[ast.AST]] = [ast.Module]
+
+    def leave(self, node):
+        # Statements may have been removed from blocks
+        if not isinstance(node, ast.Module) and getattr(node, "body", None) == []:
+            node.body = [ast.Pass()]
+        if isinstance(node, ast.Try) and not node.handlers and not node.finalbody:
+            node.finalbody = [ast.Pass()]
+        return super().leave(node)
+
+    def leave_Assert(self, node):
+        return None
+
+    def leave_Name(self, node):
+        if node.id == "__debug__" and isinstance(node.ctx, ast.Load):
+            return ast.copy_location(ast.Constant(False), node)
         return node
 
-    visit_AsyncFunctionDef = visit_FunctionDef
-    visit_ClassDef = visit_FunctionDef
+    def leave_If(self, node):
+        is_constant, value = _constant_value(node.test)
+        if not is_constant:
+            return node
+        kept, removed = (node.body, node.orelse) if value else (node.orelse, node.body)
+        if _affects_enclosing_scope(removed):
+            return node
+        return kept
+
+    def leave_IfExp(self, node):
+        is_constant, value = _constant_value(node.test)
+        if not is_constant:
+            return node
+        return node.body if value else node.orelse
+
+    def enter_FunctionDef(self, node):
+        if self.strip_annotations and not _is_registered(node):
+            node.returns = None
+            args = node.args
+            for arg in [*args.posonlyargs, *args.args, *args.kwonlyargs]:
+                arg.annotation = None
+            for arg in [args.vararg, args.kwarg]:
+                if arg is not None:
+                    arg.annotation = None
+        self._scopes.append(ast.FunctionDef)
+
+    enter_AsyncFunctionDef = enter_FunctionDef
+
+    def enter_Lambda(self, node):
+        self._scopes.append(ast.FunctionDef)
+
+    def enter_ClassDef(self, node):
+        self._scopes.append(ast.ClassDef)
+
+    def leave_FunctionDef(self, node):
+        self._scopes.pop()
+        return node
+
+    leave_AsyncFunctionDef = leave_Lambda = leave_ClassDef = leave_FunctionDef
+
+    def leave_AnnAssign(self, node):
+        if not self.strip_annotations or self._scopes[-1] is ast.ClassDef:
+            # Class annotations define fields for dataclasses, NamedTuple, etc.
+            return node
+        if node.value is not None:
+            return ast.copy_location(
+                ast.Assign(targets=[node.target], value=node.value), node
+            )
+        if self._scopes[-1] is ast.Module:
+            return None
+        # A bare annotation in a function makes the name local
+        return node
+
+
+def _remove_unused_type_checking_import(tree: ast.Module) -> None:
+    """Remove the import of TYPE_CHECKING, once it's no longer used"""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "TYPE_CHECKING":
+            return
+    body = []
+    for stmt in tree.body:
+        if isinstance(stmt, ast.ImportFrom) and stmt.module == "typing":
+            stmt.names = [
+                alias
+                for alias in stmt.names
+                if (alias.name, alias.asname) != ("TYPE_CHECKING", None)
+            ]
+            if not stmt.names:
+                continue
+        body.append(stmt)
+    tree.body = body
+
+
+def _optimize(tree: ast.Module, level: int) -> ast.Module:
+    """Apply the optimizations of the given level (see PyPackConfig.optimize)"""
+    if level <= 0:
+        return tree
+    strip_annotations = level >= 2 and not _introspects_annotations(tree)
+    tree = _OptimizeTransformer(strip_annotations=strip_annotations).visit(tree)
+    _remove_unused_type_checking_import(tree)
+    return tree
+
+
+_COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+_FUNCTIONS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)
+_SCOPES = (*_FUNCTIONS, ast.ClassDef, *_COMPREHENSIONS)
+
+
+def _scope_parts(node: ast.AST) -> tuple[list[ast.AST], list[ast.AST]]:
+    """Split the children of a scope node between the enclosing scope and itself
+
+    Returns
+    -------
+    outer
+        nodes evaluated in the enclosing scope (decorators, defaults, bases,
+        annotations, the first iterable of comprehensions)
+    inner
+        nodes evaluated in the scope, including its parameters
+    """
+    if isinstance(node, _FUNCTIONS):
+        args = node.args
+        params = [
+            param
+            for param in [
+                *args.posonlyargs,
+                *args.args,
+                args.vararg,
+                *args.kwonlyargs,
+                args.kwarg,
+            ]
+            if param is not None
+        ]
+        outer: list[ast.AST] = [
+            *args.defaults,
+            *(default for default in args.kw_defaults if default is not None),
+        ]
+        if isinstance(node, ast.Lambda):
+            return outer, [*params, node.body]
+        outer += node.decorator_list
+        outer += [param.annotation for param in params if param.annotation]
+        if node.returns is not None:
+            outer.append(node.returns)
+        return outer, [*params, *node.body]
+    if isinstance(node, ast.ClassDef):
+        return [*node.decorator_list, *node.bases, *node.keywords], list(node.body)
+    assert isinstance(node, _COMPREHENSIONS)
+    first, *others = node.generators
+    if isinstance(node, ast.DictComp):
+        elts = [node.key, node.value]
+    else:
+        elts = [node.elt]
+    return [first.iter], [first.target, *first.ifs, *others, *elts]
+
+
+def _walk_scope(nodes: list[ast.AST]) -> Generator[ast.AST, None, None]:
+    """Walk the nodes evaluated in a scope
+
+    Nested scopes are yielded, but only their parts evaluated in the enclosing
+    scope are walked.
+    """
+    stack = nodes[::-1]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, _SCOPES):
+            children = _scope_parts(node)[0]
+        elif isinstance(node, ast.arg):
+            # Annotations are in the outer parts of the function
+            continue
+        else:
+            children = list(ast.iter_child_nodes(node))
+        stack.extend(reversed(children))
+
+
+def _scope_bindings(scope: ast.AST) -> tuple[dict[str, bool], set[str]]:
+    """Find the names local to a scope, and whether they can be renamed
+
+    Names can be renamed if they are only bound by assignments and exception
+    handlers. Parameters are kept, as their names are part of the signature of
+    the function (e.g. for ``inspect.signature`` or error messages).
+
+    Returns
+    -------
+    bindings
+        mapping of local names to whether they can be renamed
+    global_names
+        names declared global in the scope
+    """
+    bindings: dict[str, bool] = {}
+
+    def bind(name: str, renamable: bool) -> None:
+        bindings[name] = bindings.get(name, True) and renamable
+
+    if isinstance(scope, _FUNCTIONS):
+        args = scope.args
+        for param in [*args.posonlyargs, *args.args, args.vararg, *args.kwonlyargs]:
+            if param is not None:
+                bind(param.arg, False)
+        if args.kwarg is not None:
+            bind(args.kwarg.arg, False)
+    global_names: set[str] = set()
+    nonlocal_names: set[str] = set()
+    for node in _walk_scope(_scope_parts(scope)[1]):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bind(node.id, True)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bind(node.name, True)
+        elif isinstance(node, ast.Import | ast.ImportFrom):
+            for alias in node.names:
+                bind((alias.asname or alias.name).split(".")[0], False)
+        elif isinstance(node, ast.FunctionDef | ast.AsyncFunctionDef | ast.ClassDef):
+            bind(node.name, False)
+        elif isinstance(node, ast.MatchAs | ast.MatchStar) and node.name:
+            bind(node.name, False)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            bind(node.rest, False)
+        elif isinstance(node, ast.Global):
+            global_names.update(node.names)
+        elif isinstance(node, ast.Nonlocal):
+            nonlocal_names.update(node.names)
+    for name in global_names | nonlocal_names:
+        bindings.pop(name, None)
+    return bindings, global_names
+
+
+def _uses_dynamic_scope(scope: ast.AST) -> bool:
+    """Check if local names of a scope may be accessed by name
+
+    This is the case if the scope or a nested scope uses DYNAMIC_SCOPE_NAMES
+    or FRAME_ATTRIBUTES. Assignment expressions in comprehensions, which bind
+    names in the enclosing function, are also considered dynamic.
+    """
+    for node in ast.walk(scope):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if node.func.id in {"dir", "vars"} and not (node.args or node.keywords):
+                return True
+        elif isinstance(node, ast.Name) and node.id in DYNAMIC_SCOPE_NAMES - {
+            "dir",
+            "vars",
+        }:
+            return True
+        elif isinstance(node, ast.Attribute) and node.attr in FRAME_ATTRIBUTES:
+            return True
+        elif isinstance(node, _COMPREHENSIONS) and any(
+            isinstance(child, ast.NamedExpr) for child in ast.walk(node)
+        ):
+            return True
+        elif getattr(node, "type_params", None):
+            return True
+    return False
+
+
+def _identifiers(scope: ast.AST) -> set[str]:
+    """All the identifiers of names in a scope and its nested scopes"""
+    names = set()
+    for node in ast.walk(scope):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.alias):
+            names.add((node.asname or node.name).split(".")[0])
+        elif isinstance(node, ast.Global | ast.Nonlocal):
+            names.update(node.names)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+        elif isinstance(
+            node,
+            ast.FunctionDef
+            | ast.AsyncFunctionDef
+            | ast.ClassDef
+            | ast.ExceptHandler
+            | ast.MatchAs
+            | ast.MatchStar,
+        ):
+            if node.name:
+                names.add(node.name)
+    return names
+
+
+def _short_names() -> Generator[str, None, None]:
+    """Generate the shortest identifiers first
+
+    Examples
+    --------
+    >>> names = _short_names()
+    >>> [next(names) for _ in range(3)]
+    ['a', 'b', 'c']
+    >>> next(itertools.islice(names, 48, None))
+    'Z'
+    >>> next(names)
+    'aa'
+    """
+    for size in itertools.count(1):
+        for chars in itertools.product(string.ascii_letters, repeat=size):
+            yield "".join(chars)
+
+
+def _rename_scope_locals(scope: ast.AST) -> None:
+    """Rename the local variables of a function or comprehension to short names
+
+    Names are renamed in the scope and in the nested scopes where they refer to
+    the same variable. A name is kept if it is bound in a nested class body,
+    where it would become a class attribute.
+    """
+    bindings, _ = _scope_bindings(scope)
+    candidates = {
+        name
+        for name, renamable in bindings.items()
+        if renamable and not name.startswith("__")
+    }
+    if not candidates:
+        return
+
+    # (node, attribute) of all the occurrences of each candidate
+    occurrences: dict[str, list[tuple[ast.AST, str]]] = {
+        name: [] for name in candidates
+    }
+    invalid: set[str] = set()
+    stack = [(_scope_parts(scope)[1], candidates)]
+    while stack:
+        nodes, active = stack.pop()
+        for node in _walk_scope(nodes):
+            if isinstance(node, ast.Name) and node.id in active:
+                occurrences[node.id].append((node, "id"))
+            elif isinstance(node, ast.ExceptHandler) and node.name in active:
+                occurrences[node.name].append((node, "name"))
+            elif isinstance(node, ast.Nonlocal) and set(node.names) & active:
+                for name in set(node.names) & active:
+                    occurrences[name].append((node, "names"))
+            elif isinstance(node, _SCOPES):
+                nested_bindings, nested_globals = _scope_bindings(node)
+                shadowed = active & (set(nested_bindings) | nested_globals)
+                if isinstance(node, ast.ClassDef):
+                    invalid |= shadowed
+                if nested_active := active - shadowed:
+                    stack.append((_scope_parts(node)[1], nested_active))
+
+    taken = _identifiers(scope)
+    short_names = (
+        name
+        for name in _short_names()
+        if name not in taken
+        and not keyword.iskeyword(name)
+        and not keyword.issoftkeyword(name)
+    )
+    new_name = next(short_names)
+    for name in sorted(
+        candidates - invalid, key=lambda name: (-len(occurrences[name]), name)
+    ):
+        if len(new_name) >= len(name):
+            continue
+        for node, attr in occurrences[name]:
+            if attr == "names":
+                assert isinstance(node, ast.Nonlocal)
+                node.names = [new_name if el == name else el for el in node.names]
+            else:
+                setattr(node, attr, new_name)
+        new_name = next(short_names)
+
+
+def _minify_local_names(tree: ast.Module) -> ast.Module:
+    """Rename local variables of functions and comprehensions to short names
+
+    Only names that can't be accessed from outside of the function are renamed,
+    i.e. parameters, nested function and class names and imports are kept.
+    Functions that may access their local variables by name (e.g. with
+    ``locals()`` or ``eval``) are left unchanged.
+
+    Examples
+    --------
+    >>> tree = ast.parse(
+    ...     "def f(value, /, *args, key=None):\\n"
+    ...     "    total = value + sum(args)\\n"
+    ...     "    return [total * item for item in key]\\n"
+    ... )
+    >>> print(ast.unparse(_minify_local_names(tree)))
+    def f(value, /, *args, key=None):
+        a = value + sum(args)
+        return [a * b for b in key]
+    """
+    for node in ast.walk(tree):
+        if isinstance(
+            node, (ast.FunctionDef, ast.AsyncFunctionDef, *_COMPREHENSIONS)
+        ) and not _uses_dynamic_scope(node):
+            _rename_scope_locals(node)
+    return tree
+
+
+def _can_unparse_separately(node: ast.AST) -> bool:
+    """Check if an expression can be unparsed on its own and parenthesized"""
+    if not isinstance(node, ast.expr) or isinstance(
+        node, ast.Starred | ast.Slice | ast.JoinedStr | ast.FormattedValue
+    ):
+        return False
+    # Tuples of slices, as in x[a:b, c] can't be parenthesized
+    return not (
+        isinstance(node, ast.Tuple)
+        and any(isinstance(elt, ast.Slice) for elt in node.elts)
+    )
+
+
+def _unparse(tree: ast.AST) -> str:
+    """Unparse an AST of any depth
+
+    ast.unparse raises a RecursionError on deeply nested expressions (e.g.
+    long chains of binary operations). In that case, the tree is walked with an
+    explicit stack, and expressions deeper than UNPARSE_MAX_DEPTH are unparsed
+    bottom-up. Their source, in parentheses, then replaces them in their
+    parent as a ``Name`` node, which ast.unparse writes as is. Statements are
+    nested at most 100 levels deep (the limit of the tokenizer).
+
+    The tree may be modified in place.
+
+    Examples
+    --------
+    >>> tree = ast.parse(" + ".join(["a"] * 2_000))
+    >>> code = _unparse(tree)
+    >>> code.count("a"), code.count("(")
+    (2000, 31)
+    """
+    try:
+        return ast.unparse(tree)
+    except RecursionError:
+        pass
+
+    heights: dict[ast.AST, int] = {}
+    sources: dict[ast.AST, str] = {}
+    # (node, children were processed, is in an f-string)
+    stack = [(tree, False, False)]
+    while stack:
+        node, processed, in_fstring = stack.pop()
+        if not processed:
+            stack.append((node, True, in_fstring))
+            in_fstring = in_fstring or isinstance(node, ast.JoinedStr)
+            # Nodes without fields (e.g. operators and ast.Load) are shared
+            # between parents, and skipped
+            stack.extend(
+                (child, False, in_fstring)
+                for child in ast.iter_child_nodes(node)
+                if child._fields
+            )
+            continue
+        height = 0
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                for idx, item in enumerate(value):
+                    if item in sources:
+                        value[idx] = ast.Name(f"({sources.pop(item)})")
+                    elif isinstance(item, ast.AST) and item._fields:
+                        height = max(height, heights.pop(item))
+            elif value in sources:
+                setattr(node, name, ast.Name(f"({sources.pop(value)})"))
+            elif isinstance(value, ast.AST) and value._fields:
+                height = max(height, heights.pop(value))
+        if (
+            height >= UNPARSE_MAX_DEPTH
+            and not in_fstring
+            and _can_unparse_separately(node)
+        ):
+            sources[node] = ast.unparse(node)
+        else:
+            heights[node] = height + 1
+    return ast.unparse(tree)
 
 
 def _path_matches_patterns(path: str, patterns: list[str]) -> bool:
@@ -65,37 +1183,210 @@ def _rewrite_py_code(
     code: str,
     file_name: str,
     py_config: PyPackConfig,
+    cache: ContentCache | None = None,
+    executed_functions: set[tuple[int, str]] | None = None,
+    runtime_path: str | None = None,
+    module: tuple[str, bool] | None = None,
+    slow_modules: frozenset[str] | None = None,
 ) -> str:
+    """Apply the AST rewrites enabled in py_config to the code of a file
+
+    If a cache is provided, results are looked up by the hash of the code, the
+    enabled rewrites and the version of the rewriter.
+
+    With py_config.tree_shake, functions that are not in executed_functions
+    (as (first line, name) pairs) are replaced by stubs. Tree shaking is
+    skipped when executed_functions is None, i.e. when functions were not
+    recorded during discovery.
+
+    If slow_modules is provided, imports of these modules are deferred (see
+    _defer_imports). This requires the module (name, is_package) of the file,
+    and is skipped when stubs fetch original functions, as these would no longer
+    find deferred imports in the module globals.
+    """
+    if runtime_path is None:
+        runtime_path = file_name
+    tree_shake = py_config.tree_shake if executed_functions is not None else 0
+    defer_imports = (
+        slow_modules is not None
+        and module is not None
+        and tree_shake != TREE_SHAKE_FETCH
+    )
+    strip_docstrings = py_config.strip_docstrings and not _path_matches_patterns(
+        file_name, STRIP_DOCSTRING_EXCLUDES
+    )
+    strip_module_docstrings = (
+        py_config.strip_module_docstrings
+        and not _path_matches_patterns(file_name, STRIP_DOCSTRING_MODULE_EXCLUDES)
+    )
+    if cache is not None:
+        key = ContentCache.make_key(
+            AST_REWRITE_VERSION,
+            # ast.unparse output may change between Python versions
+            sys.version,
+            py_config.model_dump_json(),
+            f"{strip_docstrings},{strip_module_docstrings}",
+            code,
+            *(
+                [runtime_path, json.dumps(sorted(executed_functions or []))]
+                if tree_shake
+                else []
+            ),
+            *(
+                [json.dumps(module), json.dumps(sorted(slow_modules or []))]
+                if defer_imports
+                else []
+            ),
+        )
+        if (cached_code := cache.get(key)) is not None:
+            return cached_code.decode()
+
     try:
         tree = ast.parse(code)
-    except SyntaxError:
+    except (SyntaxError, RecursionError):
+        # Code too deeply nested to be parsed can't be compiled by Python either
         return code
     try:
-        if py_config.strip_docstrings and not _path_matches_patterns(
-            file_name, STRIP_DOCSTRING_EXCLUDES
-        ):
+        if defer_imports:
+            assert module is not None and slow_modules is not None
+            tree = _defer_imports(tree, code, *module, slow_modules=slow_modules)
+        if tree_shake:
+            assert executed_functions is not None
+            tree = _StubUnusedFunctionsTransformer(
+                executed_functions, runtime_path, level=tree_shake, code=code
+            ).visit(tree)
+        tree = _optimize(tree, py_config.optimize)
+        if strip_docstrings:
             tree = _strip_module_docstring(tree)
-        if py_config.strip_module_docstrings and not _path_matches_patterns(
-            file_name, STRIP_DOCSTRING_MODULE_EXCLUDES
-        ):
+        if strip_module_docstrings:
             tree = _StripDocstringsTransformer().visit(tree)
-        uncommented_code = ast.unparse(tree)
+        if py_config.minify_names:
+            tree = _minify_local_names(tree)
+        uncommented_code = _unparse(tree)
     except RecursionError:
-        # Some files (e.g. modules in sympy) produce a recursion error when running
-        # the node transformer on them
+        # Deeply nested expressions that can't be unparsed separately (e.g. in
+        # f-strings) still make ast.unparse recurse too deeply
         print(f"Skipping AST rewrite for {file_name} due to RecursionError")
         uncommented_code = code
 
+    if cache is not None:
+        cache.set(key, uncommented_code.encode())
     return uncommented_code
 
 
+def get_ast_rewrite_cache() -> ContentCache:
+    """Get the on-disk cache for AST rewrites"""
+    return ContentCache(get_cache_dir() / "ast-rewrite")
+
+
+# State shared by all files minified in a worker process, so that it is
+# sent only once to each worker
+_worker_state: dict[str, Any] = {}
+
+
+def _init_minify_worker(
+    py_config: PyPackConfig, ast_cache: ContentCache | None
+) -> None:
+    _worker_state.update(py_config=py_config, ast_cache=ast_cache)
+
+
+def _minify_file(path: Path) -> tuple[bytes, float]:
+    """Minify a Python file, returning the output content and the time it took
+
+    Files that are not valid UTF-8 are returned unchanged.
+    """
+    t0 = perf_counter()
+    content = path.read_bytes()
+    try:
+        code = content.decode()
+    except UnicodeDecodeError:
+        return content, perf_counter() - t0
+    out_code = _rewrite_py_code(
+        code,
+        file_name=str(path),
+        py_config=_worker_state["py_config"],
+        cache=_worker_state["ast_cache"],
+    )
+    return out_code.encode(), perf_counter() - t0
+
+
+def _minify_files(
+    paths: list[Path],
+    py_config: PyPackConfig,
+    ast_cache: ContentCache | None = None,
+    jobs: int = 1,
+) -> Generator[tuple[bytes, float], None, None]:
+    """Minify Python files, yielding results in the order of paths
+
+    With jobs > 1, files are minified in a pool of worker processes.
+    """
+    if jobs <= 1:
+        _init_minify_worker(py_config, ast_cache)
+        yield from map(_minify_file, paths)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_minify_worker,
+        initargs=(py_config, ast_cache),
+    ) as executor:
+        # Send files in batches to reduce the inter-process communication overhead
+        chunksize = max(1, min(64, len(paths) // (4 * jobs)))
+        yield from executor.map(_minify_file, paths, chunksize=chunksize)
+
+
+def _file_state(path: Path, previous_state: list | None) -> tuple[list, bool]:
+    """Get the state of an input file and whether it changed since previous_state
+
+    The content is only hashed when the size or modification time changed.
+
+    Returns
+    -------
+    state
+        [modification time in ns, size, sha256 digest of the content]
+    changed
+        True if the content of the file changed
+    """
+    stat = path.stat()
+    if previous_state is not None and previous_state[:2] == [
+        stat.st_mtime_ns,
+        stat.st_size,
+    ]:
+        return previous_state, False
+    digest = file_digest(path)
+    changed = previous_state is None or previous_state[2] != digest
+    return [stat.st_mtime_ns, stat.st_size, digest], changed
+
+
+def _zip_state(path: Path) -> list[int]:
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
 def main(
     input_dir: Path = typer.Argument(..., help="Path to the folder to compress"),
     strip_docstrings: bool = typer.Option(False, help="Strip docstrings"),
     strip_module_docstrings: bool = typer.Option(
         False, help="Strip module level docstrings"
     ),
+    minify_names: bool = typer.Option(
+        False, help="Rename local variables of functions to short names"
+    ),
     # py_compile: bool = typer.Option(False, help="py-compile files")
+    cache: bool = typer.Option(
+        True, help="Re-use results of previous AST rewrites from the on-disk cache"
+    ),
+    jobs: int = typer.Option(
+        1, "--jobs", "-j", help="Number of worker processes used to minify files"
+    ),
+    stream: bool = typer.Option(
+        False,
+        help="Write the output zip file directly, without the intermediate "
+        "output folder",
+    ),
+    incremental: bool = typer.Option(
+        True, help="Only process files that changed since the previous run"
+    ),
 ) -> None:
     """Minify a folder of Python files.
 
@@ -106,41 +1397,125 @@ def main(
     py_config = PyPackConfig(
         strip_docstrings=strip_docstrings,
         strip_module_docstrings=strip_module_docstrings,
+        minify_names=minify_names,
         py_compile=False,
     )
     if py_config.strip_docstrings:
         output_dirname += "_no_docstrings"
     output_dir = input_dir.parent / output_dirname
-    shutil.rmtree(output_dir, ignore_errors=True)
-    shutil.copytree(input_dir, output_dir)
-    t0 = perf_counter()
-    n_processed = 0
-    for file in output_dir.glob("**/*.py"):
-        if not file.is_file():
-            continue
+    zip_path = output_dir.parent / (output_dir.name + ".zip")
 
-        try:
-            code = file.read_text()
-        except UnicodeDecodeError:
-            continue
-        uncommented_code = _rewrite_py_code(
-            code, file_name=str(file), py_config=py_config
+    # The state of input files in the previous run with the same output. It's
+    # only used if the output zip file wasn't modified since then.
+    manifest_cache = JSONCache(get_cache_dir() / "minify-manifests.json")
+    manifest_key = ContentCache.make_key(
+        AST_REWRITE_VERSION,
+        sys.version,
+        py_config.model_dump_json(),
+        str(input_dir.resolve()),
+        str(zip_path.resolve()),
+        str(stream),
+    )
+    previous_manifest: dict[str, list] = {}
+    previous_run = manifest_cache.get(manifest_key) if incremental else None
+    if (
+        previous_run is not None
+        and zip_path.exists()
+        and (stream or output_dir.exists())
+        and previous_run["zip"] == _zip_state(zip_path)
+    ):
+        previous_manifest = previous_run["files"]
+    if not stream and not previous_manifest:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    names = sorted(
+        path.relative_to(input_dir).as_posix()
+        for path in input_dir.glob("**/*")
+        if path.is_file()
+    )
+    manifest: dict[str, list] = {}
+    changed_names: set[str] = set()
+    for name in names:
+        manifest[name], changed = _file_state(
+            input_dir / name, previous_manifest.get(name)
         )
+        if changed:
+            changed_names.add(name)
 
-        if uncommented_code is None:
-            continue
+    py_names = [
+        name for name in names if name in changed_names and name.endswith(".py")
+    ]
+    ast_cache = get_ast_rewrite_cache() if cache else None
+    t0 = perf_counter()
+    results = _minify_files(
+        [input_dir / name for name in py_names], py_config, ast_cache, jobs=jobs
+    )
+    durations: dict[str, float] = {}
+    size_in = 0
 
-        file.write_text(uncommented_code)
-        n_processed += 1
+    if stream:
+        tmp_zip_path = zip_path.with_name(zip_path.name + ".tmp")
+        previous_archive = None
+        if previous_manifest:
+            previous_archive = ArchiveFile(zip_path, name=None)
+        with zipfile.ZipFile(tmp_zip_path, "w", compression=0) as fh:
+            for name in names:
+                if name not in changed_names:
+                    # Copy the output of the previous run
+                    assert previous_archive is not None
+                    if raw := previous_archive.read_raw(name):
+                        write_raw(fh, name, *raw)
+                        continue
+                    content = previous_archive.read(name)
+                    assert content is not None
+                elif name.endswith(".py"):
+                    content, durations[name] = next(results)
+                    size_in += manifest[name][1]
+                else:
+                    content = (input_dir / name).read_bytes()
+                fh.writestr(zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME), content)
+        if previous_archive is not None:
+            previous_archive.close()
+        tmp_zip_path.replace(zip_path)
+    else:
+        for name in set(previous_manifest) - set(manifest):
+            (output_dir / name).unlink(missing_ok=True)
+        for name in names:
+            if name not in changed_names:
+                continue
+            out_path = output_dir / name
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            if name.endswith(".py"):
+                content, durations[name] = next(results)
+                size_in += manifest[name][1]
+                out_path.write_bytes(content)
+            else:
+                shutil.copy2(input_dir / name, out_path)
+    # Shut down the worker processes
+    results.close()
 
-    typer.echo(f"Processed {n_processed} files in {perf_counter() - t0:.2f} seconds")
+    duration = perf_counter() - t0
+    typer.echo(
+        f"Processed {len(durations)} files in {duration:.2f} seconds "
+        f"({len(durations) / max(duration, 1e-9):.0f} files/s, "
+        f"{size_in / 1e6 / max(duration, 1e-9):.2f} MB/s), "
+        f"{len(names) - len(changed_names)} unchanged files skipped"
+    )
+    if durations:
+        typer.echo("Slowest files:")
+        for name in sorted(durations, key=lambda name: -durations[name])[:5]:
+            typer.echo(
+                f"  {name}: {durations[name] * 1e3:.1f} ms "
+                f"({manifest[name][1] / 1e3 / max(durations[name], 1e-9):.0f} kB/s)"
+            )
+    if ast_cache is not None:
+        ast_cache.prune()
 
-    zip_path = output_dir.parent / (output_dir.name + ".zip")
-    with zipfile.ZipFile(zip_path, "w", compression=0) as fh:
-        for file in output_dir.glob("**/*"):
-            if not file.is_file():
-                continue
-            fh.write(file, file.relative_to(output_dir))
+    if not stream:
+        with zipfile.ZipFile(zip_path, "w", compression=0) as fh:
+            for name in names:
+                fh.write(output_dir / name, name)
+    manifest_cache.set(manifest_key, {"files": manifest, "zip": _zip_state(zip_path)})
     typer.echo(f"Created zip file at {zip_path}")
 
 
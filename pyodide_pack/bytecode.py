@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import importlib.util
+import marshal
+import posixpath
+import sys
+
+# Name of the file with the bytecode of all modules, in the package bundle
+BYTECODE_BUNDLE_NAME = "bundle-bytecode.marshal"
+
+# Flags in the header of hash-based .pyc files that are not checked against
+# the source (PEP 552). File timestamps are not preserved when extracting
+# the bundle, so timestamp-based .pyc files would be considered stale.
+_PYC_UNCHECKED_HASH = 0b01
+
+
+def check_python_version(target_version: tuple[int, int] | None) -> None:
+    """Check that bytecode compiled with this interpreter can run on the target
+
+    Raises a ValueError otherwise, as the bytecode format changes between
+    Python versions.
+    """
+    host_version = sys.version_info[:2]
+    if target_version != host_version:
+        target = (
+            "unknown" if target_version is None else "{}.{}".format(*target_version)
+        )
+        raise ValueError(
+            f"Compiling Python files to bytecode for Python {target} requires to run "
+            f"pyodide pack with the same Python version (currently "
+            f"{'{}.{}'.format(*host_version)})"
+        )
+
+
+def compile_source(source: bytes, runtime_path: str) -> bytes:
+    """Compile Python source code to the marshalled code object
+
+    Parameters
+    ----------
+    source
+        Python source code
+    runtime_path
+        path of the file in Pyodide, used in tracebacks
+    """
+    code = compile(source, runtime_path, "exec", dont_inherit=True)
+    return marshal.dumps(code)
+
+
+def compile_to_pyc(source: bytes, runtime_path: str) -> bytes:
+    """Compile Python source code to the content of an unchecked hash-based .pyc
+
+    Examples
+    --------
+    >>> pyc = compile_to_pyc(b"a = 1", "/lib/a.py")
+    >>> pyc[:4] == importlib.util.MAGIC_NUMBER
+    True
+    >>> namespace = {}
+    >>> exec(marshal.loads(pyc[16:]), namespace)
+    >>> namespace["a"]
+    1
+    """
+    return (
+        importlib.util.MAGIC_NUMBER
+        + _PYC_UNCHECKED_HASH.to_bytes(4, "little")
+        + importlib.util.source_hash(source)
+        + compile_source(source, runtime_path)
+    )
+
+
+def get_pyc_path(path: str, keep_source: bool, zipimport: bool = False) -> str:
+    """Get the path of the .pyc file for a .py file
+
+    Sourceless .pyc files must be next to where the .py file would be. When the
+    source is kept, .pyc files go in __pycache__, except for zip imports which
+    only look for them next to the .py file.
+
+    Examples
+    --------
+    >>> get_pyc_path("a/b.py", keep_source=False)
+    'a/b.pyc'
+    >>> get_pyc_path("a/b.py", keep_source=True)
+    'a/__pycache__/b.cpython-3...pyc'
+    >>> get_pyc_path("a/b.py", keep_source=True, zipimport=True)
+    'a/b.pyc'
+    """
+    if not keep_source or zipimport:
+        return path + "c"
+    dirname, basename = posixpath.split(path)
+    basename = basename.removesuffix(".py")
+    return posixpath.join(
+        dirname, "__pycache__", f"{basename}.{sys.implementation.cache_tag}.pyc"
+    )
+
+
+def get_module_name(runtime_path: str) -> tuple[str, bool] | None:
+    """Get the module name of an installed .py file and whether it's a package
+
+    Returns None for files outside of site-packages.
+
+    Examples
+    --------
+    >>> get_module_name("/lib/python3.11/site-packages/a/b.py")
+    ('a.b', False)
+    >>> get_module_name("/lib/python3.11/site-packages/a/__init__.py")
+    ('a', True)
+    >>> get_module_name("/lib/python3.11/site-utils/a/b.py")
+    """
+    _, sep, relative_path = runtime_path.partition("/site-packages/")
+    if not sep or not relative_path.endswith(".py"):
+        return None
+    parts = relative_path.removesuffix(".py").split("/")
+    is_package = parts[-1] == "__init__"
+    if is_package:
+        parts.pop()
+    if not parts or not all(part.isidentifier() for part in parts):
+        return None
+    return ".".join(parts), is_package
+
+
+def dump_bytecode_bundle(modules: dict[str, tuple[bool, str, bytes]]) -> bytes:
+    """Serialize the bytecode of several modules into a single file
+
+    Parameters
+    ----------
+    modules
+        mapping of module names to (is_package, runtime path, marshalled code).
+        The code of each module stays marshalled, so that it's only loaded
+        when the module is imported.
+    """
+    return marshal.dumps({name: modules[name] for name in sorted(modules)})
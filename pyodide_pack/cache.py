@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any
+
+
+def get_cache_dir() -> Path:
+    """Get the directory used to persist pyodide-pack caches between runs.
+
+    The location can be overridden with the ``PYODIDE_PACK_CACHE_DIR``
+    environment variable, otherwise it follows ``XDG_CACHE_HOME``.
+    """
+    if cache_dir := os.environ.get("PYODIDE_PACK_CACHE_DIR"):
+        return Path(cache_dir)
+    if xdg_cache_home := os.environ.get("XDG_CACHE_HOME"):
+        return Path(xdg_cache_home) / "pyodide-pack"
+    return Path.home() / ".cache" / "pyodide-pack"
+
+
+def file_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    """Compute the sha256 hex digest of a file without loading it in memory."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _atomic_write_bytes(path: Path, content: bytes) -> None:
+    """Write a file atomically, so concurrent readers never see partial content."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(content)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+class JSONCache:
+    """A small key/value cache persisted as a single JSON file.
+
+    Failures to read or write the cache are never fatal, the cache then
+    behaves as if it was empty.
+
+    Examples
+    --------
+    >>> cache = JSONCache(Path(getfixture("tmp_path")) / "cache.json")
+    >>> cache.get("a") is None
+    True
+    >>> cache.set("a", 1)
+    >>> JSONCache(cache.path).get("a")
+    1
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._data: dict[str, Any] | None = None
+
+    def _load(self) -> dict[str, Any]:
+        if self._data is None:
+            try:
+                self._data = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                self._data = {}
+        return self._data
+
+    def get(self, key: str) -> Any:
+        return self._load().get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        data = self._load()
+        data[key] = value
+        try:
+            _atomic_write_bytes(self.path, json.dumps(data).encode())
+        except OSError:
+            pass
+
+
+class ContentCache:
+    """An on-disk content-addressed cache, with a size bounded LRU eviction
+
+    Each entry is stored in a separate file named after its key. Reading an
+    entry updates its modification time, and :meth:`prune` removes the least
+    recently used entries once the total size exceeds ``max_size``.
+
+    Examples
+    --------
+    >>> cache = ContentCache(Path(getfixture("tmp_path")), max_size=10)
+    >>> key = ContentCache.make_key("version", b"content")
+    >>> cache.get(key) is None
+    True
+    >>> cache.set(key, b"output")
+    >>> cache.get(key)
+    b'output'
+    >>> cache.set(ContentCache.make_key("other"), b"other output")
+    >>> cache.prune()
+    >>> cache.get(key) is None
+    True
+    """
+
+    def __init__(self, path: Path, max_size: int = 512_000_000):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(*parts: str | bytes) -> str:
+        """Hash several parts into a single cache key"""
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            # Prefix by the length so that parts boundaries are unambiguous
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path / key[:2] / key
+
+    def get(self, key: str) -> bytes | None:
+        path = self._entry_path(key)
+        try:
+            content = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            return None
+        return content
+
+    def set(self, key: str, value: bytes) -> None:
+        try:
+            _atomic_write_bytes(self._entry_path(key), value)
+        except OSError:
+            pass
+
+    def prune(self) -> None:
+        """Remove least recently used entries until the cache fits in max_size"""
+        entries = []
+        for path in self.path.glob("*/*"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total_size = sum(el[1] for el in entries)
+        for _, size, path in sorted(entries, key=lambda x: (x[0], x[2])):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import ast
+import posixpath
+from collections.abc import Collection
+
+from pyodide_pack.bytecode import get_module_name
+
+# Name of the file listing the files of each lazy chunk, in the core chunk
+CHUNK_LIST_NAME = "bundle-chunks.txt"
+# File name of a lazy chunk, from the name of its top-level package
+LAZY_CHUNK_NAME = "pyodide-package-bundle-lazy-{}.zip"
+
+
+def split_startup_code(code: str) -> tuple[str, str]:
+    """Split the code of an application in its leading imports and the rest
+
+    The imports at the top of the application are its startup phase. The rest
+    of the code keeps the __future__ imports, which only apply to the code they
+    are run with.
+
+    Examples
+    --------
+    >>> split_startup_code("import a\\nfrom b import c\\n\\nc(a)\\n")
+    ('import a\\nfrom b import c\\n', '\\nc(a)\\n')
+    >>> split_startup_code("x = 1")
+    ('', 'x = 1')
+    """
+    try:
+        body = ast.parse(code).body
+    except SyntaxError:
+        return "", code
+    if (
+        body
+        and isinstance(body[0], ast.Expr)
+        and isinstance(body[0].value, ast.Constant)
+    ):
+        # Module docstring
+        body = body[1:]
+    startup_end = 0
+    future_imports = []
+    for node in body:
+        if not isinstance(node, (ast.Import, ast.ImportFrom)):
+            break
+        startup_end = node.end_lineno or node.lineno
+        if isinstance(node, ast.ImportFrom) and node.module == "__future__":
+            future_imports.append(ast.get_source_segment(code, node) or "")
+    lines = code.splitlines(keepends=True)
+    startup = "".join(lines[:startup_end])
+    rest = "".join(f"{line}\n" for line in future_imports) + "".join(
+        lines[startup_end:]
+    )
+    return startup, rest
+
+
+def get_source_path(name: str) -> str | None:
+    """Get the path of the Python source of a bundle member, or None
+
+    Examples
+    --------
+    >>> get_source_path("a/b.py")
+    'a/b.py'
+    >>> get_source_path("a/b.pyc")
+    'a/b.py'
+    >>> get_source_path("a/__pycache__/b.cpython-311.pyc")
+    'a/b.py'
+    >>> get_source_path("a/b.txt")
+    """
+    if name.endswith(".py"):
+        return name
+    if not name.endswith(".pyc"):
+        return None
+    dirname, basename = posixpath.split(name)
+    if posixpath.basename(dirname) == "__pycache__":
+        return posixpath.join(
+            posixpath.dirname(dirname), basename.split(".")[0] + ".py"
+        )
+    return name[:-1]
+
+
+def get_lazy_chunks(
+    names: list[str], startup_modules: Collection[str]
+) -> dict[str, tuple[str, str | None]]:
+    """Assign the Python files of modules not imported at startup to lazy chunks
+
+    Modules are grouped in one chunk per top-level package. Other files
+    (dynamic libraries, data files) stay in the core chunk.
+
+    Returns
+    -------
+    chunks
+        mapping of bundle member names to (chunk file name, module name). The
+        module name is None for files that are not imported directly (e.g. a
+        .pyc file in __pycache__, which is used when importing the .py file).
+
+    Examples
+    --------
+    >>> get_lazy_chunks([
+    ...     "lib/python3.11/site-packages/a/__init__.py",
+    ...     "lib/python3.11/site-packages/a/b.py",
+    ...     "lib/python3.11/site-packages/a/__pycache__/b.cpython-311.pyc",
+    ...     "lib/python3.11/site-packages/a/data.txt",
+    ... ], startup_modules={"a"})
+    {'lib/python3.11/site-packages/a/b.py': ('pyodide-package-bundle-lazy-a.zip', 'a.b'),
+     'lib/python3.11/site-packages/a/__pycache__/b.cpython-311.pyc': ('pyodide-package-bundle-lazy-a.zip', None)}
+    """
+    startup_modules = set(startup_modules)
+    chunks: dict[str, tuple[str, str | None]] = {}
+    for name in names:
+        source_path = get_source_path(name)
+        if source_path is None:
+            continue
+        module = get_module_name("/" + source_path)
+        if module is None or module[0] in startup_modules:
+            continue
+        module_name = module[0]
+        chunk = LAZY_CHUNK_NAME.format(module_name.split(".")[0])
+        is_imported = "__pycache__" not in name
+        chunks[name] = (chunk, module_name if is_imported else None)
+    return chunks
+
+
+def dump_chunk_list(chunks: dict[str, tuple[str, str | None]]) -> str:
+    """Serialize lazy chunks as lines of "chunk,path,module"
+
+    Examples
+    --------
+    >>> print(dump_chunk_list({"a/b.py": ("lazy-a.zip", "a.b")}), end="")
+    lazy-a.zip,/a/b.py,a.b
+    """
+    return "".join(
+        f"{chunk},/{name},{module or ''}\n" for name, (chunk, module) in chunks.items()
+    )
@@ -1,9 +1,15 @@
 import json
+import os
 import shutil
+import subprocess
 import sys
+import tempfile
 import zipfile
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import perf_counter
+from typing import Any, get_args
 
 import typer
 from pydantic import parse_obj_as
@@ -17,11 +23,226 @@ from pyodide_pack._utils import (
     spawn_web_server,
 )
 from pyodide_pack.archive import ArchiveFile
-from pyodide_pack.config import PackConfig, _find_pyproject_toml, _get_config_section
+from pyodide_pack.ast_rewrite import TREE_SHAKE_FETCH, get_ast_rewrite_cache
+from pyodide_pack.bytecode import (
+    BYTECODE_BUNDLE_NAME,
+    check_python_version,
+    dump_bytecode_bundle,
+)
+from pyodide_pack.cache import ContentCache, JSONCache, get_cache_dir
+from pyodide_pack.chunks import (
+    CHUNK_LIST_NAME,
+    LAZY_CHUNK_NAME,
+    dump_chunk_list,
+    get_lazy_chunks,
+    split_startup_code,
+)
+from pyodide_pack.compression import (
+    CONTENT_ENCODINGS,
+    Encoding,
+    check_encodings,
+    get_precompressed_path,
+    write_precompressed,
+)
+from pyodide_pack.config import (
+    PackConfig,
+    ValidationMode,
+    _find_pyproject_toml,
+    _get_config_section,
+)
+from pyodide_pack.packing import (
+    DUPLICATES_NAME,
+    PackResult,
+    PackTask,
+    dump_duplicates,
+    find_duplicates,
+    get_access_order,
+    get_member_names,
+    merge_results,
+    run_pack_tasks,
+    split_in_shards,
+    sum_stats,
+    writestr,
+)
 from pyodide_pack.runners.node import NodeRunner
-from pyodide_pack.runtime_detection import PackageBundler, RuntimeResults
+from pyodide_pack.runtime_detection import RuntimeResults, merge_raw_results
+from pyodide_pack.size_estimation import estimate_compressed_size
 
 ROOT_DIR = Path(__file__).parents[1]
+ORIGINALS_DIR_NAME = "pyodide-package-bundle-originals"
+# Package bundle merged with the stripped stdlib, with config.merge_stdlib
+MERGED_BUNDLE_NAME = "pyodide-package-bundle-stdlib.zip"
+# Python settings compared between runs in the validation step
+BENCHMARK_SETTINGS = {
+    "py_compile",
+    "py_compile_keep_source",
+    "py_compile_bundle",
+    "defer_imports",
+    "defer_imports_min_time",
+}
+
+
+def _format_sizes(
+    sizes: dict[Encoding, int], initial_sizes: dict[Encoding, int] | None = None
+) -> str:
+    """Format compressed sizes, naming encodings if there are several
+
+    With initial_sizes, the reduction for each encoding is included.
+
+    Examples
+    --------
+    >>> _format_sizes({"gzip": 1_200_000})
+    '1.20 MB'
+    >>> _format_sizes({"gzip": 1_200_000, "brotli": 1_000_000})
+    '1.20 MB (gzip), 1.00 MB (brotli)'
+    >>> _format_sizes({"gzip": 900_000}, initial_sizes={"gzip": 1_000_000})
+    '0.90 MB (10.0% reduction)'
+    """
+    formatted = []
+    for encoding, size in sizes.items():
+        details: list[str] = [encoding] if len(sizes) > 1 else []
+        if initial_sizes and initial_sizes.get(encoding):
+            details.append(f"{100*(1 - size/initial_sizes[encoding]):.1f}% reduction")
+        formatted.append(f"{size / 1e6:.2f} MB")
+        if details:
+            formatted[-1] += f" ({', '.join(details)})"
+    return ", ".join(formatted)
+
+
+def _size_columns(size_in: int, size_out: int) -> list[str]:
+    """Size and reduction columns of the packing table, for one encoding"""
+    return [
+        f"{size_in / 1e6:.2f} [red]→[/red] {size_out / 1e6:.2f}",
+        f"{100 * (1 - size_out / size_in):.1f} %",
+    ]
+
+
+def _estimated_sizes(
+    paths: list[Path], encodings: list[Encoding]
+) -> dict[Encoding, int]:
+    """Estimated compressed sizes of output zip files, for each encoding
+
+    As for the input packages, this is the total size of their files compressed
+    one by one, so that reductions compare sizes estimated the same way.
+    """
+    sizes = dict.fromkeys(encodings, 0)
+    for path in paths:
+        with ArchiveFile(path, name=None) as archive:
+            for encoding in encodings:
+                sizes[encoding] += estimate_compressed_size(
+                    archive, encoding, use_cache=False
+                )
+    return sizes
+
+
+def _precompressed_msg(paths: list[Path], encodings: list[Encoding]) -> str:
+    """Describe the sizes of the precompressed versions of output files, if any"""
+    if not encodings:
+        return ""
+    sizes: dict[Encoding, int] = {
+        encoding: sum(
+            get_precompressed_path(path, encoding).stat().st_size for path in paths
+        )
+        for encoding in encodings
+    }
+    return f", precompressed: {_format_sizes(sizes)}"
+
+
+def _get_validation_modes(config: PackConfig) -> list[str]:
+    """Ways to load the bundle in the validation step
+
+    The bundle is always validated extracted to MEMFS, which is the mode that
+    is benchmarked. Each other mode runs the application again, so they are
+    only used when listed in config.validation_modes.
+
+    Examples
+    --------
+    >>> _get_validation_modes(PackConfig())
+    ['extract']
+    >>> _get_validation_modes(PackConfig(validation_modes=["stream", "zip_import"]))
+    ['extract', 'stream', 'zip_import']
+    """
+    modes = ["extract"]
+    for mode in config.validation_modes:
+        if mode not in get_args(ValidationMode):
+            raise ValueError(
+                f"Unknown validation mode {mode!r}, expected one of "
+                f"{', '.join(get_args(ValidationMode))}"
+            )
+        if mode == "lazy_chunks" and not config.code_splitting:
+            raise ValueError("The lazy_chunks validation mode needs code_splitting")
+        if mode == "merged_stdlib" and not config.merge_stdlib:
+            raise ValueError("The merged_stdlib validation mode needs merge_stdlib")
+        if mode not in modes:
+            modes.append(mode)
+    return modes
+
+
+def _discovery_cache_key(
+    codes: list[str],
+    requires: list[str],
+    package_dir: Path,
+    js_template_path: Path,
+    trace_functions: bool = False,
+    startup_code: str = "",
+    time_imports: bool = False,
+    code_splitting: bool = False,
+) -> str:
+    """Cache key for discovery results
+
+    Results are re-used as long as the code of all scenarios, the requirements,
+    the Pyodide distribution and the discovery script (and its options) are
+    unchanged.
+    """
+    try:
+        pyodide_version = json.loads((package_dir / "package.json").read_text())[
+            "version"
+        ]
+    except (OSError, ValueError, KeyError):
+        pyodide_version = "unknown"
+    lockfile_path = package_dir / "pyodide-lock.json"
+    lockfile = lockfile_path.read_bytes() if lockfile_path.exists() else b""
+    return ContentCache.make_key(
+        js_template_path.read_bytes(),
+        json.dumps(codes),
+        json.dumps(requires),
+        pyodide_version,
+        lockfile,
+        str(trace_functions),
+        startup_code,
+        str(time_imports),
+        str(code_splitting),
+    )
+
+
+def _run_discovery(
+    js_template_path: Path,
+    code: str,
+    requires: list[str],
+    trace_functions: bool,
+    startup_code: str = "",
+    time_imports: bool = False,
+    code_splitting: bool = False,
+) -> dict[str, Any]:
+    """Run code in Node.js and return the raw results of the discovery script
+
+    With trace_functions, the results also include the executed functions, and
+    with time_imports, the time to import each module. startup_code is run
+    before code, and with code_splitting, the results include the modules
+    imported once it's done.
+    """
+    js_template_kwargs = dict(
+        code=code,
+        startup_code=startup_code,
+        packages=requires,
+        output_path="results.json",
+        trace_functions=trace_functions,
+        time_imports=time_imports,
+        code_splitting=code_splitting,
+    )
+    with NodeRunner(js_template_path, ROOT_DIR, **js_template_kwargs) as runner:
+        runner.run()
+        return json.loads((runner.tmp_path / "results.json").read_text())
 
 
 def main(
@@ -41,8 +262,28 @@ def main(
     ),
     write_debug_map: bool = typer.Option(
         False,
-        help="Write a debug map (to './debug-map.json') with all"
-        "the detected imports for the generated bundle",
+        help="Write a debug map (to './debug-map.json') with all "
+        "the detected imports for the generated bundle, in the compact format "
+        "loaded with RuntimeResults.from_json",
+    ),
+    cache: bool = typer.Option(
+        True,
+        help="Re-use results of previous runs (discovery, AST rewrites) "
+        "from the on-disk cache",
+    ),
+    rediscover: bool = typer.Option(
+        False,
+        "--rediscover",
+        help="Run the input code to detect used files, even if cached results exist",
+    ),
+    jobs: int = typer.Option(
+        1, "--jobs", "-j", help="Number of worker processes used for packing"
+    ),
+    validation_modes: str = typer.Option(
+        None,
+        "--validate",
+        help="One or multiple additional ways to load the bundle when validating it, "
+        'separated by ",", among zip_import, stream, lazy_chunks and merged_stdlib',
     ),
 ):  # type: ignore
     """Create a minimal bundle for a Pyodide application with the required dependencies
@@ -88,30 +329,105 @@ def main(
                 console.print(f"Loaded config from {config_path}")
     if include_paths is not None:
         config.include_paths = include_paths.split(",")
+    if validation_modes is not None:
+        config.validation_modes = validation_modes.split(",")  # type: ignore[assignment]
+    try:
+        check_encodings(config.encodings)
+        modes = _get_validation_modes(config)
+    except (ImportError, ValueError) as exc:
+        console.print(str(exc))
+        sys.exit(1)
 
     console.print(
         "\n[bold]Note:[/bold] unless otherwise specified all sizes are given "
-        "for gzip compressed files to be representative of CDN compression.\n"
+        f"for {', '.join(config.encodings)} compressed files to be representative "
+        "of CDN compression.\n"
     )
     code = example_path.read_text()
 
+    # With code splitting, the leading imports of the application are run first,
+    # to find the modules needed at startup
+    startup_code = ""
+    scenario_codes = [code]
+    if config.code_splitting:
+        startup_code, scenario_codes[0] = split_startup_code(code)
+    if config.scenarios:
+        assert config_path is not None
+        scenario_codes += [
+            (config_path.parent / path).read_text() for path in config.scenarios
+        ]
+
+    package_dir = ROOT_DIR / "node_modules" / "pyodide"
     js_template_path = ROOT_DIR / "pyodide_pack" / "js" / "discovery.js"
-    js_template_kwargs = dict(
-        code=code, packages=config.requires, output_path="results.json"
+    discovery_cache = ContentCache(get_cache_dir() / "discovery") if cache else None
+    # Executed functions are only needed for tree shaking
+    trace_functions = config.py.tree_shake > 0
+    # Import times are only needed to defer imports of slow modules
+    time_imports = bool(config.py.defer_imports)
+    discovery_key = _discovery_cache_key(
+        scenario_codes,
+        config.requires,
+        package_dir,
+        js_template_path,
+        trace_functions=trace_functions,
+        startup_code=startup_code,
+        time_imports=time_imports,
+        code_splitting=config.code_splitting,
     )
-    with NodeRunner(js_template_path, ROOT_DIR, **js_template_kwargs) as runner:
+    db = None
+    if discovery_cache is not None and not rediscover:
+        if (cached_results := discovery_cache.get(discovery_key)) is not None:
+            try:
+                db = RuntimeResults.from_bytes(cached_results)
+            except ValueError:
+                # Cached by a different version of pyodide-pack or Python
+                pass
+
+    if db is not None:
+        console.print(
+            "Re-using discovery results from a previous run with the same code, "
+            "requirements and Pyodide version (use --rediscover to run it again)\n"
+        )
+    else:
         t0 = perf_counter()
-        runner.run()
+        max_workers = min(len(scenario_codes), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            raw_results = list(
+                executor.map(
+                    lambda idx_code: _run_discovery(
+                        js_template_path,
+                        idx_code[1],
+                        config.requires,
+                        trace_functions=trace_functions,
+                        startup_code=startup_code if idx_code[0] == 0 else "",
+                        time_imports=time_imports,
+                        code_splitting=config.code_splitting,
+                    ),
+                    enumerate(scenario_codes),
+                )
+            )
+        scenarios_msg = (
+            f" ({len(scenario_codes)} scenarios)" if len(scenario_codes) > 1 else ""
+        )
         console.print(
-            f"\nDone input code execution in [bold]{perf_counter() - t0:.1f} s[/bold]\n"
+            f"\nDone input code execution{scenarios_msg} in "
+            f"[bold]{perf_counter() - t0:.1f} s[/bold]\n"
         )
 
-        db = RuntimeResults.from_json(runner.tmp_path / "results.json")
+        db = RuntimeResults.from_json_string(json.dumps(merge_raw_results(raw_results)))
+        if discovery_cache is not None:
+            discovery_cache.set(discovery_key, db.to_bytes())
+            discovery_cache.prune()
 
     if write_debug_map:
-        db.to_json(Path("./debug-map.json"))
+        db.to_json(Path("./debug-map.json"), compact=True)
 
-    package_dir = ROOT_DIR / "node_modules" / "pyodide"
+    if config.py.py_compile:
+        try:
+            check_python_version(db.python_version)
+        except ValueError as exc:
+            console.print(str(exc))
+            sys.exit(1)
 
     if "pyodide_lock" in db:
         pyodide_lock = PyodideLockSpec(**json.loads(db["pyodide_lock"]))
@@ -126,128 +442,338 @@ def main(
     stdlib_stripped_path = Path("python_stdlib_stripped.zip")
 
     packages_size = sum(el.total_size(compressed=False) for el in packages.values())
-    packages_size_gzip = sum(el.total_size(compressed=True) for el in packages.values())
+    # Compressed sizes, for each encoding
+    packages_sizes = {
+        encoding: sum(
+            el.total_size(compressed=True, encoding=encoding)
+            for el in packages.values()
+        )
+        for encoding in config.encodings
+    }
     console.print(
         f"Detected [bold]{len(packages)}[/bold] dependencies with a "
-        f"total size of {packages_size_gzip/1e6:.2f} MB  "
+        f"total size of {_format_sizes(packages_sizes)}  "
         f"(uncompressed: {packages_size/1e6:.2f} MB)"
     )
-    total_initial_size = packages_size_gzip + stdlib_archive.total_size(compressed=True)
+    total_initial_sizes = {
+        encoding: size + stdlib_archive.total_size(compressed=True, encoding=encoding)
+        for encoding, size in packages_sizes.items()
+    }
     console.print(
-        f"Total initial size (stdlib + dependencies): {total_initial_size/1e6:.2f} MB"
+        "Total initial size (stdlib + dependencies): "
+        f"{_format_sizes(total_initial_sizes)}"
     )
     console.print("\n")
 
     out_bundle_path = Path("./pyodide-package-bundle.zip")
+    # Precompressed files compress the whole zip files, which gains little over
+    # deflated members, so members are then stored
+    bundle_compression = (
+        zipfile.ZIP_STORED if config.precompress else zipfile.ZIP_DEFLATED
+    )
 
     table = Table(title="Packing..")
     table.add_column("No", justify="right")
     table.add_column("Package", max_width=30)
     table.add_column("All files", justify="right")
     table.add_column(".so libs", justify="right")
-    table.add_column("Size (MB)", justify="right")
-    table.add_column("Reduction", justify="right")
-
-    dynamic_libs = []
-    with Live(table) as live:
-        with zipfile.ZipFile(
-            stdlib_stripped_path, "w", compression=zipfile.ZIP_DEFLATED
-        ) as fh_out:
-            imported_paths = db.get_imported_paths(strip_prefix=db.stdlib_prefix)
-            in_file_names = sorted(stdlib_archive.namelist())
-            bundler = PackageBundler(db, config=config)
-            for in_file_name in in_file_names:
-                if in_file_name not in imported_paths:
-                    continue
-                in_stream = stdlib_archive.read(in_file_name)
-                if in_stream is None:
-                    continue
-                out_stream = bundler.process_content(in_file_name, in_stream)
-                if out_stream is None:
-                    continue
-                # File paths starting with / fails to get correctly extracted
-                # in extract_archive in Pyodide
-                with fh_out.open(in_file_name.lstrip("/"), "w") as fh:
-                    fh.write(out_stream)
-        stdlib_archive_stripped = ArchiveFile(stdlib_stripped_path, name="stdlib")
-
-        msg_0 = "0"
-        msg_1 = "stdlib"
-        msg_2 = f"{len(stdlib_archive.namelist())} [red]→[/red] {len(stdlib_archive_stripped.namelist())}"
-        msg_3 = ""
-        msg_4 = (
-            f"{stdlib_archive.total_size(compressed=True) / 1e6:.2f} [red]→[/red] "
-            f"{stdlib_archive_stripped.total_size(compressed=True)/1e6:.2f}"
-        )
-        msg_5 = f"{100*(1 - stdlib_archive_stripped.total_size(compressed=True) / stdlib_archive.total_size(compressed=True)):.1f} %"
-        table.add_row(msg_0, msg_1, msg_2, msg_3, msg_4, msg_5)
-        live.refresh()
-        with zipfile.ZipFile(
-            out_bundle_path, "w", compression=zipfile.ZIP_DEFLATED
-        ) as fh_out:
-            for idx, ar in enumerate(sorted(packages.values(), key=lambda x: x.name)):
-                # Sort keys for reproducibility
+    for encoding in config.encodings:
+        name = f" {encoding}" if len(config.encodings) > 1 else ""
+        table.add_column(f"Size{name} (MB)", justify="right")
+        table.add_column(f"Reduction{name}", justify="right")
+
+    ast_cache = get_ast_rewrite_cache() if cache else None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tasks = []
+
+        # Original sources of files with functions removed by tree shaking, which
+        # are fetched by the stubs of these functions if they are called
+        originals_dir = None
+        if config.py.tree_shake == TREE_SHAKE_FETCH:
+            shutil.rmtree(ORIGINALS_DIR_NAME, ignore_errors=True)
+            originals_dir = Path(ORIGINALS_DIR_NAME).resolve()
+
+        stdlib_file_names = [
+            name
+            for name in sorted(stdlib_archive.namelist())
+            if name in db.stdlib_paths
+        ]
+        # Sort keys for reproducibility
+        archives = [stdlib_archive] + sorted(packages.values(), key=lambda x: x.name)
+        for archive_idx, ar in enumerate(archives):
+            if archive_idx == 0:
+                in_file_names = stdlib_file_names
+            else:
                 in_file_names = sorted(ar.namelist())
+            for shard_idx, shard in enumerate(split_in_shards(ar, in_file_names)):
+                tasks.append(
+                    PackTask(
+                        archive_idx=archive_idx,
+                        shard_idx=shard_idx,
+                        archive_path=ar.file_path,
+                        in_file_names=shard,
+                        out_path=Path(tmp_dir) / f"{archive_idx}-{shard_idx}.zip",
+                        stdlib=archive_idx == 0,
+                        originals_dir=originals_dir,
+                    )
+                )
+        n_shards = Counter(task.archive_idx for task in tasks)
+
+        results: dict[int, list[PackResult]] = defaultdict(list)
+        with Live(table) as live:
+            for result in run_pack_tasks(tasks, db, config, ast_cache, jobs=jobs):
+                archive_idx = result.task.archive_idx
+                results[archive_idx].append(result)
+                if len(results[archive_idx]) < n_shards[archive_idx]:
+                    continue
 
-                bundler = PackageBundler(db, config=config)
-                for in_file_name in in_file_names:
-                    out_file_name = bundler.process_path(in_file_name)
-                    if out_file_name is None:
-                        continue
-                    in_stream = ar.read(in_file_name)
-                    if in_stream is None:
-                        continue
-                    out_stream = bundler.process_content(in_file_name, in_stream)
-                    if out_stream is None:
-                        continue
-                    # File paths starting with / fails to get correctly extracted
-                    # in extract_archive in Pyodide
-                    with fh_out.open(out_file_name.lstrip("/"), "w") as fh:
-                        fh.write(out_stream)
-
-                dynamic_libs.extend(bundler.dynamic_libs)
-
-                stats = bundler.stats
-
-                msg_0 = f"{idx+1}"
-                msg_1 = ar.file_path.name
-                msg_2 = f"{len(in_file_names)} [red]→[/red] {stats['fh_out']}"
-                msg_3 = f"{stats['so_in']} [red]→[/red] {stats['so_out']}"
-                msg_4 = f"{ar.total_size(compressed=True) / 1e6:.2f} [red]→[/red] {stats['size_gzip_out']/1e6:.2f}"
-                msg_5 = f"{100*(1 - stats['size_gzip_out'] / ar.total_size(compressed=True)):.1f} %"
-                table.add_row(msg_0, msg_1, msg_2, msg_3, msg_4, msg_5)
+                if archive_idx == 0:
+                    with zipfile.ZipFile(
+                        stdlib_stripped_path, "w", compression=bundle_compression
+                    ) as fh_out:
+                        merge_results(fh_out, results[0])
+                    stdlib_archive_stripped = ArchiveFile(
+                        stdlib_stripped_path, name="stdlib"
+                    )
+
+                    msg_0 = "0"
+                    msg_1 = "stdlib"
+                    msg_2 = f"{len(stdlib_archive.namelist())} [red]→[/red] {len(stdlib_archive_stripped.namelist())}"
+                    msg_3 = ""
+                    size_msgs = [
+                        msg
+                        for encoding in config.encodings
+                        for msg in _size_columns(
+                            stdlib_archive.total_size(
+                                compressed=True, encoding=encoding
+                            ),
+                            stdlib_archive_stripped.total_size(
+                                compressed=True, encoding=encoding
+                            ),
+                        )
+                    ]
+                else:
+                    ar = archives[archive_idx]
+                    stats = sum_stats(results[archive_idx])
+
+                    msg_0 = f"{archive_idx}"
+                    msg_1 = ar.file_path.name
+                    msg_2 = f"{len(ar.namelist())} [red]→[/red] {stats['fh_out']}"
+                    msg_3 = f"{stats['so_in']} [red]→[/red] {stats['so_out']}"
+                    size_msgs = [
+                        msg
+                        for encoding in config.encodings
+                        for msg in _size_columns(
+                            ar.total_size(compressed=True, encoding=encoding),
+                            stats[f"size_{encoding}_out"],
+                        )
+                    ]
+                table.add_row(msg_0, msg_1, msg_2, msg_3, *size_msgs)
                 live.refresh()
 
-            # Write the list of .so libraries to pre-load
-            with fh_out.open("bundle-so-list.txt", "w") as fh:
-                for so in sorted(dynamic_libs):
-                    fh.write(f"{so.path},{so.shared}\n".encode())
-            with fh_out.open("home/pyodide/pyodide_pack_loader.py", "w") as fh:
-                loader_path = (
-                    Path(__file__).parent / "loader" / "pyodide_pack_loader.py"
+        package_results = [
+            result
+            for archive_idx in range(1, len(archives))
+            for result in sorted(
+                results[archive_idx], key=lambda res: res.task.shard_idx
+            )
+        ]
+        dynamic_libs = [
+            dll for result in package_results for dll in result.dynamic_libs
+        ]
+        bytecode = {
+            name: val
+            for result in package_results
+            for name, val in result.bytecode.items()
+        }
+        # Files are ordered by the time they were first accessed during discovery,
+        # so that the files needed at startup come first when streaming the bundle
+        member_names = get_member_names(package_results)
+        opened_file_times = db.get("opened_file_times", {})
+        member_order, _ = get_access_order(member_names, opened_file_times)
+
+        # With code splitting, modules not imported at startup go in lazy chunks,
+        # fetched by the loader when they are first imported
+        lazy_chunks: dict[str, tuple[str, str | None]] = {}
+        if config.code_splitting:
+            for path in Path(".").glob(LAZY_CHUNK_NAME.format("*")):
+                path.unlink()
+                write_precompressed(path, [])
+            lazy_chunks = get_lazy_chunks(member_names, db.get("startup_modules", []))
+        chunk_members: dict[str, set[str]] = defaultdict(set)
+        for name, (chunk, _) in lazy_chunks.items():
+            chunk_members[chunk].add(name)
+        for chunk, members in sorted(chunk_members.items()):
+            with zipfile.ZipFile(chunk, "w", compression=bundle_compression) as fh_out:
+                merge_results(
+                    fh_out,
+                    package_results,
+                    include=members.__contains__,
+                    order=member_order,
                 )
-                fh.write(loader_path.read_text().encode("utf-8"))
 
-    out_bundle_size = out_bundle_path.stat().st_size
-    if packages_size_gzip:
+        # Files used by the loader come first in the bundle
+        loader_path = Path(__file__).parent / "loader" / "pyodide_pack_loader.py"
+        loader = loader_path.read_bytes()
+        # The list of .so libraries to pre-load, as (path, shared, needed), in
+        # load order
+        so_list = "".join(
+            f"{so.path},{so.shared},{':'.join(so.needed)}\n"
+            for so in sorted(dynamic_libs)
+        )
+        metadata = [("bundle-so-list.txt", so_list.encode())]
+        if lazy_chunks:
+            metadata.append((CHUNK_LIST_NAME, dump_chunk_list(lazy_chunks).encode()))
+        if bytecode:
+            metadata.append((BYTECODE_BUNDLE_NAME, dump_bytecode_bundle(bytecode)))
+        core_order, n_startup = get_access_order(
+            [name for name in member_names if name not in lazy_chunks],
+            opened_file_times,
+            db.get("startup_time"),
+        )
+        # Files with the same content as a previous file are only written once,
+        # and created by the loader as links to that file
+        duplicates: dict[str, str] = {}
+        if config.deduplicate:
+            duplicates, deduplicated_size = find_duplicates(package_results, core_order)
+            metadata.append((DUPLICATES_NAME, dump_duplicates(duplicates).encode()))
+            n_startup -= sum(name in duplicates for name in core_order[:n_startup])
+            console.print(
+                f"Deduplicated {len(duplicates)} files with the same content as "
+                f"another file, saving {deduplicated_size / 1e6:.2f} MB (compressed)\n"
+            )
+        with zipfile.ZipFile(
+            out_bundle_path, "w", compression=bundle_compression
+        ) as fh_out:
+            # Number of files needed at startup, including this one and the loader
+            n_startup += 2 + len(metadata)
+            writestr(fh_out, "bundle-startup.txt", f"{n_startup}\n".encode())
+            writestr(fh_out, "home/pyodide/pyodide_pack_loader.py", loader)
+            for name, content in metadata:
+                writestr(fh_out, name, content)
+            merge_results(
+                fh_out,
+                package_results,
+                include=lambda name: name not in duplicates,
+                order=core_order,
+            )
+        # The loader is also written next to the bundle, to stream the bundle with it
+        shutil.copy(loader_path, loader_path.name)
+
+        # The merged bundle is loaded instead of the stdlib, with the package files
+        # after the stdlib files. The loader is at its root, so that it can be
+        # imported directly, and imports packages from the zip file.
+        merged_bundle_path = Path(MERGED_BUNDLE_NAME)
+        merged_bundle_path.unlink(missing_ok=True)
+        if config.merge_stdlib:
+            with zipfile.ZipFile(
+                merged_bundle_path, "w", compression=bundle_compression
+            ) as fh_out:
+                merge_results(fh_out, results[0])
+                writestr(fh_out, loader_path.name, loader)
+                for name, content in metadata:
+                    writestr(fh_out, name, content)
+                merge_results(
+                    fh_out,
+                    package_results,
+                    include=lambda name: name not in duplicates,
+                    order=core_order,
+                )
+
+    if ast_cache is not None:
+        ast_cache.prune()
+
+    # Precompressed output files are served by static hosting that doesn't
+    # compress files on the fly, with the corresponding Content-Encoding
+    precompress_encodings = config.encodings if config.precompress else []
+    for path in [
+        stdlib_stripped_path,
+        out_bundle_path,
+        Path(loader_path.name),
+        merged_bundle_path,
+        *map(Path, chunk_members),
+    ]:
+        write_precompressed(path, precompress_encodings)
+    if config.precompress:
+        suffixes = [CONTENT_ENCODINGS[encoding][1] for encoding in config.encodings]
         console.print(
-            f"Wrote {out_bundle_path} with {out_bundle_size/ 1e6:.2f} MB "
-            f"({100*(1 - out_bundle_size/packages_size_gzip):.1f}% reduction) \n"
+            f"Wrote precompressed {', '.join(suffixes)} files next to the output "
+            "files\n"
         )
 
-    # We start a webserver so that the bundle can be loaded via fetch
+    out_bundle_sizes = _estimated_sizes([out_bundle_path], config.encodings)
+    if any(packages_sizes.values()):
+        console.print(
+            f"Wrote {out_bundle_path} with "
+            f"{_format_sizes(out_bundle_sizes, packages_sizes)}"
+            f"{_precompressed_msg([out_bundle_path], precompress_encodings)} \n"
+        )
+    chunk_paths = [Path(chunk) for chunk in chunk_members]
+    lazy_chunks_sizes = _estimated_sizes(chunk_paths, config.encodings)
+    if lazy_chunks:
+        console.print(
+            f"Wrote {len(chunk_members)} lazy chunks with {len(lazy_chunks)} files and "
+            f"{_format_sizes(lazy_chunks_sizes)}"
+            f"{_precompressed_msg(chunk_paths, precompress_encodings)}, fetched "
+            f"when their modules are imported\n"
+        )
+    if config.merge_stdlib:
+        merged_bundle_sizes = _estimated_sizes([merged_bundle_path], config.encodings)
+        console.print(
+            f"Wrote {merged_bundle_path} with {_format_sizes(merged_bundle_sizes)}"
+            f"{_precompressed_msg([merged_bundle_path], precompress_encodings)}, "
+            f"to load as the stdlib instead of {stdlib_stripped_path} and "
+            f"{out_bundle_path}\n"
+        )
+
+    # We start a webserver so that the bundle can be loaded via fetch. The bundle
+    # is validated when extracted to MEMFS, and optionally in other modes, e.g.
+    # when imported from the zip file.
+    validation_results: dict[str, dict[str, Any]] = {}
+    if not lazy_chunks and "lazy_chunks" in modes:
+        # All modules are imported at startup
+        modes.remove("lazy_chunks")
     with spawn_web_server(dist_dir=".") as (_, port, server_logs):
         js_template_path = ROOT_DIR / "pyodide_pack" / "js" / "validate.js"
-        js_template_kwargs = dict(code=code, output_path="results.json", port=port)
-        with NodeRunner(js_template_path, ROOT_DIR, **js_template_kwargs) as runner:
-            shutil.copy(
-                stdlib_stripped_path, runner.tmp_path / stdlib_stripped_path.name
+        for mode in modes:
+            merged_stdlib = mode == "merged_stdlib"
+            js_template_kwargs = dict(
+                code=code,
+                output_path="results.json",
+                port=port,
+                originals_dir=ORIGINALS_DIR_NAME,
+                lazy_dynlibs=config.so.lazy_load,
+                zip_import=mode == "zip_import",
+                stream=mode == "stream",
+                merged_stdlib=merged_stdlib,
+                stdlib_name=(
+                    merged_bundle_path.name
+                    if merged_stdlib
+                    else stdlib_stripped_path.name
+                ),
+                lazy_chunks=bool(lazy_chunks),
+                # Chunks are otherwise fetched in advance
+                import_lazy_chunks=mode == "lazy_chunks",
+                chunks_dir=str(Path.cwd()),
             )
-            console.print("Running the input code in Node.js to validate bundle..\n")
-            t0 = perf_counter()
-            runner.run()
-            with open(runner.tmp_path / "results.json") as fh:
-                benchmarks = json.load(fh)
+            with NodeRunner(js_template_path, ROOT_DIR, **js_template_kwargs) as runner:
+                shutil.copy(
+                    stdlib_stripped_path, runner.tmp_path / stdlib_stripped_path.name
+                )
+                console.print(
+                    f"Running the input code in Node.js to validate bundle ({mode})..\n"
+                )
+                try:
+                    runner.run()
+                except subprocess.CalledProcessError:
+                    console.print(
+                        f"[red]Bundle validation failed ({mode})[/red], see the "
+                        "error above"
+                    )
+                    sys.exit(1)
+                with open(runner.tmp_path / "results.json") as fh:
+                    validation_results[mode] = json.load(fh)
+    benchmarks = validation_results["extract"]["bench"]
 
     table = Table(title="Validating and benchmarking the output bundle..")
     table.add_column("Step", justify="left")
@@ -263,15 +789,64 @@ def main(
     )
     console.print(table)
 
-    total_final_size = (
-        stdlib_archive_stripped.total_size(compressed=True) + out_bundle_size
-    )
+    table = Table(title="Comparing ways to load the bundle")
+    table.add_column("Mode", justify="left")
+    table.add_column("Load time (s)", justify="right")
+    table.add_column("Peak memory (MB)", justify="right")
+    table.add_column("Wasm memory (MB)", justify="right")
+    for mode, mode_results in validation_results.items():
+        table.add_row(
+            mode,
+            f"{sum(mode_results['bench'].values())/1e9:.2f}",
+            f"{mode_results['memory']['max_rss']/1e6:.1f}",
+            f"{mode_results['memory']['wasm_memory']/1e6:.1f}",
+        )
+    console.print(table)
+
+    # Compare the import time with the last runs with different settings
+    # affecting it
+    benchmarks_cache = JSONCache(get_cache_dir() / "benchmarks.json")
+    settings = config.py.model_dump(include=BENCHMARK_SETTINGS)
+    settings_key = json.dumps(settings, sort_keys=True)
+    previous_runs = benchmarks_cache.get(discovery_key) or {}
+    for previous_key, previous_benchmarks in previous_runs.items():
+        if previous_key == settings_key or "import_run_app" not in previous_benchmarks:
+            continue
+        previous_settings = json.loads(previous_key)
+        changes = ", ".join(
+            f"{name}: {previous_settings.get(name)} → {value}"
+            for name, value in settings.items()
+            if previous_settings.get(name) != value
+        )
+        previous_time = previous_benchmarks["import_run_app"]
+        console.print(
+            f"Import and run time: {previous_time/1e9:.2f} s [red]→[/red] "
+            f"{benchmarks['import_run_app']/1e9:.2f} s, compared to the last run "
+            f"with {changes}"
+        )
+    if cache:
+        benchmarks_cache.set(discovery_key, {**previous_runs, settings_key: benchmarks})
+
+    total_final_sizes = {
+        encoding: stdlib_archive_stripped.total_size(compressed=True, encoding=encoding)
+        + out_bundle_sizes[encoding]
+        + lazy_chunks_sizes[encoding]
+        for encoding in config.encodings
+    }
 
     console.print(
         f"\nTotal output size (stdlib + packages): "
-        f"{total_final_size/1e6:.2f} MB "
-        f"({100*(1 - total_final_size/total_initial_size):.1f}% reduction)"
+        f"{_format_sizes(total_final_sizes, total_initial_sizes)}"
     )
+    if config.merge_stdlib:
+        total_merged_sizes = {
+            encoding: merged_bundle_sizes[encoding] + lazy_chunks_sizes[encoding]
+            for encoding in config.encodings
+        }
+        console.print(
+            f"Total output size with the bundle merged with the stdlib: "
+            f"{_format_sizes(total_merged_sizes, total_initial_sizes)}"
+        )
 
     console.print("\nBundle validation successful.")
 
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import gzip
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Literal
+
+# Transfer encodings supported for size accounting and precompressed files
+Encoding = Literal["gzip", "brotli", "zstd"]
+
+# Content-Encoding token and suffix of precompressed files for each encoding,
+# in order of preference when a client accepts several of them
+CONTENT_ENCODINGS: dict[str, tuple[str, str]] = {
+    "brotli": ("br", ".br"),
+    "zstd": ("zstd", ".zst"),
+    "gzip": ("gzip", ".gz"),
+}
+
+# Browsers only decompress zstd content with a window of at most 8 MB, which
+# excludes the "ultra" levels above 19
+ZSTD_LEVEL = 19
+# Levels used to estimate compressed sizes, file by file. The maximum levels of
+# brotli and zstd are too slow to compress every packed file on each run.
+ESTIMATE_LEVELS = {"gzip": 9, "brotli": 9, "zstd": 9}
+
+
+def compress(
+    content: bytes | memoryview, encoding: str, level: int | None = None
+) -> bytes:
+    """Compress content with a transfer encoding, at its maximum level by default
+
+    brotli and zstd require the brotli and zstandard packages.
+
+    Examples
+    --------
+    >>> gzip.decompress(compress(b"abc" * 10, "gzip"))
+    b'abcabcabcabcabcabcabcabcabcabc'
+    """
+    if encoding == "gzip":
+        return gzip.compress(content, compresslevel=level or 9, mtime=0)
+    if encoding == "brotli":
+        try:
+            import brotli  # type: ignore
+        except ImportError as err:
+            raise ImportError(
+                "brotli compression requires the brotli package, installed with "
+                "pip install pyodide-pack[compression]"
+            ) from err
+        return brotli.compress(bytes(content), quality=level or 11)
+    if encoding == "zstd":
+        try:
+            import zstandard
+        except ImportError as err:
+            raise ImportError(
+                "zstd compression requires the zstandard package, installed with "
+                "pip install pyodide-pack[compression]"
+            ) from err
+        return zstandard.ZstdCompressor(level=level or ZSTD_LEVEL).compress(content)
+    raise ValueError(f"Unknown encoding {encoding!r}")
+
+
+def compressed_size(content: bytes | memoryview, encoding: str) -> int:
+    """Estimate the compressed size of content, at the level of ESTIMATE_LEVELS
+
+    Examples
+    --------
+    >>> compressed_size(b"abc" * 10, "gzip")
+    25
+    """
+    return len(compress(content, encoding, ESTIMATE_LEVELS[encoding]))
+
+
+def check_encodings(encodings: Iterable[str]) -> None:
+    """Check that the packages needed by encodings are installed
+
+    Raises an ImportError otherwise.
+    """
+    for encoding in encodings:
+        compress(b"", encoding)
+
+
+def get_precompressed_path(path: Path, encoding: str) -> Path:
+    """Get the path of the file precompressed with an encoding
+
+    Examples
+    --------
+    >>> get_precompressed_path(Path("a.zip"), "brotli")
+    PosixPath('a.zip.br')
+    """
+    return path.with_name(path.name + CONTENT_ENCODINGS[encoding][1])
+
+
+def write_precompressed(path: Path, encodings: Iterable[str]) -> dict[str, int]:
+    """Write the file compressed with each encoding next to it
+
+    Precompressed files of other encodings, or of a file which doesn't exist
+    anymore, are removed.
+
+    Returns
+    -------
+    sizes
+        size of the precompressed file for each encoding
+    """
+    encodings = list(encodings)
+    content = path.read_bytes() if encodings and path.exists() else None
+    sizes = {}
+    for encoding in CONTENT_ENCODINGS:
+        out_path = get_precompressed_path(path, encoding)
+        if encoding not in encodings or content is None:
+            out_path.unlink(missing_ok=True)
+            continue
+        out_path.write_bytes(compress(content, encoding))
+        sizes[encoding] = out_path.stat().st_size
+    return sizes
+
+
+def find_precompressed(path: str, accept_encoding: str) -> tuple[str, str] | None:
+    """Find a precompressed version of a file accepted by a client
+
+    Parameters
+    ----------
+    path
+        path of the requested file
+    accept_encoding
+        value of the Accept-Encoding header of the request
+
+    Returns
+    -------
+    precompressed
+        path of the precompressed file and its Content-Encoding, or None
+
+    Examples
+    --------
+    >>> find_precompressed("missing.zip", "gzip, br")
+    """
+    accepted = set()
+    for item in accept_encoding.split(","):
+        token, _, params = item.partition(";")
+        _, _, quality = params.replace(" ", "").partition("q=")
+        try:
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(token.strip().lower())
+    for token, suffix in CONTENT_ENCODINGS.values():
+        if token in accepted and Path(path + suffix).is_file():
+            return path + suffix, token
+    return None
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
+
+from pyodide_pack.compression import Encoding
 
 try:
     import tomllib
@@ -39,6 +41,10 @@ def _get_config_section(path: Path) -> dict[str, Any] | None:
     return None
 
 
+# Ways to load the bundle in the validation step, besides extracting it
+ValidationMode = Literal["zip_import", "stream", "lazy_chunks", "merged_stdlib"]
+
+
 class PyPackConfig(BaseModel):
     """Configuration for handling Python files"""
 
@@ -47,6 +53,19 @@ class PyPackConfig(BaseModel):
     strip_module_docstrings: bool = True
     strip_docstrings: bool = True
     py_compile: bool = False
+    py_compile_keep_source: bool = False
+    py_compile_bundle: bool = False
+    # 0: disabled, 1: stubs fetching the original function, 2: stubs raising an error
+    tree_shake: Literal[0, 1, 2] = 0
+    # 0: disabled, 1: remove asserts, debug and type checking blocks,
+    # 2: also remove annotations
+    optimize: Literal[0, 1, 2] = 0
+    # Rename local variables of functions to short names
+    minify_names: bool = False
+    # Packages (top-level import names) for which imports of slow modules are deferred
+    defer_imports: list[str] = []
+    # Minimal import time (in seconds) of modules for which imports are deferred
+    defer_imports_min_time: float = 0.01
 
 
 class SoPackConfig(BaseModel):
@@ -55,6 +74,8 @@ class SoPackConfig(BaseModel):
     model_config = ConfigDict(extra="forbid")
 
     drop_unused_so: bool = True
+    # Load libraries of extension modules when they are imported
+    lazy_load: bool = False
 
 
 class PackConfig(BaseModel):
@@ -64,5 +85,22 @@ class PackConfig(BaseModel):
 
     requires: list[str] = []
     include_paths: list[str] = []
+    scenarios: list[str] = []
+    # Put modules not imported by the leading imports of the application in
+    # lazy chunks, fetched when they are first imported
+    code_splitting: bool = False
+    # Also write the package bundle merged with the stripped stdlib, to load
+    # both with a single request as the stdlib of Pyodide
+    merge_stdlib: bool = False
+    # Transfer encodings used to report sizes, and to precompress the output
+    # files with, as <file>.gz, <file>.br or <file>.zst
+    encodings: list[Encoding] = Field(["gzip"], min_length=1)
+    precompress: bool = False
+    # Write files with the same content as another file only once, the loader
+    # creating them as links to that file
+    deduplicate: bool = False
+    # Additional ways to load the bundle in the validation step, each with a
+    # separate run of the application. The extracted bundle is always validated.
+    validation_modes: list[ValidationMode] = []
     py: PyPackConfig = PyPackConfig()
     so: SoPackConfig = SoPackConfig()
@@ -1,4 +1,12 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+# Number of bytes read at the beginning of dynamic libraries to find the
+# libraries they need, in the dylink section which comes first in the module
+DYLINK_HEAD_SIZE = 65_536
+
+_WASM_HEADER = b"\0asm\x01\0\0\0"
+# Subsection of the dylink.0 section with the needed libraries
+_WASM_DYLINK_NEEDED = 2
 
 
 @dataclass
@@ -12,14 +20,91 @@ class DynamicLib:
     --------
     >>> l = [DynamicLib('a', load_order=2), DynamicLib('b', load_order=1)]
     >>> list(sorted(l))
-    [DynamicLib(path='b', load_order=1, shared=False),
-     DynamicLib(path='a', load_order=2, shared=False)]
+    [DynamicLib(path='b', load_order=1, shared=False, needed=[]),
+     DynamicLib(path='a', load_order=2, shared=False, needed=[])]
     """
 
     path: str
     load_order: int
     shared: bool = False
+    # File names of the libraries it needs, see get_needed_libs
+    needed: list[str] = field(default_factory=list)
 
     def __lt__(self, other):
         """Implement less than to make these objects sortable"""
         return self.load_order < other.load_order
+
+
+def _read_leb128(data: bytes, pos: int) -> tuple[int, int]:
+    """Read an unsigned LEB128 integer, returning it and the next position"""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return result, pos
+
+
+def _read_name(data: bytes, pos: int) -> tuple[str, int]:
+    size, pos = _read_leb128(data, pos)
+    if pos + size > len(data):
+        raise IndexError("truncated name")
+    return data[pos : pos + size].decode(), pos + size
+
+
+def _read_names(data: bytes, pos: int) -> list[str]:
+    count, pos = _read_leb128(data, pos)
+    names = []
+    for _ in range(count):
+        name, pos = _read_name(data, pos)
+        names.append(name)
+    return names
+
+
+def get_needed_libs(head: bytes) -> list[str]:
+    """Get the file names of the libraries needed by a WebAssembly dynamic library
+
+    They are read from the dylink.0 (or legacy dylink) custom section, which is
+    the first section of the module. An empty list is returned if head, the
+    beginning of the file, doesn't contain this section.
+
+    Examples
+    --------
+    >>> def name(value):
+    ...     return bytes([len(value)]) + value
+    >>> needed = b"\\x01" + name(b"libz.so")
+    >>> section = name(b"dylink.0") + b"\\x02" + bytes([len(needed)]) + needed
+    >>> get_needed_libs(b"\\0asm\\x01\\0\\0\\0\\0" + bytes([len(section)]) + section)
+    ['libz.so']
+    >>> get_needed_libs(b"\\x7fELF")
+    []
+    """
+    if not head.startswith(_WASM_HEADER):
+        return []
+    try:
+        pos = len(_WASM_HEADER)
+        if head[pos] != 0:
+            # Not a custom section
+            return []
+        size, pos = _read_leb128(head, pos + 1)
+        end = pos + size
+        section_name, pos = _read_name(head, pos)
+        if section_name == "dylink":
+            # Memory size, memory alignment, table size and table alignment
+            for _ in range(4):
+                _, pos = _read_leb128(head, pos)
+            return _read_names(head, pos)
+        if section_name != "dylink.0":
+            return []
+        while pos < end:
+            subsection_type = head[pos]
+            size, pos = _read_leb128(head, pos + 1)
+            if subsection_type == _WASM_DYLINK_NEEDED:
+                return _read_names(head, pos)
+            pos += size
+    except (IndexError, UnicodeDecodeError):
+        # Truncated or invalid section
+        pass
+    return []
@@ -1,5 +1,5 @@
-function patchFSopen(pyodide, fileList) {
-  // Record FS.open
+function patchFSopen(pyodide, fileList, fileTimes) {
+  // Record FS.open, and the time (in ms) each file was first opened
   // Note: we can't use FS.trackingDelegate since we want this to work without
   // -sFS_DEBUG
   const openOrig = pyodide._module.FS.open;
@@ -9,6 +9,9 @@ function patchFSopen(pyodide, fileList) {
     // Here we only keep files in read mode.
     if (flags % 2 == 0) {
       fileList.push(path);
+      if (!(path in fileTimes)) {
+        fileTimes[path] = performance.now();
+      }
     }
     return openOrig(path, flags, mode, fd_start, fd_end);
   };
@@ -81,7 +84,8 @@ async function main() {
 
   let pyodide = await loadPyodide()
   let fileList = [];
-  patchFSopen(pyodide, fileList);
+  let fileTimes = new Object();
+  patchFSopen(pyodide, fileList, fileTimes);
 
   let loadDynlibCalls = [];
   pathchLoadDynLib(pyodide, loadDynlibCalls);
@@ -99,13 +103,108 @@ async function main() {
 	await micropip.install({{packages}});
   }
 
+{% if time_imports %}
+  // Record the time to import each module (including its own imports), so that
+  // imports of slow modules can be deferred
+  pyodide.runPython(`
+import builtins
+import importlib.util
+import sys
+import time
+
+_pyodide_pack_import_orig = builtins.__import__
+_pyodide_pack_import_times = {}
+
+def _pyodide_pack_import(name, globals=None, locals=None, fromlist=(), level=0):
+    try:
+        package = (globals or {}).get("__package__") or ""
+        abs_name = importlib.util.resolve_name("." * level + name, package)
+    except (ImportError, ValueError):
+        return _pyodide_pack_import_orig(name, globals, locals, fromlist, level)
+    names = [abs_name] + [f"{abs_name}.{el}" for el in fromlist or () if el != "*"]
+    new_names = [el for el in names if el not in sys.modules]
+    if not new_names:
+        return _pyodide_pack_import_orig(name, globals, locals, fromlist, level)
+    t0 = time.perf_counter()
+    try:
+        return _pyodide_pack_import_orig(name, globals, locals, fromlist, level)
+    finally:
+        duration = time.perf_counter() - t0
+        for el in new_names:
+            if el in sys.modules:
+                _pyodide_pack_import_times.setdefault(el, duration)
+
+builtins.__import__ = _pyodide_pack_import
+`);
+{% endif %}
+{% if trace_functions %}
+  // Record executed functions as (file name, first line, name), so that unused
+  // functions can be removed
+  pyodide.runPython(`
+import sys
+_pyodide_pack_executed = set()
+
+if hasattr(sys, "monitoring"):
+    def _pyodide_pack_start(code, offset):
+        _pyodide_pack_executed.add((code.co_filename, code.co_firstlineno, code.co_name))
+        return sys.monitoring.DISABLE
+
+    sys.monitoring.use_tool_id(sys.monitoring.PROFILER_ID, "pyodide-pack")
+    sys.monitoring.register_callback(
+        sys.monitoring.PROFILER_ID, sys.monitoring.events.PY_START, _pyodide_pack_start
+    )
+    sys.monitoring.set_events(sys.monitoring.PROFILER_ID, sys.monitoring.events.PY_START)
+else:
+    def _pyodide_pack_profile(frame, event, arg):
+        if event == "call":
+            code = frame.f_code
+            _pyodide_pack_executed.add((code.co_filename, code.co_firstlineno, code.co_name))
+
+    sys.setprofile(_pyodide_pack_profile)
+`);
+{% endif %}
+{% if startup_code %}
+  await pyodide.runPythonAsync(`
+{{ startup_code }}
+`);
+{% endif %}
+{% if code_splitting %}
+  // Modules imported at startup, which go in the core chunk of the bundle
+  let startupModules = pyodide.runPython("import sys; list(sys.modules)").toJs();
+{% endif %}
+  // Files first opened before this time are needed at startup. Without a
+  // separate startup code, this is the whole application.
+  let startupTime = performance.now();
   await pyodide.runPythonAsync(`
 {{ code }}
 `);
+{% if not startup_code %}
+  startupTime = performance.now();
+{% endif %}
   // Run code used in the loader
   await pyodide.runPythonAsync(`
 import pyodide.http
 `);
+{% if time_imports %}
+  let importTimes = pyodide.runPython(`
+builtins.__import__ = _pyodide_pack_import_orig
+_pyodide_pack_import_times
+`).toJs({dict_converter : Object.fromEntries});
+{% endif %}
+{% if trace_functions %}
+  let executedFunctions = pyodide.runPython(`
+if hasattr(sys, "monitoring"):
+    sys.monitoring.set_events(sys.monitoring.PROFILER_ID, 0)
+    sys.monitoring.free_tool_id(sys.monitoring.PROFILER_ID)
+else:
+    sys.setprofile(None)
+
+_pyodide_pack_functions = {}
+for file_name, first_line, name in sorted(_pyodide_pack_executed):
+    _pyodide_pack_functions.setdefault(file_name, []).append([first_line, name])
+_pyodide_pack_functions
+`).toJs({dict_converter : Object.fromEntries});
+{% endif %}
   // Look for loaded modules. That's the only way to access imported stdlib from the zipfile.
   let sysModules = pyodide.runPython(
 	"import sys; {name: getattr(mod, '__file__', None) for name, mod in sys.modules.items()}"
@@ -125,7 +224,18 @@ import pyodide.http
 	sys_modules: sysModules,
 	LDSO_loaded_libs_by_handle: pyodide._module.LDSO['loadedLibsByHandle'],
 	dl_accessed_symbols: accessedSymbolsOut,
+	opened_file_times: fileTimes,
+	startup_time: startupTime,
   };
+{% if trace_functions %}
+  obj.executed_functions = executedFunctions;
+{% endif %}
+{% if time_imports %}
+  obj.import_times = importTimes;
+{% endif %}
+{% if code_splitting %}
+  obj.startup_modules = startupModules;
+{% endif %}
   if ("micropip" in pyodide.loadedPackages) {
     obj.pyodide_lock = pyodide.pyimport("micropip").freeze();
   }
@@ -8,12 +8,48 @@ async function main() {
   let bench = new Object();
 
   let t0 = process.hrtime.bigint();
-  let pyodide = await loadPyodide({fullStdLib: false, stdLibURL: "http://127.0.0.1:{{ port }}/python_stdlib_stripped.zip"});
+  let pyodide = await loadPyodide({fullStdLib: false, stdLibURL: "http://127.0.0.1:{{ port }}/{{ stdlib_name }}"});
   bench.loadPyodide = Number(process.hrtime.bigint() - t0);
 
 
   globalThis.fetch = fetch.default;
 
+{% if merged_stdlib %}
+  // The bundle was loaded with the stdlib, whose zip file is on sys.path and
+  // has the loader at its root
+{% elif zip_import %}
+  // Keep the bundle as a single file, modules are imported from it with zipimport
+  t0 = process.hrtime.bigint();
+  let response = await globalThis.fetch(
+    "http://127.0.0.1:{{ port }}/pyodide-package-bundle.zip"
+  );
+  pyodide.FS.writeFile(
+    "/pyodide-package-bundle.zip", new Uint8Array(await response.arrayBuffer())
+  );
+  bench.fetch_bundle = Number(process.hrtime.bigint() - t0);
+  await pyodide.runPythonAsync(`
+    import sys
+
+    sys.path.insert(0, "/pyodide-package-bundle.zip/home/pyodide")
+  `);
+{% elif stream %}
+  // Extract the bundle while it is received, with the loader written next to it
+  t0 = process.hrtime.bigint();
+  await pyodide.runPythonAsync(`
+    from pyodide.http import pyfetch
+
+    response = await pyfetch("http://127.0.0.1:{{ port }}/pyodide_pack_loader.py")
+    with open("/home/pyodide/pyodide_pack_loader.py", "wb") as fh:
+        fh.write(await response.bytes())
+
+    import pyodide_pack_loader
+
+    _pyodide_pack_rest = await pyodide_pack_loader.stream_bundle(
+        "http://127.0.0.1:{{ port }}/pyodide-package-bundle.zip"
+    )
+  `);
+  bench.fetch_unpack_archive = Number(process.hrtime.bigint() - t0);
+{% else %}
   t0 = process.hrtime.bigint();
   await pyodide.runPythonAsync(`
     from pyodide.http import pyfetch
@@ -27,11 +63,40 @@ async function main() {
 
     assert Path('/home/pyodide/pyodide_pack_loader.py').exists()
   `)
-
+{% endif %}
   t0 = process.hrtime.bigint();
 
   let pp_loader = pyodide.pyimport('pyodide_pack_loader');
-  await pp_loader.setup()
+  await pp_loader.setup(
+    "http://127.0.0.1:{{ port }}/{{ originals_dir }}",
+    {{ "true" if lazy_dynlibs else "false" }},
+    {{ '"/pyodide-package-bundle.zip"' if zip_import else "undefined" }},
+    "http://127.0.0.1:{{ port }}",
+  );
+{% if stream %}
+  // The application may need files of the bundle not accessed at startup
+  await pyodide.runPythonAsync("await _pyodide_pack_rest");
+{% endif %}
+{% if import_lazy_chunks %}
+  // Lazy chunks are fetched with synchronous requests when their modules are
+  // imported, which Node.js doesn't support, so they are read from the file
+  // system instead
+  globalThis.readChunkSync = (url) => new Uint8Array(
+    fs.readFileSync({{ chunks_dir|tojson }} + "/" + url.split("/").pop())
+  );
+  await pyodide.runPythonAsync(`
+    import pyodide_pack_loader
+    from js import readChunkSync
+
+    pyodide_pack_loader._lazy_chunk_importer.fetch = (
+        lambda url: readChunkSync(url).to_bytes()
+    )
+  `);
+{% elif lazy_chunks %}
+  // Lazy chunks are fetched synchronously on import, which is not possible in
+  // Node.js, so they are fetched in advance (see the "lazy chunks" mode)
+  await pp_loader.load_lazy_chunks();
+{% endif %}
 
   bench.load_dynamic_libs = Number(process.hrtime.bigint() - t0);
 
@@ -42,7 +107,13 @@ async function main() {
 `);
   bench.import_run_app = Number(process.hrtime.bigint() - t0);
 
-  let jsonString = JSON.stringify(bench);
+  // Peak memory of the process (including extracted files in MEMFS), and
+  // size of the WebAssembly memory
+  let memory = {
+    max_rss: process.resourceUsage().maxRSS * 1024,
+    wasm_memory: pyodide._module.HEAP8.length,
+  };
+  let jsonString = JSON.stringify({ bench: bench, memory: memory });
   let file = fs.createWriteStream("{{ output_path }}");
   file.write(jsonString);
   file.end();
@@ -1,10 +1,661 @@
+import asyncio
+import json
+import marshal
+import os
+import sys
+import types
+import zipimport
+import zlib
+from importlib import invalidate_caches
+from importlib.abc import Loader, MetaPathFinder
+from importlib.machinery import ExtensionFileLoader, ModuleSpec
+from importlib.util import spec_from_file_location
 from pathlib import Path
 
+BYTECODE_BUNDLE_PATH = Path("/bundle-bytecode.marshal")
+SO_LIST_PATH = Path("/bundle-so-list.txt")
+CHUNK_LIST_PATH = Path("/bundle-chunks.txt")
+DUPLICATES_PATH = Path("/bundle-duplicates.json")
+# Number of files needed at startup, at the beginning of the bundle
+STARTUP_NAME = "bundle-startup.txt"
 
-async def setup():
-    """Load dynamic libraries in the pyodide-pack bundle"""
+# URL of the directory with the lazy chunks of the bundle
+CHUNKS_URL = "."
+_lazy_chunk_importer = None
+
+# URL of the original sources of files with functions removed by tree shaking
+ORIGINALS_URL = "pyodide-package-bundle-originals"
+_loaded_functions: dict[tuple[str, int, str], types.CodeType] = {}
+
+
+class BytecodeBundleImporter(MetaPathFinder, Loader):
+    """Import modules from the precompiled bytecode bundle
+
+    The bundle maps module names to (is_package, path, marshalled code). Code
+    objects are only unmarshalled when the corresponding module is imported.
+    """
+
+    def __init__(self, modules):
+        self.modules = modules
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in self.modules:
+            return None
+        is_package, origin, _ = self.modules[fullname]
+        spec = ModuleSpec(fullname, self, origin=origin, is_package=is_package)
+        spec.has_location = True
+        if is_package:
+            spec.submodule_search_locations = [str(Path(origin).parent)]
+        return spec
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        _, _, code = self.modules[module.__spec__.name]
+        exec(marshal.loads(code), module.__dict__)
+
+    def get_code(self, fullname):
+        return marshal.loads(self.modules[fullname][2])
+
+    def get_source(self, fullname):
+        return None
+
+
+def _find_code(code, first_line, name):
+    """Find the code object of a function in the code of a module"""
+    codes = [code]
+    while codes:
+        code = codes.pop()
+        if code.co_firstlineno == first_line and code.co_name == name:
+            return code
+        codes.extend(obj for obj in code.co_consts if isinstance(obj, types.CodeType))
+    raise LookupError(f"Could not find the code of {name} (line {first_line})")
+
+
+def load_function(globals, path, first_line, name):
+    """Load a function removed by tree shaking from its original source
+
+    This is called by the stubs that replace functions not executed during
+    the detection of used files. It requires synchronous HTTP requests, so it
+    only works in a browser.
+    """
+    key = (path, first_line, name)
+    if key not in _loaded_functions:
+        from pyodide.http import open_url  # type: ignore[import-not-found]
+
+        source = open_url(f"{ORIGINALS_URL}/{path.lstrip('/')}").read()
+        code = _find_code(compile(source, path, "exec"), first_line, name)
+        _loaded_functions[key] = code
+    return types.FunctionType(_loaded_functions[key], globals, name)
+
+
+def _read_so_list(text):
+    """Parse the dynamic libraries to load, as (path, shared, needed)
+
+    Each line of the list is "path,shared,needed", where needed are the file
+    names of the libraries it needs separated by ":". Older bundles don't have
+    the needed column.
+    """
+    libs = []
+    for line in text.splitlines():
+        so_path, is_shared, *extra = line.split(",")
+        needed = extra[0].split(":") if extra and extra[0] else []
+        libs.append((so_path, is_shared == "True", needed))
+    return libs
+
+
+def _get_extension_module_name(so_path):
+    """Get the name of the extension module of a dynamic library, or None"""
+    dirname, _, basename = so_path.rpartition("/")
+    parts = [basename.split(".")[0]]
+    if "/site-packages/" in so_path:
+        parts[:0] = dirname.partition("/site-packages/")[2].split("/")
+    elif not dirname.endswith("/lib-dynload"):
+        return None
+    parts = [part for part in parts if part]
+    if not parts or not all(part.isidentifier() for part in parts):
+        return None
+    return ".".join(parts)
+
+
+def _load_dynlib_sync(path):
+    """Load a (non shared) dynamic library synchronously
+
+    This does the same as the asynchronous loadDynlib of Pyodide, but compiles
+    the WebAssembly module synchronously, which browsers only allow for small
+    modules in the main thread.
+    """
+    from js import Object  # type: ignore[import-not-found]
+    from pyodide.ffi import to_js  # type: ignore[import-not-found]
     from pyodide_js import _module
 
-    for paths in Path("/bundle-so-list.txt").read_text().splitlines():
-        path, is_shared = paths.split(",")
-        await _module.API.loadDynlib(path, bool(is_shared))
+    flags = {
+        "loadAsync": False,
+        "nodelete": True,
+        "allowUndefined": True,
+        "global": False,
+        "fs": _module.FS,
+    }
+    _module.loadDynamicLibrary(
+        path, to_js(flags, dict_converter=Object.fromEntries), Object.new()
+    )
+    # Libraries needing this one look it up by file name
+    loaded_libs = _module.LDSO.loadedLibsByName
+    setattr(loaded_libs, path.rpartition("/")[2], getattr(loaded_libs, path))
+
+
+class DynlibImportHook(MetaPathFinder):
+    """Load dynamic libraries of extension modules when they are imported
+
+    This finder doesn't find modules: it loads the library of an extension
+    module, and the libraries it needs, before the import system finds it.
+    Shared libraries, and libraries which are not needed by an extension
+    module, are loaded eagerly.
+    """
+
+    def __init__(self, libs, load_dynlib=_load_dynlib_sync):
+        self.load_dynlib = load_dynlib
+        # Libraries needed by each local library
+        self.needed = {
+            so_path: needed for so_path, is_shared, needed in libs if not is_shared
+        }
+        self.by_name = {}
+        for so_path in self.needed:
+            self.by_name.setdefault(so_path.rpartition("/")[2], so_path)
+
+        needed_names = {name for *_, needed in libs for name in needed}
+        # Local libraries needed by shared libraries are loaded with them
+        roots = [
+            self.by_name[name]
+            for _, is_shared, needed in libs
+            if is_shared
+            for name in needed
+            if name in self.by_name
+        ]
+        # Extension module names of libraries to load when they are imported.
+        # Libraries needed by other libraries are not extension modules.
+        self.modules = {}
+        for so_path in self.needed:
+            if so_path.rpartition("/")[2] in needed_names:
+                continue
+            module_name = _get_extension_module_name(so_path)
+            if module_name is None:
+                roots.append(so_path)
+            else:
+                self.modules[module_name] = so_path
+        # Libraries which are not needed by an extension module (e.g. loaded
+        # with ctypes), and the libraries they need, are loaded eagerly
+        self.eager = set(self._with_dependencies(roots, loaded=set()))
+        self.loaded = set(self.eager)
+
+    def _with_dependencies(self, so_paths, loaded):
+        """Get libraries and the local libraries they need, dependencies first"""
+        output = []
+        seen = set(loaded)
+        stack = [(so_path, False) for so_path in reversed(so_paths)]
+        while stack:
+            so_path, deps_done = stack.pop()
+            if deps_done:
+                output.append(so_path)
+                continue
+            if so_path in seen:
+                continue
+            seen.add(so_path)
+            stack.append((so_path, True))
+            for name in reversed(self.needed[so_path]):
+                if (dep := self.by_name.get(name)) is not None and dep not in seen:
+                    stack.append((dep, False))
+        return output
+
+    def find_spec(self, fullname, path=None, target=None):
+        so_path = self.modules.pop(fullname, None)
+        if so_path is not None:
+            for dep in self._with_dependencies([so_path], loaded=self.loaded):
+                self.load_dynlib(dep)
+                self.loaded.add(dep)
+        return None
+
+
+def _read_duplicates(text):
+    """Parse the duplicate files of the bundle, as {path: path of the original}"""
+    return json.loads(text)
+
+
+def link_duplicates(duplicate_list_path=DUPLICATES_PATH):
+    """Create the duplicate files of an extracted bundle as links
+
+    Files with the same content as another file are only written once in the
+    bundle. Links are created even if the original file is not extracted yet,
+    e.g. while the bundle is streamed.
+    """
+    if not duplicate_list_path.exists():
+        return
+    for path, original in _read_duplicates(duplicate_list_path.read_text()).items():
+        path = Path(path)
+        if path.is_symlink() or path.exists():
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.symlink_to(original)
+    invalidate_caches()
+
+
+def _get_module_name(path):
+    """Get the name of the module of a Python file in site-packages, or None"""
+    dirname, _, basename = path.rpartition("/")
+    stem, _, suffix = basename.rpartition(".")
+    if (
+        "/site-packages/" not in path
+        or suffix not in ("py", "pyc")
+        or "__pycache__" in dirname
+    ):
+        return None
+    parts = dirname.partition("/site-packages/")[2].split("/")
+    if stem != "__init__":
+        parts.append(stem)
+    parts = [part for part in parts if part]
+    if not parts or not all(part.isidentifier() for part in parts):
+        return None
+    return ".".join(parts)
+
+
+class ZipBundle:
+    """A bundle kept as a single zip file, instead of being extracted
+
+    Python modules and package data are imported from the zip file with
+    zipimport. Package data is available with importlib.resources, but not
+    with open(). Dynamic libraries are extracted when they are loaded.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.importer = zipimport.zipimporter(self.path)
+        # Paths of files not written in the bundle, and of the file with the
+        # same content
+        self.duplicates = {}
+
+    def read(self, path):
+        """Read a file of the bundle, from its path once extracted, or None"""
+        path = self.duplicates.get(str(path), str(path))
+        try:
+            return self.importer.get_data(path.lstrip("/"))
+        except OSError:
+            return None
+
+    def extract(self, path):
+        """Extract a file of the bundle, unless it already exists"""
+        path = Path(path)
+        if not path.exists():
+            if (content := self.read(path)) is None:
+                raise FileNotFoundError(f"{path} is not in the bundle {self.path}")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+
+    def mount(self):
+        """Import modules from the bundle, before the directories of sys.path"""
+        for idx in reversed(range(len(sys.path))):
+            entry = sys.path[idx]
+            if entry.startswith("/") and os.path.isdir(entry):
+                sys.path.insert(idx, f"{self.path}/{entry.lstrip('/')}")
+        sys.path_importer_cache.clear()
+
+
+class ExtensionModuleFinder(MetaPathFinder):
+    """Find extension modules of a zip bundle, extracting their library
+
+    Packages imported from a zip file have their __path__ inside the zip,
+    where the regular finders can't load extension modules.
+    """
+
+    def __init__(self, bundle, so_paths):
+        self.bundle = bundle
+        self.modules = {}
+        for so_path in so_paths:
+            if (module_name := _get_extension_module_name(so_path)) is not None:
+                self.modules[module_name] = so_path
+
+    def find_spec(self, fullname, path=None, target=None):
+        so_path = self.modules.get(fullname)
+        if so_path is None:
+            return None
+        self.bundle.extract(so_path)
+        loader = ExtensionFileLoader(fullname, so_path)
+        return spec_from_file_location(fullname, so_path, loader=loader)
+
+
+class DuplicateModuleFinder(MetaPathFinder):
+    """Find modules of a zip bundle which are duplicates, extracting them
+
+    Duplicate files are not in the zip file, so zipimport can't find them.
+    They are extracted when imported, and packages keep their directory in the
+    zip file in their __path__.
+    """
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.modules = {}
+        for path in bundle.duplicates:
+            if (module_name := _get_module_name(path)) is not None:
+                self.modules[module_name] = path
+
+    def find_spec(self, fullname, path=None, target=None):
+        module_path = self.modules.get(fullname)
+        if module_path is None:
+            return None
+        self.bundle.extract(module_path)
+        dirname, _, basename = module_path.rpartition("/")
+        search_locations = None
+        if basename.startswith("__init__."):
+            search_locations = [f"{self.bundle.path}/{dirname.lstrip('/')}", dirname]
+        return spec_from_file_location(
+            fullname, module_path, submodule_search_locations=search_locations
+        )
+
+
+# Compression method of deflated files in zip archives
+_ZIP_DEFLATED = 8
+
+# Synchronous requests can't return binary data, which is instead returned as
+# text with the x-user-defined charset, mapping bytes 0x80-0xFF to U+F780-U+F7FF
+_X_USER_DEFINED = {0xF700 + byte: byte for byte in range(0x80, 0x100)}
+
+
+def _fetch_sync(url):
+    """Fetch a binary file synchronously, which only works in a browser"""
+    from js import XMLHttpRequest  # type: ignore[import-not-found]
+
+    request = XMLHttpRequest.new()
+    request.open("GET", url, False)
+    request.overrideMimeType("text/plain; charset=x-user-defined")
+    request.send(None)
+    if request.status >= 400:
+        raise OSError(f"Failed to fetch {url} (status {request.status})")
+    return request.responseText.translate(_X_USER_DEFINED).encode("latin-1")
+
+
+class LazyChunkImporter(MetaPathFinder):
+    """Fetch lazy chunks of the bundle when one of their modules is imported
+
+    The files of a chunk are extracted to their path in the file system, and
+    modules are then imported from there.
+    """
+
+    # Directory where chunks are written while their files are extracted
+    tmp_dir = Path("/tmp")
+
+    def __init__(self, chunk_list, chunks_url=CHUNKS_URL, fetch=_fetch_sync):
+        self.chunks_url = chunks_url
+        self.fetch = fetch
+        # Files of each chunk, and (chunk, path) of each module
+        self.chunks = {}
+        self.modules = {}
+        for line in chunk_list.splitlines():
+            chunk, path, module_name = line.split(",")
+            self.chunks.setdefault(chunk, []).append(path)
+            if module_name:
+                self.modules[module_name] = (chunk, path)
+        self.loaded = set()
+
+    def load_chunk(self, chunk, content=None):
+        """Extract the files of a chunk, fetching it unless content is given"""
+        if chunk in self.loaded:
+            return
+        if content is None:
+            content = self.fetch(f"{self.chunks_url}/{chunk}")
+        chunk_path = self.tmp_dir / chunk
+        chunk_path.write_bytes(content)
+        importer = zipimport.zipimporter(str(chunk_path))
+        for path in self.chunks[chunk]:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            Path(path).write_bytes(importer.get_data(path.lstrip("/")))
+        chunk_path.unlink()
+        invalidate_caches()
+        self.loaded.add(chunk)
+
+    async def load_all(self):
+        """Fetch all chunks that are not loaded yet, e.g. once the app started"""
+        from pyodide.http import pyfetch
+
+        for chunk in self.chunks:
+            if chunk not in self.loaded:
+                response = await pyfetch(f"{self.chunks_url}/{chunk}")
+                self.load_chunk(chunk, await response.bytes())
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in self.modules:
+            return None
+        chunk, module_path = self.modules[fullname]
+        self.load_chunk(chunk)
+        return spec_from_file_location(fullname, module_path)
+
+
+async def load_lazy_chunks():
+    """Fetch the lazy chunks of the bundle which were not imported yet
+
+    Modules in lazy chunks are fetched synchronously when imported, which only
+    works in a browser. Calling this after the application started fetches them
+    in advance.
+    """
+    if _lazy_chunk_importer is not None:
+        await _lazy_chunk_importer.load_all()
+
+
+class ZipStreamExtractor:
+    """Extract the files of a zip archive while it is being received
+
+    Files are extracted as soon as their data is received. This requires the
+    sizes of files to be in their local header, as in pyodide-pack bundles.
+    """
+
+    def __init__(self, extract_dir="/"):
+        self.extract_dir = Path(extract_dir)
+        self.buffer = bytearray()
+        self.names = []
+        self.done = False
+        # Number of files needed at startup, once read from the bundle
+        self.n_startup = None
+
+    def feed(self, data):
+        """Add received data, extracting the files that are now complete"""
+        self.buffer += data
+        pos = 0
+        while not self.done and len(self.buffer) - pos >= 30:
+            header = self.buffer[pos : pos + 30]
+            if header[:4] != b"PK\x03\x04":
+                # Central directory, after the last file
+                self.done = True
+                break
+            flags = int.from_bytes(header[6:8], "little")
+            if flags & 0x08:
+                raise ValueError("Zip files with data descriptors are not supported")
+            method = int.from_bytes(header[8:10], "little")
+            compressed_size = int.from_bytes(header[18:22], "little")
+            name_size = int.from_bytes(header[26:28], "little")
+            extra_size = int.from_bytes(header[28:30], "little")
+            start = pos + 30 + name_size + extra_size
+            if len(self.buffer) < start + compressed_size:
+                break
+            name = self.buffer[pos + 30 : pos + 30 + name_size].decode()
+            content = bytes(self.buffer[start : start + compressed_size])
+            if method == _ZIP_DEFLATED:
+                content = zlib.decompress(content, -zlib.MAX_WBITS)
+            self._extract(name, content)
+            pos = start + compressed_size
+        del self.buffer[:pos]
+
+    def _extract(self, name, content):
+        path = self.extract_dir / name
+        if name.endswith("/"):
+            path.mkdir(parents=True, exist_ok=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+        if name == STARTUP_NAME:
+            self.n_startup = int(content)
+        self.names.append(name)
+
+    @property
+    def startup_done(self):
+        """Whether all the files needed at startup were extracted"""
+        return self.done or (
+            self.n_startup is not None and len(self.names) >= self.n_startup
+        )
+
+
+async def _stream_response(response, extractor, startup_done):
+    body = response.js_response.body
+    if body is None or not hasattr(body, "getReader"):
+        # Streams are not supported (e.g. node-fetch in Node.js)
+        extractor.feed(await response.bytes())
+    else:
+        reader = body.getReader()
+        while not (chunk := await reader.read()).done:
+            extractor.feed(chunk.value.to_bytes())
+            if extractor.startup_done:
+                startup_done.set()
+    extractor.done = True
+    startup_done.set()
+
+
+async def stream_bundle(url, extract_dir="/"):
+    """Download the bundle, extracting its files while they are received
+
+    Files of the bundle are ordered by the time they were first accessed when
+    detecting the used files. This returns as soon as the files needed at
+    startup are extracted, so that the application can start while the rest of
+    the bundle is downloaded.
+
+    Returns
+    -------
+    task
+        the task extracting the rest of the bundle. It must be awaited before
+        importing modules that are not imported at startup.
+    """
+    from pyodide.http import pyfetch
+
+    response = await pyfetch(url)
+    extractor = ZipStreamExtractor(extract_dir)
+    startup_done = asyncio.Event()
+    task = asyncio.ensure_future(_stream_response(response, extractor, startup_done))
+    startup_task = asyncio.ensure_future(startup_done.wait())
+    try:
+        await asyncio.wait([task, startup_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        startup_task.cancel()
+    if task.done():
+        # Raise errors from the extraction, if any
+        task.result()
+    return task
+
+
+async def load_dynamic_libs(so_list_path=SO_LIST_PATH, lazy=False, bundle=None):
+    """Load the dynamic libraries of the bundle
+
+    Libraries are loaded one at a time, in the order they were loaded when
+    detecting the used files.
+
+    With lazy=True, libraries of extension modules are only loaded when these
+    modules are imported, see DynlibImportHook. With a ZipBundle, libraries
+    are extracted from it before being loaded.
+    """
+    from pyodide_js import _module
+
+    if bundle is None:
+        libs = _read_so_list(so_list_path.read_text())
+    else:
+        libs = _read_so_list((bundle.read(so_list_path) or b"").decode())
+        sys.meta_path.insert(0, ExtensionModuleFinder(bundle, [lib[0] for lib in libs]))
+
+    if lazy:
+        load_dynlib = _load_dynlib_sync
+        if bundle is not None:
+
+            def load_dynlib(path):
+                bundle.extract(path)
+                _load_dynlib_sync(path)
+
+        hook = DynlibImportHook(libs, load_dynlib=load_dynlib)
+        libs = [lib for lib in libs if lib[1] or lib[0] in hook.eager]
+        sys.meta_path.insert(0, hook)
+
+    for path, is_shared, _ in libs:
+        if bundle is not None:
+            bundle.extract(path)
+        await _module.API.loadDynlib(path, is_shared)
+
+
+def _get_bundle_path():
+    """Get the path of the zip file this module was imported from, or None"""
+    loader = __spec__.loader if __spec__ is not None else None
+    if isinstance(loader, zipimport.zipimporter):
+        return loader.archive
+    return None
+
+
+async def setup(
+    originals_url=None, lazy_dynlibs=False, bundle_path=None, chunks_url=None
+):
+    """Load dynamic libraries in the pyodide-pack bundle
+
+    Parameters
+    ----------
+    originals_url
+        URL of the original sources of files with functions removed by tree
+        shaking. Defaults to ORIGINALS_URL, relative to the page.
+    lazy_dynlibs
+        if True, load the libraries of extension modules when they are first
+        imported instead of at startup. Their WebAssembly modules are then
+        compiled synchronously, which browsers only allow for small modules
+        in the main thread, so this is best used in a web worker.
+    bundle_path
+        path of the bundle zip file, if it was not extracted. Modules are then
+        imported from the zip file, see ZipBundle. Defaults to the zip file
+        this module was imported from, if any (e.g. the stdlib zip file, for a
+        bundle merged with the stdlib).
+    chunks_url
+        URL of the directory with the lazy chunks of the bundle. Defaults to
+        CHUNKS_URL, relative to the page.
+    """
+    global ORIGINALS_URL, _lazy_chunk_importer
+
+    if originals_url is not None:
+        ORIGINALS_URL = originals_url
+
+    bundle = None
+    if bundle_path is None:
+        bundle_path = _get_bundle_path()
+    if bundle_path is not None:
+        bundle = ZipBundle(bundle_path)
+        bundle.mount()
+        duplicate_list = bundle.read(DUPLICATES_PATH)
+        if duplicate_list is not None:
+            bundle.duplicates = _read_duplicates(duplicate_list.decode())
+            sys.meta_path.insert(0, DuplicateModuleFinder(bundle))
+        bytecode_bundle = bundle.read(BYTECODE_BUNDLE_PATH)
+    elif BYTECODE_BUNDLE_PATH.exists():
+        bytecode_bundle = BYTECODE_BUNDLE_PATH.read_bytes()
+    else:
+        bytecode_bundle = None
+
+    if bundle is None:
+        # Files with the same content as another file are links to it
+        link_duplicates()
+
+    if bytecode_bundle is not None:
+        modules = marshal.loads(bytecode_bundle)
+        sys.meta_path.insert(0, BytecodeBundleImporter(modules))
+
+    if bundle is not None:
+        chunk_list = bundle.read(CHUNK_LIST_PATH)
+    elif CHUNK_LIST_PATH.exists():
+        chunk_list = CHUNK_LIST_PATH.read_bytes()
+    else:
+        chunk_list = None
+
+    if chunk_list is not None:
+        _lazy_chunk_importer = LazyChunkImporter(
+            chunk_list.decode(), chunks_url=chunks_url or CHUNKS_URL
+        )
+        sys.meta_path.insert(0, _lazy_chunk_importer)
+
+    await load_dynamic_libs(lazy=lazy_dynlibs, bundle=bundle)
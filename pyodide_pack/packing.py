@@ -0,0 +1,415 @@
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+import json
+import zipfile
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from pyodide_pack.archive import ZIP_DATE_TIME, ArchiveFile, write_raw
+from pyodide_pack.cache import ContentCache
+from pyodide_pack.chunks import get_source_path
+from pyodide_pack.config import PackConfig
+from pyodide_pack.dynamic_lib import DYLINK_HEAD_SIZE, DynamicLib, get_needed_libs
+from pyodide_pack.runtime_detection import PackageBundler, RuntimeResults
+
+# Packages with more (uncompressed) data than this are split in several tasks
+SHARD_SIZE = 16_000_000
+# Name of the file listing duplicate files, in the bundle
+DUPLICATES_NAME = "bundle-duplicates.json"
+
+
+@dataclass
+class PackTask:
+    """Files of an input archive to pack into a (partial) output zip file
+
+    Parameters
+    ----------
+    archive_idx
+        index of the input archive, used to merge results in a stable order
+    shard_idx
+        index of this task among the tasks for the same input archive
+    archive_path
+        path of the input archive
+    in_file_names
+        names of the files in the input archive to consider
+    out_path
+        path of the zip file to write
+    stdlib
+        if True, the input archive is the stdlib, and all files are written
+        with the same path. Otherwise, the output path of files (and whether
+        they are included) is determined with PackageBundler.process_path.
+    originals_dir
+        directory where to write the original source of Python files, used by
+        tree shaking stubs
+    """
+
+    archive_idx: int
+    shard_idx: int
+    archive_path: Path
+    in_file_names: list[str]
+    out_path: Path
+    stdlib: bool = False
+    originals_dir: Path | None = None
+
+
+@dataclass
+class PackResult:
+    """Result of a PackTask"""
+
+    task: PackTask
+    stats: dict[str, int]
+    dynamic_libs: list[DynamicLib] = field(default_factory=list)
+    bytecode: dict[str, tuple[bool, str, bytes]] = field(default_factory=dict)
+
+
+def writestr(fh_out: zipfile.ZipFile, name: str, content: bytes) -> None:
+    """Write a file to a zip archive, with a fixed timestamp"""
+    zinfo = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+    zinfo.compress_type = fh_out.compression
+    with fh_out.open(zinfo, "w") as fh:
+        fh.write(content)
+
+
+def write_member(
+    fh_out: zipfile.ZipFile,
+    archive: ArchiveFile,
+    bundler: PackageBundler,
+    in_file_name: str,
+    out_file_name: str | None = None,
+) -> None:
+    """Write a member of the input archive to the output zip file
+
+    Files that are not modified by the bundler are copied in their compressed
+    form, without being decompressed and compressed again.
+    """
+    if out_file_name is None:
+        out_file_name = in_file_name
+    # File paths starting with / fails to get correctly extracted
+    # in extract_archive in Pyodide
+    out_file_name = out_file_name.lstrip("/")
+
+    if not bundler.needs_processing(in_file_name) and (
+        raw := archive.read_raw(in_file_name)
+    ):
+        info, raw_stream = raw
+        bundler.process_raw_content(
+            in_file_name, info, lambda: archive.read_view(in_file_name)
+        )
+        write_raw(fh_out, out_file_name, info, raw_stream)
+        return
+
+    in_stream = archive.read(in_file_name)
+    if in_stream is None:
+        return
+    for name, out_stream in bundler.process_file(
+        in_file_name, out_file_name, in_stream
+    ):
+        writestr(fh_out, name, out_stream)
+
+
+def merge_zip(
+    fh_out: zipfile.ZipFile,
+    in_path: Path,
+    include: Callable[[str], bool] | None = None,
+) -> None:
+    """Append the files of a zip file written by run_pack_task to fh_out
+
+    If include is given, only files for which it returns True are appended.
+    """
+    with ArchiveFile(in_path, name=None) as archive:
+        for name in archive.namelist():
+            if include is not None and not include(name):
+                continue
+            raw = archive.read_raw(name)
+            assert raw is not None
+            write_raw(fh_out, name, *raw)
+
+
+def split_in_shards(
+    archive: ArchiveFile, in_file_names: list[str], shard_size: int = SHARD_SIZE
+) -> list[list[str]]:
+    """Split a list of files in contiguous shards of roughly shard_size bytes"""
+    shards: list[list[str]] = [[]]
+    size = 0
+    for name in in_file_names:
+        if size >= shard_size:
+            shards.append([])
+            size = 0
+        shards[-1].append(name)
+        size += archive.getmember(name).file_size
+    return shards
+
+
+def run_pack_task(
+    task: PackTask,
+    db: RuntimeResults,
+    config: PackConfig,
+    ast_cache: ContentCache | None = None,
+) -> PackResult:
+    """Pack the files of a task into its output zip file"""
+    bundler = PackageBundler(
+        db,
+        config=config,
+        ast_cache=ast_cache,
+        stdlib=task.stdlib,
+        originals_dir=task.originals_dir,
+    )
+    with (
+        ArchiveFile(task.archive_path, name=None) as archive,
+        zipfile.ZipFile(task.out_path, "w", compression=zipfile.ZIP_DEFLATED) as fh_out,
+    ):
+        for in_file_name in task.in_file_names:
+            out_file_name: str | None = in_file_name
+            n_dynamic_libs = len(bundler.dynamic_libs)
+            if not task.stdlib:
+                out_file_name = bundler.process_path(in_file_name)
+            if out_file_name is None:
+                continue
+            write_member(fh_out, archive, bundler, in_file_name, out_file_name)
+            if len(bundler.dynamic_libs) > n_dynamic_libs:
+                # Record the libraries needed by the dynamic library, to load
+                # it after them
+                head = archive.read_head(in_file_name, DYLINK_HEAD_SIZE) or b""
+                bundler.dynamic_libs[-1] = dataclasses.replace(
+                    bundler.dynamic_libs[-1], needed=get_needed_libs(head)
+                )
+    return PackResult(
+        task=task,
+        stats=bundler.stats,
+        dynamic_libs=bundler.dynamic_libs,
+        bytecode=bundler.bytecode,
+    )
+
+
+# State shared by all tasks executed in a worker process, so that it is
+# sent only once to each worker
+_worker_state: dict[str, Any] = {}
+
+
+def _init_worker(
+    db: RuntimeResults, config: PackConfig, ast_cache: ContentCache | None
+) -> None:
+    _worker_state.update(db=db, config=config, ast_cache=ast_cache)
+
+
+def _run_pack_task_in_worker(task: PackTask) -> PackResult:
+    return run_pack_task(task, **_worker_state)
+
+
+def run_pack_tasks(
+    tasks: list[PackTask],
+    db: RuntimeResults,
+    config: PackConfig,
+    ast_cache: ContentCache | None = None,
+    jobs: int = 1,
+) -> Iterator[PackResult]:
+    """Run packing tasks, yielding results as soon as they are done
+
+    With jobs > 1, tasks are executed in a pool of worker processes and results
+    are yielded in completion order. Otherwise they are executed in order in the
+    current process.
+    """
+    if jobs <= 1:
+        for task in tasks:
+            yield run_pack_task(task, db, config, ast_cache)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(db, config, ast_cache)
+    ) as executor:
+        # Submit larger tasks first, to reduce the time waiting for the last one
+        futures = [
+            executor.submit(_run_pack_task_in_worker, task)
+            for task in sorted(tasks, key=lambda task: -len(task.in_file_names))
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _sorted_results(results: list[PackResult]) -> list[PackResult]:
+    return sorted(results, key=lambda res: (res.task.archive_idx, res.task.shard_idx))
+
+
+def _open_results(
+    stack: ExitStack, results: list[PackResult]
+) -> dict[str, ArchiveFile]:
+    """Open the zip files of tasks, returning the archive of each file name"""
+    archives = {}
+    for result in results:
+        archive = stack.enter_context(ArchiveFile(result.task.out_path, name=None))
+        archives.update(dict.fromkeys(archive.namelist(), archive))
+    return archives
+
+
+def merge_results(
+    fh_out: zipfile.ZipFile,
+    results: list[PackResult],
+    include: Callable[[str], bool] | None = None,
+    order: list[str] | None = None,
+) -> None:
+    """Merge the zip files of tasks in a deterministic order
+
+    Files are merged in the order of tasks, or in the given order of file
+    names. If include is given, only files for which it returns True are merged.
+    """
+    if order is None:
+        for result in _sorted_results(results):
+            merge_zip(fh_out, result.task.out_path, include)
+        return
+
+    with ExitStack() as stack:
+        archives = _open_results(stack, results)
+        for name in order:
+            if name not in archives or (include is not None and not include(name)):
+                continue
+            raw = archives[name].read_raw(name)
+            assert raw is not None
+            write_raw(fh_out, name, *raw)
+
+
+def get_member_names(results: list[PackResult]) -> list[str]:
+    """Get the names of the files written by tasks, in merge order"""
+    names = []
+    for result in _sorted_results(results):
+        with zipfile.ZipFile(result.task.out_path) as fh:
+            names.extend(fh.namelist())
+    return names
+
+
+def _is_resolved_by_loader(name: str) -> bool:
+    """Check if the loader can create a duplicate file in all loading modes
+
+    When the bundle is imported from its zip file, duplicate modules and
+    dynamic libraries are extracted when needed. Other files, e.g. package
+    data read with importlib.resources, must be in the zip file.
+
+    Examples
+    --------
+    >>> _is_resolved_by_loader("lib/python3.11/site-packages/a/b.py")
+    True
+    >>> _is_resolved_by_loader("lib/python3.11/site-packages/a/_ext.so")
+    True
+    >>> _is_resolved_by_loader("lib/python3.11/site-packages/a/LICENSE")
+    False
+    >>> _is_resolved_by_loader("lib/python3.11/site-packages/a-1.0.data/b.py")
+    False
+    """
+    if name.endswith(".so"):
+        return True
+    # Same as _get_module_name in the loader
+    dirname, _, basename = f"/{name}".rpartition("/")
+    stem, _, suffix = basename.rpartition(".")
+    if (
+        "/site-packages/" not in dirname + "/"
+        or suffix not in ("py", "pyc")
+        or "__pycache__" in dirname
+    ):
+        return False
+    parts = dirname.partition("/site-packages/")[2].split("/")
+    if stem != "__init__":
+        parts.append(stem)
+    parts = [part for part in parts if part]
+    return bool(parts) and all(part.isidentifier() for part in parts)
+
+
+def find_duplicates(
+    results: list[PackResult], names: list[str]
+) -> tuple[dict[str, str], int]:
+    """Find files written by tasks with the same content as a previous file
+
+    Files are compared, in the order of names, by the hash of their content.
+    Empty files are not considered duplicates, nor files which the loader
+    can't create when the bundle is imported from its zip file (see
+    _is_resolved_by_loader).
+
+    Returns
+    -------
+    duplicates
+        mapping of the names of duplicate files to the name of the first file
+        with the same content
+    saved_size
+        total compressed size of the duplicate files
+    """
+    duplicates = {}
+    saved_size = 0
+    with ExitStack() as stack:
+        archives = _open_results(stack, results)
+        originals: dict[tuple[int, bytes], str] = {}
+        for name in names:
+            if name not in archives or not _is_resolved_by_loader(name):
+                continue
+            member = archives[name].getmember(name)
+            content = archives[name].read_view(name)
+            if not member.is_file or not member.file_size or content is None:
+                continue
+            key = (member.file_size, hashlib.sha256(content).digest())
+            if (original := originals.setdefault(key, name)) != name:
+                duplicates[name] = original
+                saved_size += member.compress_size
+    return duplicates, saved_size
+
+
+def dump_duplicates(duplicates: dict[str, str]) -> str:
+    """Serialize duplicate files as JSON, mapping paths to the original file
+
+    Paths may contain any character (e.g. commas in data files of wheels).
+
+    Examples
+    --------
+    >>> dump_duplicates({"b/a,b.txt": "a/a,b.txt"})
+    '{"/b/a,b.txt": "/a/a,b.txt"}'
+    """
+    return json.dumps(
+        {f"/{name}": f"/{original}" for name, original in duplicates.items()}
+    )
+
+
+def get_access_order(
+    names: list[str],
+    access_times: dict[str, float],
+    startup_time: float | None = None,
+) -> tuple[list[str], int]:
+    """Order bundle members by the time they were first accessed at runtime
+
+    Compiled .pyc files are ordered as their source. Files which were not
+    accessed come last, in their original order.
+
+    Returns
+    -------
+    order
+        ordered names of the members
+    n_startup
+        number of members first accessed before startup_time (or accessed at
+        all, if startup_time is None), which come first in the order
+
+    Examples
+    --------
+    >>> get_access_order(
+    ...     ["a.py", "b.pyc", "c.txt"], {"/a.py": 2.0, "/b.py": 1.0}, startup_time=1.5
+    ... )
+    (['b.pyc', 'a.py', 'c.txt'], 1)
+    """
+    times = {
+        name: access_times.get("/" + (get_source_path(name) or name)) for name in names
+    }
+    order = sorted(names, key=lambda name: (times[name] is None, times[name] or 0))
+    n_startup = sum(
+        time is not None and (startup_time is None or time <= startup_time)
+        for time in times.values()
+    )
+    return order, n_startup
+
+
+def sum_stats(results: list[PackResult]) -> dict[str, int]:
+    """Sum the bundler stats of several tasks"""
+    stats: dict[str, int] = {}
+    for result in results:
+        for key, val in result.stats.items():
+            stats[key] = stats.get(key, 0) + val
+    return stats
@@ -1,17 +1,36 @@
 from __future__ import annotations
 
+import copy
 import fnmatch
-import gzip
+import functools
 import json
+import marshal
 import os
+import re
+import zipfile
+from collections.abc import Callable
 from pathlib import Path
+from typing import Any
 
-from pyodide_pack._utils import (
-    match_suffix,
+from pyodide_pack._utils import SuffixIndex
+from pyodide_pack.ast_rewrite import TREE_SHAKE_FETCH, _rewrite_py_code
+from pyodide_pack.bytecode import (
+    compile_source,
+    compile_to_pyc,
+    get_module_name,
+    get_pyc_path,
 )
-from pyodide_pack.ast_rewrite import _rewrite_py_code
+from pyodide_pack.cache import ContentCache
+from pyodide_pack.compression import compressed_size
 from pyodide_pack.config import PackConfig
 from pyodide_pack.dynamic_lib import DynamicLib
+from pyodide_pack.size_estimation import GZIP_OVERHEAD
+
+COMPACT_FORMAT = "pyodide-pack-results"
+# Bump when the compact representation changes
+COMPACT_FORMAT_VERSION = 2
+# Header of the binary serialization, followed by the marshal format version
+_BINARY_MAGIC = b"PYPACKRR" + bytes([COMPACT_FORMAT_VERSION, marshal.version])
 
 
 class RuntimeResults(dict):
@@ -29,10 +48,36 @@ class RuntimeResults(dict):
         """
         return self["sys_modules"]["pathlib"].replace("/pathlib.py", "")
 
-    def get_imported_paths(self, strip_prefix: str | None = None):
+    @property
+    def python_version(self) -> tuple[int, int] | None:
+        """Python version of the runtime, from the name of the stdlib zip file
+
+        Examples
+        --------
+        >>> db = RuntimeResults(sys_modules={"pathlib": "/lib/python311.zip/pathlib.py"})
+        >>> db.python_version
+        (3, 11)
+        """
+        match = re.search(r"python(\d)(\d+)\.zip$", self.stdlib_prefix)
+        if match is None:
+            return None
+        return int(match.group(1)), int(match.group(2))
+
+    @functools.cached_property
+    def opened_files_index(self) -> SuffixIndex:
+        """Index of opened files, to match archive members against them"""
+        return SuffixIndex(self["opened_file_names"])
+
+    @functools.cached_property
+    def dynamic_libs_index(self) -> SuffixIndex:
+        """Index of loaded dynamic libraries, to match archive members against them"""
+        return SuffixIndex(self["dynamic_libs_map"])
+
+    def get_imported_paths(self, strip_prefix: str | None = None) -> list[str]:
         """Get the paths of all imported modules.
 
-        Optionally by stripping a prefix from the paths.
+        Optionally by stripping a prefix from the paths. Results are computed
+        once per prefix, as runtime results are not modified after loading.
 
         Examples
         --------
@@ -45,7 +90,13 @@ class RuntimeResults(dict):
         >>> db.get_imported_paths(strip_prefix="/lib/python311.zip")
         ['pathlib.py', 'os.py']
         """
-        imported_paths = list(self["sys_modules"].values()) + self["opened_file_names"]
+        cache = self.__dict__.setdefault("_imported_paths", {})
+        if strip_prefix in cache:
+            return list(cache[strip_prefix])
+
+        imported_paths = [
+            path for path in self["sys_modules"].values() if path is not None
+        ] + self["opened_file_names"]
         if strip_prefix is not None:
             imported_paths = [
                 path.replace(strip_prefix + "/", "")
@@ -54,13 +105,68 @@ class RuntimeResults(dict):
             ]
         # Remove duplicates, relying on the fact that dict preserves insertion order
         imported_paths = list(dict.fromkeys(imported_paths))
-        return imported_paths
+        cache[strip_prefix] = imported_paths
+        return list(imported_paths)
+
+    def get_executed_functions(self, path: str) -> set[tuple[int, str]] | None:
+        """Get the functions executed at runtime in a file
+
+        Returns a set of (first line, name) pairs, or None if executed functions
+        were not recorded during discovery.
+
+        Examples
+        --------
+        >>> db = RuntimeResults(executed_functions={"/lib/a.py": [[1, "f"]]})
+        >>> db.get_executed_functions("/lib/a.py")
+        {(1, 'f')}
+        >>> db.get_executed_functions("/lib/b.py")
+        set()
+        """
+        if "executed_functions" not in self:
+            return None
+        return {(line, name) for line, name in self["executed_functions"].get(path, [])}
+
+    def get_slow_modules(self, min_time: float) -> frozenset[str] | None:
+        """Get the modules which took at least min_time seconds to import
+
+        Returns None if import times were not recorded during discovery.
+
+        Examples
+        --------
+        >>> db = RuntimeResults(import_times={"numpy": 0.2, "json": 0.001})
+        >>> db.get_slow_modules(0.01)
+        frozenset({'numpy'})
+        """
+        if "import_times" not in self:
+            return None
+        return frozenset(
+            name
+            for name, duration in self["import_times"].items()
+            if duration >= min_time
+        )
+
+    @functools.cached_property
+    def stdlib_paths(self) -> frozenset[str]:
+        """Imported paths from the stdlib, relative to the stdlib prefix"""
+        return frozenset(self.get_imported_paths(strip_prefix=self.stdlib_prefix))
 
     @classmethod
     def from_json(cls, path) -> RuntimeResults:
         """Load the results.json with runtime execution information."""
         with open(path) as fh:
-            db = cls(json.load(fh))
+            return cls.from_json_string(fh.read())
+
+    @classmethod
+    def from_json_string(cls, content: str | bytes) -> RuntimeResults:
+        """Load runtime execution information from the content of a results.json
+
+        Both the output of the discovery script and the compact format
+        written by ``to_json(compact=True)`` are supported.
+        """
+        data = json.loads(content)
+        if "paths" in data and data.get("format") == COMPACT_FORMAT:
+            return cls.from_compact(data)
+        db = cls(data)
 
         db["opened_file_names"] = [
             path for path in db["opened_file_names"] if "__pycache__" not in path
@@ -80,18 +186,263 @@ class RuntimeResults(dict):
         }
         return db
 
-    def to_json(self, path: Path) -> None:
-        """Save the results.json with runtime execution information."""
+    def to_json(self, path: Path, compact: bool = False) -> None:
+        """Save the results.json with runtime execution information.
+
+        With compact=True, results are saved in the compact format of
+        :meth:`to_compact`, otherwise as human readable indented JSON.
+        """
         with open(path, "w") as fh:
-            json.dump(self, fh, indent=2, default=vars)
+            if compact:
+                json.dump(self.to_compact(), fh, separators=(",", ":"))
+            else:
+                json.dump(self, fh, indent=2, default=vars)
+
+    def to_compact(self) -> dict[str, Any]:
+        """Convert to a compact representation with an interned path table
+
+        Each distinct path is stored once in the "paths" table, and is
+        referenced by its index everywhere else.
+
+        Examples
+        --------
+        >>> db = RuntimeResults(
+        ...     opened_file_names=["/lib/a.py", "/lib/b.py"],
+        ...     sys_modules={"a": "/lib/a.py"})
+        >>> db.to_compact()
+        {'format': 'pyodide-pack-results', 'version': 2,
+         'paths': ['/lib/a.py', '/lib/b.py'],
+         'data': {'opened_file_names': [0, 1], 'sys_modules': {'a': 0}}}
+        >>> RuntimeResults.from_compact(db.to_compact()) == db
+        True
+        """
+        table = PathTable()
+        data: dict[str, Any] = {}
+        for key, val in self.items():
+            match key:
+                case "opened_file_names":
+                    data[key] = [table.intern(path) for path in val]
+                case "sys_modules":
+                    data[key] = {
+                        name: None if path is None else table.intern(path)
+                        for name, path in val.items()
+                    }
+                case "load_dyn_lib_calls":
+                    data[key] = [
+                        [table.intern(obj["path"]), obj["global"]] for obj in val
+                    ]
+                case "dl_accessed_symbols":
+                    data[key] = [
+                        [table.intern(path), symbols] for path, symbols in val.items()
+                    ]
+                case "dynamic_libs_map":
+                    data[key] = [
+                        [table.intern(dll.path), dll.load_order, dll.shared]
+                        for dll in val.values()
+                    ]
+                case "opened_file_times":
+                    data[key] = [
+                        [table.intern(path), time] for path, time in val.items()
+                    ]
+                case "executed_functions":
+                    data[key] = [
+                        [table.intern(path), functions]
+                        for path, functions in val.items()
+                    ]
+                case "LDSO_loaded_libs_by_handle":
+                    # Libraries by handle, with their path as "name"
+                    data[key] = [
+                        [
+                            handle,
+                            None if "name" not in lib else table.intern(lib["name"]),
+                            {name: el for name, el in lib.items() if name != "name"},
+                        ]
+                        for handle, lib in val.items()
+                    ]
+                case _:
+                    data[key] = val
+        return {
+            "format": COMPACT_FORMAT,
+            "version": COMPACT_FORMAT_VERSION,
+            "paths": table.paths,
+            "data": data,
+        }
+
+    @classmethod
+    def from_compact(cls, compact: dict[str, Any]) -> RuntimeResults:
+        """Load results from the compact representation of :meth:`to_compact`"""
+        if (
+            compact.get("format") != COMPACT_FORMAT
+            or compact.get("version") != COMPACT_FORMAT_VERSION
+        ):
+            raise ValueError("Unsupported format for runtime results")
+        paths = compact["paths"]
+        db = cls()
+        for key, val in compact["data"].items():
+            match key:
+                case "opened_file_names":
+                    db[key] = [paths[idx] for idx in val]
+                case "sys_modules":
+                    db[key] = {
+                        name: None if idx is None else paths[idx]
+                        for name, idx in val.items()
+                    }
+                case "load_dyn_lib_calls":
+                    db[key] = [
+                        {"path": paths[idx], "global": is_global}
+                        for idx, is_global in val
+                    ]
+                case "dl_accessed_symbols":
+                    db[key] = {paths[idx]: symbols for idx, symbols in val}
+                case "dynamic_libs_map":
+                    db[key] = {
+                        paths[idx]: DynamicLib(
+                            paths[idx], load_order=load_order, shared=shared
+                        )
+                        for idx, load_order, shared in val
+                    }
+                case "opened_file_times":
+                    db[key] = {paths[idx]: time for idx, time in val}
+                case "executed_functions":
+                    db[key] = {paths[idx]: functions for idx, functions in val}
+                case "LDSO_loaded_libs_by_handle":
+                    db[key] = {
+                        handle: lib if idx is None else {"name": paths[idx], **lib}
+                        for handle, idx, lib in val
+                    }
+                case _:
+                    db[key] = val
+        return db
+
+    def to_bytes(self) -> bytes:
+        """Serialize to a binary format, to be loaded with :meth:`from_bytes`
+
+        This uses the compact representation serialized with marshal, and is
+        meant for caching results, not for long term storage.
+        """
+        return _BINARY_MAGIC + marshal.dumps(self.to_compact())
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> RuntimeResults:
+        """Load results serialized with :meth:`to_bytes`
+
+        Raises a ValueError if the content was not produced by to_bytes
+        with the same Python version.
+        """
+        if not content.startswith(_BINARY_MAGIC):
+            raise ValueError("Unsupported format for runtime results")
+        try:
+            compact = marshal.loads(content[len(_BINARY_MAGIC) :])
+        except (EOFError, TypeError) as e:
+            raise ValueError("Unsupported format for runtime results") from e
+        return cls.from_compact(compact)
+
+
+class PathTable:
+    """A table of interned paths, each identified by its index in the table
+
+    Examples
+    --------
+    >>> table = PathTable()
+    >>> table.intern("/lib/a.py"), table.intern("/lib/b.py"), table.intern("/lib/a.py")
+    (0, 1, 0)
+    >>> table.paths
+    ['/lib/a.py', '/lib/b.py']
+    """
+
+    def __init__(self) -> None:
+        self.paths: list[str] = []
+        self._ids: dict[str, int] = {}
+
+    def intern(self, path: str) -> int:
+        """Get the ID of a path, adding it to the table if necessary"""
+        if (path_id := self._ids.get(path)) is None:
+            path_id = self._ids[path] = len(self.paths)
+            self.paths.append(path)
+        return path_id
+
+
+def merge_raw_results(results: list[dict[str, Any]]) -> dict[str, Any]:
+    """Merge the raw results of several executions of the discovery script
+
+    The output includes every file, module, dynamic library and symbol accessed
+    by any of the executions, in the order they were first accessed.
+
+    Examples
+    --------
+    >>> merge_raw_results([
+    ...     {"opened_file_names": ["a.py", "b.py"],
+    ...      "load_dyn_lib_calls": [{"path": "c.so", "global": False}],
+    ...      "dl_accessed_symbols": {"c.so": ["f"]}},
+    ...     {"opened_file_names": ["b.py", "d.py"],
+    ...      "load_dyn_lib_calls": [{"path": "c.so", "global": True}],
+    ...      "dl_accessed_symbols": {"c.so": ["g", "f"]}},
+    ... ])
+    {'opened_file_names': ['a.py', 'b.py', 'd.py'],
+     'load_dyn_lib_calls': [{'path': 'c.so', 'global': True}],
+     'dl_accessed_symbols': {'c.so': ['f', 'g']}}
+    """
+    merged: dict[str, Any] = {}
+    for res in results:
+        for key, val in res.items():
+            if key not in merged:
+                merged[key] = copy.deepcopy(val)
+                continue
+            current = merged[key]
+            if key == "load_dyn_lib_calls":
+                calls = {obj["path"]: obj for obj in current}
+                for obj in val:
+                    if obj["path"] in calls:
+                        # A library loaded globally in any scenario stays global
+                        calls[obj["path"]]["global"] |= obj["global"]
+                    else:
+                        calls[obj["path"]] = dict(obj)
+                merged[key] = list(calls.values())
+            elif key == "executed_functions":
+                for path, functions in val.items():
+                    merged_functions = current.get(path, []) + functions
+                    current[path] = [
+                        list(el) for el in dict.fromkeys(map(tuple, merged_functions))
+                    ]
+            elif key == "opened_file_times":
+                # Files only opened by later executions are ordered after others
+                offset = max(current.values(), default=0)
+                for path, time in val.items():
+                    current.setdefault(path, offset + time)
+            elif key == "import_times":
+                for name, duration in val.items():
+                    current[name] = max(current.get(name, 0), duration)
+            elif key == "dl_accessed_symbols":
+                for lib_name, symbols in val.items():
+                    merged_symbols = (current.get(lib_name) or []) + (symbols or [])
+                    current[lib_name] = list(dict.fromkeys(merged_symbols))
+            elif isinstance(val, list):
+                merged[key] = list(dict.fromkeys(current + val))
+            elif isinstance(val, dict):
+                merged[key] = {**val, **current}
+            # For other values (e.g. stdlib_prefix), keep the first one
+    return merged
 
 
 class PackageBundler:
     """Only include necessary files for a given package."""
 
-    def __init__(self, db: RuntimeResults, config: PackConfig):
+    def __init__(
+        self,
+        db: RuntimeResults,
+        config: PackConfig,
+        ast_cache: ContentCache | None = None,
+        stdlib: bool = False,
+        originals_dir: Path | None = None,
+    ):
         self.db = db
         self.config = config
+        self.ast_cache = ast_cache
+        # The stdlib is loaded with zipimport from python_stdlib.zip
+        self.stdlib = stdlib
+        # Where to write the original source of Python files, for the stubs of
+        # functions removed by tree shaking to fetch them
+        self.originals_dir = originals_dir
         self.stats = {
             "py_in": 0,
             "so_in": 0,
@@ -101,9 +452,13 @@ class PackageBundler:
             "other_out": 0,
             "fh_out": 0,
             "size_out": 0,
-            "size_gzip_out": 0,
+            # Compressed size for each transfer encoding, as size_<encoding>_out
+            **{f"size_{encoding}_out": 0 for encoding in config.encodings},
         }
         self.dynamic_libs: list[DynamicLib] = []
+        # Bytecode of modules to include in the bytecode bundle, see
+        # bytecode.dump_bytecode_bundle
+        self.bytecode: dict[str, tuple[bool, str, bytes]] = {}
 
     def process_path(self, in_file_name: str) -> str | None:
         """Process a path, returning the output path if it should be included."""
@@ -119,15 +474,13 @@ class PackageBundler:
                 stats["other_in"] += 1
 
         out_file_name = None
-        if out_file_name := match_suffix(
-            list(db["dynamic_libs_map"].keys()), in_file_name
-        ):
+        if out_file_name := db.dynamic_libs_index.match(in_file_name):
             stats["so_out"] += 1
             # Get the dynamic library path while preserving order
             dll = db["dynamic_libs_map"][out_file_name]
             self.dynamic_libs.append(dll)
 
-        elif out_file_name := match_suffix(db["opened_file_names"], in_file_name):
+        elif out_file_name := db.opened_files_index.match(in_file_name):
             match extension:
                 case ".so":
                     out_file_name = None
@@ -152,18 +505,137 @@ class PackageBundler:
                     self.dynamic_libs.append(dll)
         return out_file_name
 
-    def process_content(self, in_file_name: str, content: bytes) -> bytes | None:
-        """Process both the input filename and the file contents"""
+    def needs_processing(self, in_file_name: str) -> bool:
+        """Whether process_content may modify the content of this file.
+
+        Files that are not modified can be copied to the output bundle
+        without being decompressed.
+        """
+        return Path(in_file_name).suffix == ".py"
+
+    def process_raw_content(
+        self,
+        in_file_name: str,
+        info: zipfile.ZipInfo,
+        read: Callable[[], bytes | memoryview | None] | None = None,
+    ) -> None:
+        """Account for a file that is copied as is in its compressed form.
+
+        The gzip size is known from the deflated size. For other encodings, the
+        content is read with read() to be compressed.
+        """
         stats = self.stats
         stats["fh_out"] += 1
+        stats["size_out"] += info.file_size
+        content = None
+        for encoding in self.config.encodings:
+            if encoding == "gzip":
+                stats["size_gzip_out"] += info.compress_size + GZIP_OVERHEAD
+                continue
+            if content is None and read is not None:
+                content = read()
+            if content is not None:
+                stats[f"size_{encoding}_out"] += compressed_size(content, encoding)
 
-        extension = Path(in_file_name).suffix
-        out_content = content
-        if extension == ".py":
-            out_content = _rewrite_py_code(
-                content.decode(), file_name=in_file_name, py_config=self.config.py
-            ).encode()
-        stats["size_out"] += len(out_content)
-        stats["size_gzip_out"] += len(gzip.compress(out_content))
+    def get_runtime_path(self, out_file_name: str) -> str:
+        """Get the path of an output file in Pyodide"""
+        if self.stdlib:
+            return f"{self.db.stdlib_prefix}/{out_file_name}"
+        return "/" + out_file_name.lstrip("/")
+
+    def _rewrite_content(
+        self, in_file_name: str, content: bytes, out_file_name: str
+    ) -> bytes:
+        if Path(in_file_name).suffix != ".py":
+            return content
+        runtime_path = self.get_runtime_path(out_file_name)
+        executed_functions = None
+        if self.config.py.tree_shake:
+            executed_functions = self.db.get_executed_functions(runtime_path)
+        if (
+            executed_functions is not None
+            and self.config.py.tree_shake == TREE_SHAKE_FETCH
+            and self.originals_dir is not None
+        ):
+            original_path = self.originals_dir / runtime_path.lstrip("/")
+            original_path.parent.mkdir(parents=True, exist_ok=True)
+            original_path.write_bytes(content)
+        module = get_module_name(runtime_path)
+        slow_modules = None
+        if (
+            module is not None
+            and module[0].split(".")[0] in self.config.py.defer_imports
+        ):
+            slow_modules = self.db.get_slow_modules(
+                self.config.py.defer_imports_min_time
+            )
+        return _rewrite_py_code(
+            content.decode(),
+            file_name=in_file_name,
+            py_config=self.config.py,
+            cache=self.ast_cache,
+            executed_functions=executed_functions,
+            runtime_path=runtime_path,
+            module=module,
+            slow_modules=slow_modules,
+        ).encode()
 
+    def _add_output_stats(self, content: bytes) -> None:
+        stats = self.stats
+        stats["fh_out"] += 1
+        stats["size_out"] += len(content)
+        for encoding in self.config.encodings:
+            stats[f"size_{encoding}_out"] += compressed_size(content, encoding)
+
+    def process_content(
+        self, in_file_name: str, content: bytes, out_file_name: str | None = None
+    ) -> bytes | None:
+        """Process both the input filename and the file contents"""
+        if out_file_name is None:
+            out_file_name = in_file_name
+        out_content = self._rewrite_content(in_file_name, content, out_file_name)
+        self._add_output_stats(out_content)
         return out_content
+
+    def process_file(
+        self, in_file_name: str, out_file_name: str, content: bytes
+    ) -> list[tuple[str, bytes]]:
+        """Process the file contents, returning the files to write to the output
+
+        Compared to process_content, this also compiles Python files to bytecode
+        if enabled in the config, in which case the output may contain a .pyc
+        file with or without the original .py file.
+        """
+        py_config = self.config.py
+        if Path(in_file_name).suffix != ".py" or not py_config.py_compile:
+            out_content = self.process_content(in_file_name, content, out_file_name)
+            return [] if out_content is None else [(out_file_name, out_content)]
+
+        source = self._rewrite_content(in_file_name, content, out_file_name)
+        runtime_path = self.get_runtime_path(out_file_name)
+        outputs = []
+        if py_config.py_compile_keep_source:
+            outputs.append((out_file_name, source))
+
+        module = None if self.stdlib else get_module_name(runtime_path)
+        try:
+            if py_config.py_compile_bundle and module is not None:
+                module_name, is_package = module
+                code = compile_source(source, runtime_path)
+                self.bytecode[module_name] = (is_package, runtime_path, code)
+                self._add_output_stats(code)
+            else:
+                pyc_path = get_pyc_path(
+                    out_file_name,
+                    keep_source=py_config.py_compile_keep_source,
+                    zipimport=self.stdlib,
+                )
+                outputs.append((pyc_path, compile_to_pyc(source, runtime_path)))
+        except SyntaxError:
+            # Files that fail to compile (e.g. test files with invalid syntax) are
+            # shipped as source, so the error is raised when importing them.
+            outputs = [(out_file_name, source)]
+
+        for _, out_content in outputs:
+            self._add_output_stats(out_content)
+        return outputs
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from pyodide_pack.cache import JSONCache, file_digest, get_cache_dir
+from pyodide_pack.compression import ESTIMATE_LEVELS, compressed_size
+
+if TYPE_CHECKING:
+    from pyodide_pack.archive import ArchiveFile, ArchiveMember
+
+# Size of the gzip header (10 bytes) and trailer (CRC32 + size, 8 bytes) around
+# a raw deflate stream, as produced by gzip.compress
+GZIP_OVERHEAD = 18
+
+# Below this amount of data to compress, starting a process pool costs more
+# than it saves.
+PARALLEL_MIN_SIZE = 4_000_000
+
+
+def _gzip_size_from_zipinfo(info: zipfile.ZipInfo | ArchiveMember) -> int | None:
+    """Estimate the gzip size of a zip member from its metadata.
+
+    Zip members compressed with deflate contain the same stream as a gzip file
+    minus the header and trailer. Returns None if the metadata can't be used.
+
+    Examples
+    --------
+    >>> info = zipfile.ZipInfo("a.py")
+    >>> info.compress_type, info.compress_size = zipfile.ZIP_DEFLATED, 6
+    >>> _gzip_size_from_zipinfo(info)
+    24
+    >>> info.compress_type = zipfile.ZIP_STORED
+    >>> _gzip_size_from_zipinfo(info) is None
+    True
+    """
+    if info.compress_type != zipfile.ZIP_DEFLATED:
+        return None
+    return info.compress_size + GZIP_OVERHEAD
+
+
+def _compressed_sizes(file_path: Path, names: list[str], encoding: str = "gzip") -> int:
+    """Compute the total compressed size for some members of an archive.
+
+    This is executed in worker processes, so it re-opens the archive
+    rather than receiving file contents.
+    """
+    from pyodide_pack.archive import ArchiveFile
+
+    size = 0
+    with ArchiveFile(file_path, name=None) as archive:
+        for name in names:
+            stream = archive.read_view(name)
+            if stream is None:
+                continue
+            size += compressed_size(stream, encoding)
+    return size
+
+
+def _split_in_chunks(members: list[tuple[str, int]], n_chunks: int) -> list[list[str]]:
+    """Split (name, size) pairs into chunks of roughly equal total size.
+
+    Examples
+    --------
+    >>> _split_in_chunks([("a", 10), ("b", 1), ("c", 9), ("d", 1)], 2)
+    [['a', 'd'], ['b', 'c']]
+    """
+    chunks: list[list[str]] = [[] for _ in range(n_chunks)]
+    chunk_sizes = [0] * n_chunks
+    for name, size in sorted(members, key=lambda x: -x[1]):
+        idx = chunk_sizes.index(min(chunk_sizes))
+        chunks[idx].append(name)
+        chunk_sizes[idx] += size
+    return [sorted(chunk) for chunk in chunks if chunk]
+
+
+def _compute_compressed_size(
+    archive: ArchiveFile,
+    encoding: str = "gzip",
+    max_workers: int | None = None,
+    parallel_min_size: int = PARALLEL_MIN_SIZE,
+) -> int:
+    """Compute the compressed size of an archive, using metadata when possible."""
+    size = 0
+    # Members for which we need to run the compression, with their uncompressed size
+    to_compress: list[tuple[str, int]] = []
+    for member in archive.infolist():
+        if not member.is_file:
+            continue
+        if (
+            encoding == "gzip"
+            and (estimate := _gzip_size_from_zipinfo(member)) is not None
+        ):
+            size += estimate
+        else:
+            to_compress.append((member.name, member.file_size))
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    uncompressed_size = sum(el[1] for el in to_compress)
+    if max_workers <= 1 or uncompressed_size < parallel_min_size:
+        return size + _compressed_sizes(
+            archive.file_path, [el[0] for el in to_compress], encoding
+        )
+
+    chunks = _split_in_chunks(to_compress, max_workers)
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        futures = [
+            executor.submit(_compressed_sizes, archive.file_path, chunk, encoding)
+            for chunk in chunks
+        ]
+        size += sum(future.result() for future in futures)
+    return size
+
+
+def estimate_gzip_size(
+    archive: ArchiveFile,
+    max_workers: int | None = None,
+    parallel_min_size: int = PARALLEL_MIN_SIZE,
+    use_cache: bool = True,
+) -> int:
+    """Estimate the total size of archive members once gzip compressed.
+
+    See :func:`estimate_compressed_size`.
+    """
+    return estimate_compressed_size(
+        archive, "gzip", max_workers, parallel_min_size, use_cache
+    )
+
+
+def estimate_compressed_size(
+    archive: ArchiveFile,
+    encoding: str = "gzip",
+    max_workers: int | None = None,
+    parallel_min_size: int = PARALLEL_MIN_SIZE,
+    use_cache: bool = True,
+) -> int:
+    """Estimate the total size of archive members once compressed.
+
+    For gzip, deflated zip members are accounted for with their compressed size
+    from the zip metadata. Other members (stored zip members, tar archives), or
+    all members for other encodings, are compressed at the level of
+    :data:`pyodide_pack.compression.ESTIMATE_LEVELS`, in parallel over a process
+    pool for large archives. Results are cached on disk by archive hash, so
+    that re-running on the same Pyodide distribution does not recompute them.
+
+    Parameters
+    ----------
+    archive
+        archive to estimate the size for
+    encoding
+        transfer encoding, see :data:`pyodide_pack.compression.CONTENT_ENCODINGS`
+    max_workers
+        maximum number of worker processes. Defaults to the number of CPUs.
+    parallel_min_size
+        minimal amount of data to compress (in bytes) to use a process pool
+    use_cache
+        if True read and store results in the on-disk cache
+    """
+    if not use_cache:
+        return _compute_compressed_size(
+            archive, encoding, max_workers, parallel_min_size
+        )
+
+    cache = JSONCache(
+        get_cache_dir() / f"archive-{encoding}-{ESTIMATE_LEVELS[encoding]}-sizes.json"
+    )
+    key = file_digest(archive.file_path)
+    if (size := cache.get(key)) is not None:
+        return size
+    size = _compute_compressed_size(archive, encoding, max_workers, parallel_min_size)
+    cache.set(key, size)
+    return size
@@ -20,3 +20,11 @@ def example_zipfile_xml() -> bytes:
     stream.seek(0)
 
     return stream.read()
+
+
+@pytest.fixture(autouse=True)
+def pyodide_pack_cache_dir(tmp_path_factory, monkeypatch):
+    """Isolate the on-disk caches used by pyodide-pack for each test."""
+    cache_dir = tmp_path_factory.mktemp("pyodide-pack-cache")
+    monkeypatch.setenv("PYODIDE_PACK_CACHE_DIR", str(cache_dir))
+    return cache_dir
@@ -4,7 +4,7 @@ import zipfile
 
 import pytest
 
-from pyodide_pack.archive import ArchiveFile
+from pyodide_pack.archive import ArchiveFile, write_raw
 
 
 @pytest.mark.parametrize("format_", ["tar", "zip"])
@@ -53,3 +53,132 @@ def test_archive_filter_to_zip(tmp_path):
         tmp_path / "test_stripped.zip", lambda x: x != "b.py"
     )
     assert ar_stripped.namelist() == ["a.py", "c.py", "d.py"]
+
+
+def test_archive_raw_copy(tmp_path, monkeypatch):
+    file_path = tmp_path / "test.whl"
+    content = bytes(range(256)) * 100
+    with zipfile.ZipFile(file_path, "w", compression=zipfile.ZIP_DEFLATED) as fh:
+        fh.writestr("a/b.so", content, compress_type=zipfile.ZIP_DEFLATED)
+        fh.writestr("a/c.txt", b"stored", compress_type=zipfile.ZIP_STORED)
+        # Members written in streaming mode use a data descriptor
+        with fh.open("a/d.py", "w") as fh_el:
+            fh_el.write(b"import os\n" * 100)
+
+    ar = ArchiveFile(file_path, name="test")
+    assert ar.read_raw("a/c.txt") is None
+
+    out_path = tmp_path / "out.zip"
+    with zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_DEFLATED) as fh_out:
+        for in_name, out_name in [("a/b.so", "lib/b.so"), ("a/d.py", "lib/d.py")]:
+            raw = ar.read_raw(in_name)
+            assert raw is not None
+            info, raw_stream = raw
+            assert len(raw_stream) == info.compress_size
+            write_raw(fh_out, out_name, info, raw_stream)
+        fh_out.writestr("other.txt", b"other")
+
+    with zipfile.ZipFile(out_path) as fh:
+        assert fh.testzip() is None
+        assert fh.namelist() == ["lib/b.so", "lib/d.py", "other.txt"]
+        assert fh.read("lib/b.so") == content
+        assert fh.read("lib/d.py") == b"import os\n" * 100
+        assert (
+            fh.getinfo("lib/b.so").compress_size == ar.getmember("a/b.so").compress_size
+        )
+
+    # Members are decompressed when written to a zip file with stored members
+    with zipfile.ZipFile(out_path, "w") as fh_out:
+        write_raw(fh_out, "lib/b.so", *ar.read_raw("a/b.so"))  # type: ignore[misc]
+    with zipfile.ZipFile(out_path) as fh:
+        assert fh.testzip() is None
+        assert fh.getinfo("lib/b.so").compress_type == zipfile.ZIP_STORED
+        assert fh.read("lib/b.so") == content
+
+    # Without the private zipfile attributes, members are recompressed
+    monkeypatch.setattr(
+        "pyodide_pack.archive._ZIPFILE_WRITE_ATTRS", ("_missing_attribute",)
+    )
+    with zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_DEFLATED) as fh_out:
+        write_raw(fh_out, "lib/b.so", *ar.read_raw("a/b.so"))  # type: ignore[misc]
+    with zipfile.ZipFile(out_path) as fh:
+        assert fh.testzip() is None
+        assert fh.getinfo("lib/b.so").compress_type == zipfile.ZIP_DEFLATED
+        assert fh.read("lib/b.so") == content
+
+
+def test_archive_read_head(tmp_path):
+    file_path = tmp_path / "test.whl"
+    content = bytes(range(256)) * 100
+    with zipfile.ZipFile(file_path, "w") as fh:
+        fh.writestr("a/b.so", content, compress_type=zipfile.ZIP_DEFLATED)
+        fh.writestr("a/c.so", content, compress_type=zipfile.ZIP_STORED)
+        fh.writestr("a/d/", b"")
+
+    ar = ArchiveFile(file_path, name="test")
+    assert ar.read_head("a/b.so", 1000) == content[:1000]
+    assert ar.read_head("a/c.so", 1000) == content[:1000]
+    assert ar.read_head("a/b.so", 100_000) == content
+    assert ar.read_head("a/d/", 1000) is None
+
+
+def test_archive_raw_copy_tar(tmp_path):
+    file_path = tmp_path / "test.tar"
+    with tarfile.open(file_path, "w") as fh:
+        tarinfo = tarfile.TarInfo(name="a/b.py")
+        tarinfo.size = 4
+        fh.addfile(tarinfo, fileobj=io.BytesIO(b"test"))
+
+    assert ArchiveFile(file_path, name="test").read_raw("a/b.py") is None
+
+
+def test_archive_index_tar(tmp_path):
+    file_path = tmp_path / "test.tar"
+    with tarfile.open(file_path, "w") as fh:
+        tarinfo = tarfile.TarInfo(name="a")
+        tarinfo.type = tarfile.DIRTYPE
+        fh.addfile(tarinfo)
+        for idx in range(10):
+            content = f"x = {idx}".encode()
+            tarinfo = tarfile.TarInfo(name=f"a/{idx}.py")
+            tarinfo.size = len(content)
+            fh.addfile(tarinfo, fileobj=io.BytesIO(content))
+        tarinfo = tarfile.TarInfo(name="a/link.py")
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = "3.py"
+        fh.addfile(tarinfo)
+
+    with ArchiveFile(file_path, name="test") as ar:
+        assert ar.namelist() is ar.namelist()
+        assert len(ar.namelist()) == 12
+        assert ar.read("a") is None
+        assert ar.read("a/7.py") == b"x = 7"
+        assert ar.read("a/link.py") == b"x = 3"
+        member = ar.getmember("a/7.py")
+        assert member.file_size == 5
+        assert member.CRC is None
+        # Reads from tar archives are slices of the memory-mapped file
+        view = ar.read_view("a/7.py")
+        assert view is not None
+        assert view.obj is ar._buffer
+        del view
+        # The symlink is accounted as a file, as it would be when extracted
+        assert ar.total_size() == 11 * 5
+
+
+def test_archive_index_zip(tmp_path):
+    file_path = tmp_path / "test.zip"
+    with zipfile.ZipFile(file_path, "w") as fh:
+        fh.writestr("a/", b"")
+        fh.writestr("a/b.py", b"stored", compress_type=zipfile.ZIP_STORED)
+        fh.writestr("a/c.py", b"deflated" * 10, compress_type=zipfile.ZIP_DEFLATED)
+
+    with ArchiveFile(file_path, name="test") as ar:
+        assert ar.namelist() == ["a/", "a/b.py", "a/c.py"]
+        assert ar.read("a/") is None
+        assert ar.read("a/b.py") == b"stored"
+        assert ar.read("a/c.py") == b"deflated" * 10
+        assert (
+            ar.getmember("a/c.py").CRC
+            == zipfile.ZipFile(file_path).getinfo("a/c.py").CRC
+        )
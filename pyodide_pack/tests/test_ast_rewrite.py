@@ -1,14 +1,21 @@
 import ast
+import importlib
+import zipfile
 from pathlib import Path
 from textwrap import dedent
 
 import hypothesis.strategies as st
+import pytest
 from hypothesis import given, settings
 
+from pyodide_pack import ast_rewrite
 from pyodide_pack.ast_rewrite import (
+    _rewrite_py_code,
     _strip_module_docstring,
     _StripDocstringsTransformer,
 )
+from pyodide_pack.cache import ContentCache
+from pyodide_pack.config import PyPackConfig
 from pyodide_pack.testing import _get_stdlib_module_paths
 
 
@@ -144,8 +151,440 @@ def test_cli_minify(tmp_path):
     input_dir.mkdir()
     (input_dir / "pathlib.py").write_text(Path(pathlib.__file__).read_text())
 
-    main(input_dir, strip_docstrings=False, strip_module_docstrings=False)
+    main(
+        input_dir,
+        strip_docstrings=False,
+        strip_module_docstrings=False,
+        minify_names=False,
+        cache=True,
+        jobs=1,
+        stream=False,
+        incremental=True,
+    )
     output_path = tmp_path / "input_dir_stripped.zip"
     assert output_path.exists()
     # There is at least a 10% size reduction, though this test and API needs to be rewritten
     assert (input_dir / "pathlib.py").stat().st_size > 1.1 * output_path.stat().st_size
+
+
+def test_rewrite_py_code_cache(tmp_path):
+    cache = ContentCache(tmp_path)
+    code = 'def foo():\n    """This is a docstring"""\n    return 1\n'
+    py_config = PyPackConfig()
+    expected = "def foo():\n    return 1"
+    assert _rewrite_py_code(code, "a.py", py_config, cache=cache) == expected
+    assert len(list(tmp_path.glob("*/*"))) == 1
+
+    # Cached results are used for the same content and config
+    (cache_entry,) = tmp_path.glob("*/*")
+    cache_entry.write_text("cached")
+    assert _rewrite_py_code(code, "b.py", py_config, cache=cache) == "cached"
+
+    # but not if the config changes
+    py_config = PyPackConfig(strip_module_docstrings=False)
+    assert _rewrite_py_code(code, "a.py", py_config, cache=cache) == code.strip("\n")
+    assert len(list(tmp_path.glob("*/*"))) == 2
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_cli_minify_incremental(tmp_path, monkeypatch, stream):
+    input_dir = tmp_path / "input_dir"
+    (input_dir / "pkg").mkdir(parents=True)
+    (input_dir / "pkg" / "a.py").write_text('def a():\n    """Docstring"""\n')
+    (input_dir / "pkg" / "b.py").write_text("# comment\nb = 1\n")
+    (input_dir / "pkg" / "data.txt").write_text("data")
+
+    minified = []
+    minify_file = ast_rewrite._minify_file
+
+    def _minify_file(path):
+        minified.append(path.name)
+        return minify_file(path)
+
+    monkeypatch.setattr(ast_rewrite, "_minify_file", _minify_file)
+
+    def run_minify():
+        ast_rewrite.main(
+            input_dir,
+            strip_docstrings=True,
+            strip_module_docstrings=True,
+            minify_names=False,
+            cache=False,
+            jobs=1,
+            stream=stream,
+            incremental=True,
+        )
+        zip_path = tmp_path / "input_dir_stripped_no_docstrings.zip"
+        with zipfile.ZipFile(zip_path) as fh:
+            return {name: fh.read(name) for name in fh.namelist()}
+
+    assert run_minify() == {
+        "pkg/a.py": b"def a():\n    pass",
+        "pkg/b.py": b"b = 1",
+        "pkg/data.txt": b"data",
+    }
+    assert minified == ["a.py", "b.py"]
+    assert (tmp_path / "input_dir_stripped_no_docstrings").exists() != stream
+
+    # Only changed files are processed again
+    minified.clear()
+    (input_dir / "pkg" / "b.py").write_text("# comment\nb = 20\n")
+    (input_dir / "pkg" / "data.txt").unlink()
+    assert run_minify() == {
+        "pkg/a.py": b"def a():\n    pass",
+        "pkg/b.py": b"b = 20",
+    }
+    assert minified == ["b.py"]
+
+
+def test_cli_minify_jobs(tmp_path):
+    input_dir = tmp_path / "input_dir"
+    input_dir.mkdir()
+    for idx in range(10):
+        (input_dir / f"m{idx}.py").write_text(f"# comment\nx = {idx}\n")
+
+    ast_rewrite.main(
+        input_dir,
+        strip_docstrings=False,
+        strip_module_docstrings=False,
+        minify_names=False,
+        cache=False,
+        jobs=2,
+        stream=True,
+        incremental=False,
+    )
+    with zipfile.ZipFile(tmp_path / "input_dir_stripped.zip") as fh:
+        assert fh.namelist() == sorted(f"m{idx}.py" for idx in range(10))
+        assert fh.read("m3.py") == b"x = 3"
+
+
+TREE_SHAKE_CODE = dedent(
+    """
+    import functools
+
+
+    @functools.cache
+    def used(a, b=2):
+        return used_helper(a) + b
+
+
+    def used_helper(a):
+        return a
+
+
+    def unused(a, *args, c=3, **kwargs):
+        x = a + sum(args) + c
+        return x + len(kwargs)
+
+
+    class A:
+        def method(self):
+            y = 1
+            return super().method() + y
+    """
+)
+
+
+def test_tree_shake_raise():
+    py_config = PyPackConfig(tree_shake=2)
+    executed = {(5, "used"), (10, "used_helper")}
+    out = _rewrite_py_code(
+        TREE_SHAKE_CODE, "a.py", py_config, executed_functions=executed
+    )
+    namespace: dict = {}
+    exec(out, namespace)
+    assert namespace["used"](1) == 3
+    with pytest.raises(RuntimeError, match="unused .a.py:14. was removed"):
+        namespace["unused"](1)
+    with pytest.raises(RuntimeError, match="method"):
+        namespace["A"]().method()
+
+    # Tree shaking is disabled if executed functions were not recorded
+    assert "RuntimeError" not in _rewrite_py_code(TREE_SHAKE_CODE, "a.py", py_config)
+
+
+def test_tree_shake_fetch(tmp_path, monkeypatch):
+    import io
+    import sys
+    import types
+
+    from pyodide_pack.loader import pyodide_pack_loader
+
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "a.py").write_text(TREE_SHAKE_CODE)
+    pyodide_http = types.ModuleType("pyodide.http")
+    pyodide_http.open_url = lambda url: io.StringIO(Path(url).read_text())  # type: ignore[attr-defined]
+    monkeypatch.setitem(sys.modules, "pyodide", types.ModuleType("pyodide"))
+    monkeypatch.setitem(sys.modules, "pyodide.http", pyodide_http)
+    monkeypatch.setitem(sys.modules, "pyodide_pack_loader", pyodide_pack_loader)
+    monkeypatch.setattr(pyodide_pack_loader, "ORIGINALS_URL", str(tmp_path))
+
+    py_config = PyPackConfig(tree_shake=1)
+    out = _rewrite_py_code(
+        TREE_SHAKE_CODE,
+        "a.py",
+        py_config,
+        executed_functions={(5, "used"), (10, "used_helper")},
+        runtime_path="/lib/a.py",
+    )
+    assert "x = a" not in out
+    # Methods using super() can't be re-created from their code, and are kept
+    assert "y = 1" in out
+    namespace: dict = {}
+    exec(out, namespace)
+    assert namespace["unused"](1, 2, c=4, d=5) == 8
+
+
+def test_defer_imports(tmp_path, monkeypatch):
+    import sys
+
+    pkg_dir = tmp_path / "pp_defer_pkg"
+    pkg_dir.mkdir()
+    (pkg_dir / "slow.py").write_text("def norm(x):\n    return abs(x)\n")
+    files = {
+        "__init__.py": "from .slow import norm\nfrom .utils import f\n",
+        "utils.py": dedent(
+            """
+            import json
+            from .slow import norm
+
+
+            def f(x):
+                \"\"\"Docstring\"\"\"
+                return norm(x)
+
+
+            DEFAULT = json.dumps(1)
+            """
+        ),
+    }
+    py_config = PyPackConfig(strip_docstrings=False, strip_module_docstrings=False)
+    slow_modules = frozenset({"pp_defer_pkg.slow", "json"})
+    for name, code in files.items():
+        if name == "__init__.py":
+            module = ("pp_defer_pkg", True)
+        else:
+            module = ("pp_defer_pkg.utils", False)
+        out = _rewrite_py_code(
+            code, name, py_config, module=module, slow_modules=slow_modules
+        )
+        (pkg_dir / name).write_text(out)
+
+    # json is used when the module is executed and can't be deferred
+    assert "import json\n" in (pkg_dir / "utils.py").read_text()
+
+    monkeypatch.syspath_prepend(str(tmp_path))
+    try:
+        pp_defer_pkg = importlib.import_module("pp_defer_pkg")
+
+        assert "pp_defer_pkg.slow" not in sys.modules
+        assert pp_defer_pkg.f(-2) == 2
+        assert "pp_defer_pkg.slow" in sys.modules
+        # Deferred imports are still available as module attributes
+        assert pp_defer_pkg.norm(-1) == 1
+        assert pp_defer_pkg.utils.norm(-1) == 1
+        with pytest.raises(AttributeError, match="has no attribute 'missing'"):
+            pp_defer_pkg.missing  # noqa: B018
+    finally:
+        for name in list(sys.modules):
+            if name.startswith("pp_defer_pkg"):
+                del sys.modules[name]
+
+
+def test_optimize():
+    code = dedent(
+        """
+        from typing import TYPE_CHECKING, Any
+
+        if TYPE_CHECKING:
+            from collections.abc import Sequence
+
+        X: int = 1
+
+
+        def f(a: "Sequence", b: int = 2) -> Any:
+            assert a, "empty"
+            c: int = len(a) + b
+            if __debug__:
+                print("debug")
+            else:
+                c += 1
+            return c
+
+
+        def g():
+            if not __debug__:
+                return
+            yield 1
+
+
+        class A:
+            x: int = 1
+        """
+    )
+    out_1 = _rewrite_py_code(code, "a.py", PyPackConfig(optimize=1))
+    for removed in ["assert", "TYPE_CHECKING", "import Sequence", "__debug__", "print"]:
+        assert removed not in out_1
+    # Annotations are only removed with optimize=2
+    assert "c: int" in out_1
+
+    out_2 = _rewrite_py_code(code, "a.py", PyPackConfig(optimize=2))
+    assert "def f(a, b=2):" in out_2
+    assert "X = 1" in out_2
+    assert "c = len(a) + b" in out_2
+    # Class annotations are kept
+    assert "x: int = 1" in out_2
+
+    namespace: dict = {}
+    exec(out_2, namespace)
+    assert namespace["f"]([1]) == 4
+    assert list(namespace["g"]()) == []
+
+
+def test_optimize_keep_introspected_annotations():
+    code = dedent(
+        """
+        import dataclasses
+
+
+        def f(a: int) -> int:
+            assert a
+            return a
+        """
+    )
+    out = _rewrite_py_code(code, "a.py", PyPackConfig(optimize=2))
+    assert "def f(a: int) -> int:" in out
+    assert "assert" not in out
+
+
+def test_optimize_keep_registered_annotations():
+    # The dispatch function is defined in another module
+    code = dedent(
+        """
+        from .base import process
+
+
+        @process.register
+        def _(a: int, *args: str) -> int:
+            return a
+
+
+        @process.register(str)
+        async def _(a: str) -> str:
+            return a
+
+
+        def f(a: int) -> int:
+            return a
+        """
+    )
+    out = _rewrite_py_code(code, "a.py", PyPackConfig(optimize=2))
+    assert "def _(a: int, *args: str) -> int:" in out
+    assert "async def _(a: str) -> str:" in out
+    assert "def f(a):" in out
+
+
+def test_minify_names():
+    code = dedent(
+        """
+        def f(values, /, *args, scale=1, **kwargs):
+            total = 0
+            for value in values:
+                total += value * scale
+
+            def add(offset):
+                nonlocal total
+                total += offset
+
+            add(len(args) + len(kwargs))
+            try:
+                1 / 0
+            except ZeroDivisionError as error:
+                message = str(error)
+            return total, message, [total * item for item in values]
+
+
+        def g(values):
+            result = [len(value) for value in values]
+            return locals()
+
+
+        def h():
+            counter = 1
+
+            class A:
+                counter = 2
+
+                def get(self):
+                    return counter
+
+            return A().get() + A.counter
+        """
+    )
+    out = _rewrite_py_code(code, "a.py", PyPackConfig(minify_names=True))
+    # Parameters, including positional-only and variadic ones, and nested
+    # functions are kept
+    assert "def f(values, /, *args, scale=1, **kwargs):" in out
+    assert "def add(offset):" in out
+    for name in ["total", "error", "message", "item"]:
+        assert name not in out.split("def g")[0]
+    # Local names of functions using locals() are kept
+    assert "result = [len(" in out
+    # Names shadowed in a nested class body are kept
+    assert "counter = 1" in out
+
+    namespace: dict = {}
+    exec(out, namespace)
+    assert namespace["f"]([1, 2], 3, scale=2, x=1) == (8, "division by zero", [8, 16])
+    assert namespace["g"](["ab"]) == {"values": ["ab"], "result": [2]}
+    assert namespace["h"]() == 3
+
+
+def test_minify_names_stdlib():
+    import gzip
+    import statistics
+
+    code = Path(statistics.__file__).read_text()
+    config = PyPackConfig(strip_docstrings=True, strip_module_docstrings=True)
+    out = _rewrite_py_code(code, "statistics.py", config)
+    out_minified = _rewrite_py_code(
+        code, "statistics.py", config.model_copy(update={"minify_names": True})
+    )
+    assert len(out_minified) < 0.97 * len(out)
+    assert len(gzip.compress(out_minified.encode())) < len(gzip.compress(out.encode()))
+
+    namespace: dict = {}
+    exec(compile(out_minified, "statistics.py", "exec"), namespace)
+    assert namespace["median"]([3, 1, 2]) == 2
+    assert namespace["stdev"]([1.0, 2.0, 3.0]) == 1.0
+
+
+def test_rewrite_deeply_nested_code():
+    # Too deep for recursive AST transformers and ast.unparse
+    terms = " + ".join(f"f({i})" for i in range(1500))
+    code = dedent(
+        f'''
+        def f(value):
+            """Docstring"""
+            assert value >= 0
+            return value
+
+
+        def total():
+            """Docstring"""
+            return {terms}
+        '''
+    )
+    config = PyPackConfig(optimize=1, minify_names=True)
+    out = _rewrite_py_code(code, "a.py", config)
+    assert "Docstring" not in out
+    assert "assert" not in out
+
+    namespace: dict = {}
+    exec(out, namespace)
+    assert namespace["total"]() == sum(range(1500))
+
+    # Expressions in f-strings are not unparsed separately, files with deep ones
+    # are left unchanged
+    code = "a = 1\nx = f'{" + "+".join(["a"] * 1200) + "}'\n"
+    assert _rewrite_py_code(code, "a.py", config) == code
@@ -0,0 +1,46 @@
+import importlib
+import marshal
+import sys
+
+import pytest
+
+from pyodide_pack.bytecode import (
+    check_python_version,
+    compile_source,
+    dump_bytecode_bundle,
+)
+from pyodide_pack.loader.pyodide_pack_loader import BytecodeBundleImporter
+
+
+def test_check_python_version():
+    check_python_version(sys.version_info[:2])
+    with pytest.raises(ValueError, match="requires to run pyodide pack"):
+        check_python_version((2, 7))
+    with pytest.raises(ValueError, match="Python unknown"):
+        check_python_version(None)
+
+
+def test_bytecode_bundle_importer(tmp_path):
+    pkg_path = str(tmp_path / "pp_bundle_pkg" / "__init__.py")
+    mod_path = str(tmp_path / "pp_bundle_pkg" / "mod.py")
+    modules = {
+        "pp_bundle_pkg": (True, pkg_path, compile_source(b"x = 1", pkg_path)),
+        "pp_bundle_pkg.mod": (
+            False,
+            mod_path,
+            compile_source(b"from . import x\ny = x + 1", mod_path),
+        ),
+    }
+    importer = BytecodeBundleImporter(marshal.loads(dump_bytecode_bundle(modules)))
+    sys.meta_path.insert(0, importer)
+    try:
+        mod = importlib.import_module("pp_bundle_pkg.mod")
+        assert mod.y == 2
+        assert mod.__file__ == mod_path
+        assert sys.modules["pp_bundle_pkg"].__path__ == [
+            str(tmp_path / "pp_bundle_pkg")
+        ]
+    finally:
+        sys.meta_path.remove(importer)
+        sys.modules.pop("pp_bundle_pkg.mod", None)
+        sys.modules.pop("pp_bundle_pkg", None)
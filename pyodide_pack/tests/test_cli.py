@@ -1,6 +1,107 @@
+import zipfile
 from subprocess import check_output
 
+import pytest
+
 
 def test_cli_help():
     output = check_output(["pyodide", "pack", "--help"]).decode("utf-8")
     assert "Create a minimal bundle" in output
+
+
+def test_discovery_cache_key(tmp_path):
+    from pyodide_pack.cli import _discovery_cache_key
+
+    js_template_path = tmp_path / "discovery.js"
+    js_template_path.write_text("main();")
+    package_dir = tmp_path / "pyodide"
+    package_dir.mkdir()
+    (package_dir / "package.json").write_text('{"version": "0.24.1"}')
+    (package_dir / "pyodide-lock.json").write_text("{}")
+
+    key = _discovery_cache_key(["import a"], ["a"], package_dir, js_template_path)
+    assert key == _discovery_cache_key(
+        ["import a"], ["a"], package_dir, js_template_path
+    )
+    assert key != _discovery_cache_key(
+        ["import a", "import b"], ["a"], package_dir, js_template_path
+    )
+    assert key != _discovery_cache_key(
+        ["import b"], ["a"], package_dir, js_template_path
+    )
+    assert key != _discovery_cache_key(
+        ["import a"], ["b"], package_dir, js_template_path
+    )
+    assert key != _discovery_cache_key(
+        ["import a"], ["a"], package_dir, js_template_path, trace_functions=True
+    )
+    assert key != _discovery_cache_key(
+        ["import a"], ["a"], package_dir, js_template_path, time_imports=True
+    )
+    assert key != _discovery_cache_key(
+        ["import a"], ["a"], package_dir, js_template_path, code_splitting=True
+    )
+
+    (package_dir / "package.json").write_text('{"version": "0.25.0"}')
+    key_version = _discovery_cache_key(
+        ["import a"], ["a"], package_dir, js_template_path
+    )
+    assert key_version != key
+
+    (package_dir / "pyodide-lock.json").write_text('{"packages": {}}')
+    assert key_version != _discovery_cache_key(
+        ["import a"], ["a"], package_dir, js_template_path
+    )
+
+
+def test_output_sizes(tmp_path):
+    from pyodide_pack.cli import _estimated_sizes, _precompressed_msg
+    from pyodide_pack.compression import compressed_size, write_precompressed
+
+    content = b"import os\n" * 100
+    path = tmp_path / "bundle.zip"
+    with zipfile.ZipFile(path, "w") as fh:
+        fh.writestr("a.py", content)
+        fh.writestr("b.py", content)
+    # Sizes are estimated file by file, as for input packages
+    assert _estimated_sizes([path, path], ["gzip"]) == {
+        "gzip": 4 * compressed_size(content, "gzip")
+    }
+
+    assert _precompressed_msg([path], []) == ""
+    write_precompressed(path, ["gzip"])
+    size = (tmp_path / "bundle.zip.gz").stat().st_size
+    assert _precompressed_msg([path], ["gzip"]) == (
+        f", precompressed: {size / 1e6:.2f} MB"
+    )
+
+
+def test_get_validation_modes():
+    from pyodide_pack.cli import _get_validation_modes
+    from pyodide_pack.config import PackConfig
+
+    assert _get_validation_modes(PackConfig()) == ["extract"]
+    config = PackConfig(
+        code_splitting=True,
+        merge_stdlib=True,
+        validation_modes=["merged_stdlib", "lazy_chunks", "zip_import", "stream"],
+    )
+    assert _get_validation_modes(config) == [
+        "extract",
+        "merged_stdlib",
+        "lazy_chunks",
+        "zip_import",
+        "stream",
+    ]
+
+    config = PackConfig(validation_modes=["lazy_chunks"])
+    with pytest.raises(ValueError, match="needs code_splitting"):
+        _get_validation_modes(config)
+    config = PackConfig(validation_modes=["merged_stdlib"])
+    with pytest.raises(ValueError, match="needs merge_stdlib"):
+        _get_validation_modes(config)
+    # Modes passed on the command line are not validated by pydantic
+    config = PackConfig()
+    config.validation_modes = ["zip"]  # type: ignore[list-item]
+    with pytest.raises(ValueError, match="Unknown validation mode 'zip'"):
+        _get_validation_modes(config)
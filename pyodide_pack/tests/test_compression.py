@@ -0,0 +1,87 @@
+import gzip
+import urllib.request
+
+import pytest
+
+from pyodide_pack._utils import spawn_web_server
+from pyodide_pack.compression import (
+    compress,
+    find_precompressed,
+    get_precompressed_path,
+    write_precompressed,
+)
+
+
+def test_compress():
+    content = b"import os\n" * 100
+    assert gzip.decompress(compress(content, "gzip")) == content
+    # The output doesn't depend on the time
+    assert compress(content, "gzip") == compress(content, "gzip")
+    with pytest.raises(ValueError, match="Unknown encoding"):
+        compress(content, "lzma")
+
+
+@pytest.mark.parametrize(
+    "encoding, module_name", [("brotli", "brotli"), ("zstd", "zstandard")]
+)
+def test_compress_optional(encoding, module_name):
+    module = pytest.importorskip(module_name)
+    content = b"import os\n" * 100
+    if module_name == "zstandard":
+        decompressed = module.ZstdDecompressor().decompress(compress(content, encoding))
+    else:
+        decompressed = module.decompress(compress(content, encoding))
+    assert decompressed == content
+
+
+def test_write_precompressed(tmp_path):
+    path = tmp_path / "bundle.zip"
+    path.write_bytes(b"a" * 1000)
+
+    sizes = write_precompressed(path, ["gzip"])
+    gz_path = get_precompressed_path(path, "gzip")
+    assert gz_path.name == "bundle.zip.gz"
+    assert sizes == {"gzip": gz_path.stat().st_size}
+    assert gzip.decompress(gz_path.read_bytes()) == b"a" * 1000
+
+    # Precompressed files of other encodings are removed
+    assert write_precompressed(path, []) == {}
+    assert not gz_path.exists()
+
+    write_precompressed(path, ["gzip"])
+    path.unlink()
+    write_precompressed(path, ["gzip"])
+    assert not gz_path.exists()
+
+
+def test_find_precompressed(tmp_path):
+    path = tmp_path / "bundle.zip"
+    path.write_bytes(b"a" * 1000)
+    (tmp_path / "bundle.zip.gz").write_bytes(compress(b"a" * 1000, "gzip"))
+    (tmp_path / "bundle.zip.br").write_bytes(b"")
+
+    assert find_precompressed(str(path), "") is None
+    assert find_precompressed(str(path), "deflate") is None
+    assert find_precompressed(str(path), "gzip") == (f"{path}.gz", "gzip")
+    # brotli is preferred, unless it's refused
+    assert find_precompressed(str(path), "gzip, deflate, br") == (f"{path}.br", "br")
+    assert find_precompressed(str(path), "GZIP, br;q=0") == (f"{path}.gz", "gzip")
+    assert find_precompressed(str(path), "zstd") is None
+
+
+def test_web_server_precompressed(tmp_path):
+    content = b"a" * 1000
+    (tmp_path / "bundle.zip").write_bytes(content)
+    write_precompressed(tmp_path / "bundle.zip", ["gzip"])
+
+    with spawn_web_server(dist_dir=str(tmp_path)) as (hostname, port, _):
+        url = f"http://{hostname}:{port}/bundle.zip"
+        request = urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})
+        with urllib.request.urlopen(request) as response:
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert response.headers["Content-Type"] == "application/zip"
+            assert gzip.decompress(response.read()) == content
+
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["Content-Encoding"] is None
+            assert response.read() == content
@@ -0,0 +1,302 @@
+import asyncio
+import importlib
+import importlib.resources
+import io
+import json
+import sys
+import types
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from pyodide_pack.chunks import dump_chunk_list
+from pyodide_pack.loader import pyodide_pack_loader
+
+
+def test_load_dynamic_libs(tmp_path, monkeypatch):
+    events = []
+
+    async def load_dynlib(path, is_shared):
+        events.append(("start", path, is_shared))
+        await asyncio.sleep(0)
+        events.append(("end", path, is_shared))
+
+    api = types.SimpleNamespace(loadDynlib=load_dynlib)
+    pyodide_js = types.ModuleType("pyodide_js")
+    pyodide_js._module = types.SimpleNamespace(API=api)  # type: ignore[attr-defined]
+    monkeypatch.setitem(sys.modules, "pyodide_js", pyodide_js)
+
+    so_list = tmp_path / "bundle-so-list.txt"
+    so_list.write_text("/libblas.so,True,\n/a.so,False,libblas.so\n/b.so,False,\n")
+    asyncio.run(pyodide_pack_loader.load_dynamic_libs(so_list))
+    # Libraries are loaded one at a time, in order
+    assert events == [
+        ("start", "/libblas.so", True),
+        ("end", "/libblas.so", True),
+        ("start", "/a.so", False),
+        ("end", "/a.so", False),
+        ("start", "/b.so", False),
+        ("end", "/b.so", False),
+    ]
+
+    # Lists without the needed libraries, from older bundles
+    events.clear()
+    so_list.write_text("/a.so,False\n/b.so,True\n")
+    asyncio.run(pyodide_pack_loader.load_dynamic_libs(so_list))
+    assert events[::2] == [("start", "/a.so", False), ("start", "/b.so", True)]
+
+
+def test_dynlib_import_hook():
+    site_packages = "/lib/python3.11/site-packages"
+    libs = [
+        ("/usr/lib/libopenblas.so", True, ["libgfortran.so"]),
+        (f"{site_packages}/a/libgfortran.so", False, []),
+        (f"{site_packages}/a/_core.cpython-311-wasm32-emscripten.so", False, []),
+        (f"{site_packages}/a/b/_ext.so", False, ["libdep.so"]),
+        (f"{site_packages}/a/libdep.so", False, []),
+        (f"{site_packages}/a.libs/libffi_helper.so", False, []),
+    ]
+    loaded = []
+    hook = pyodide_pack_loader.DynlibImportHook(libs, load_dynlib=loaded.append)
+    # Libraries needed by shared libraries, or not needed by extension modules
+    assert hook.eager == {
+        f"{site_packages}/a/libgfortran.so",
+        f"{site_packages}/a.libs/libffi_helper.so",
+    }
+    assert hook.find_spec("os") is None
+    assert loaded == []
+
+    assert hook.find_spec("a.b._ext") is None
+    assert loaded == [f"{site_packages}/a/libdep.so", f"{site_packages}/a/b/_ext.so"]
+    # Libraries are loaded only once
+    hook.find_spec("a.b._ext")
+    assert len(loaded) == 2
+
+    hook.find_spec("a._core")
+    assert loaded[2:] == [f"{site_packages}/a/_core.cpython-311-wasm32-emscripten.so"]
+
+
+def test_zip_bundle(tmp_path, monkeypatch):
+    site_packages = tmp_path / "lib" / "site-packages"
+    site_packages.mkdir(parents=True)
+    so_path = f"{site_packages}/zb_pkg/_ext.so"
+    bundle_path = tmp_path / "bundle.zip"
+    with zipfile.ZipFile(bundle_path, "w") as fh:
+        fh.writestr(f"{site_packages}/zb_pkg/__init__.py".lstrip("/"), "a = 1")
+        fh.writestr(f"{site_packages}/zb_pkg/data.txt".lstrip("/"), "data")
+        fh.writestr(so_path.lstrip("/"), b"\0asm")
+        fh.writestr("bundle-so-list.txt", f"{so_path},False,\n")
+
+    bundle = pyodide_pack_loader.ZipBundle(bundle_path)
+    assert bundle.read("/bundle-so-list.txt") == f"{so_path},False,\n".encode()
+    assert bundle.read("/missing.txt") is None
+    with pytest.raises(FileNotFoundError, match="missing.txt is not in the bundle"):
+        bundle.extract(tmp_path / "missing.txt")
+
+    monkeypatch.setattr(sys, "path", [str(site_packages)])
+    monkeypatch.setattr(sys, "meta_path", list(sys.meta_path))
+    monkeypatch.delitem(sys.modules, "zb_pkg", raising=False)
+    bundle.mount()
+    assert sys.path == [f"{bundle_path}/{str(site_packages).lstrip('/')}"] + [
+        str(site_packages)
+    ]
+    # Modules and package data are read from the zip file, without extracting it
+    zb_pkg = importlib.import_module("zb_pkg")
+    assert zb_pkg.a == 1
+    assert importlib.resources.files(zb_pkg).joinpath("data.txt").read_text() == (
+        "data"
+    )
+    assert not (site_packages / "zb_pkg").exists()
+
+    # Extension modules are extracted when they are imported
+    finder = pyodide_pack_loader.ExtensionModuleFinder(bundle, [so_path])
+    assert finder.find_spec("zb_pkg.other") is None
+    spec = finder.find_spec("zb_pkg._ext")
+    assert spec.origin == so_path
+    assert (site_packages / "zb_pkg" / "_ext.so").read_bytes() == b"\0asm"
+
+
+def test_link_duplicates(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "LICENSE").write_text("MIT")
+    duplicate_list = tmp_path / "bundle-duplicates.json"
+    duplicate_list.write_text(
+        json.dumps(
+            {
+                f"{tmp_path}/b/LICENSE": f"{tmp_path}/a/LICENSE",
+                f"{tmp_path}/b/a,b.py": f"{tmp_path}/a/later.py",
+            }
+        )
+    )
+    pyodide_pack_loader.link_duplicates(duplicate_list)
+    assert (tmp_path / "b" / "LICENSE").read_text() == "MIT"
+    # Links are created before the original files are extracted
+    assert not (tmp_path / "b" / "a,b.py").exists()
+    (tmp_path / "a" / "later.py").write_text("a = 1")
+    assert (tmp_path / "b" / "a,b.py").read_text() == "a = 1"
+
+    # Existing files are kept
+    pyodide_pack_loader.link_duplicates(duplicate_list)
+    pyodide_pack_loader.link_duplicates(tmp_path / "missing.txt")
+
+
+def test_zip_bundle_duplicates(tmp_path, monkeypatch):
+    site_packages = tmp_path / "lib" / "site-packages"
+    site_packages.mkdir(parents=True)
+    bundle_path = tmp_path / "bundle.zip"
+    with zipfile.ZipFile(bundle_path, "w") as fh:
+        fh.writestr(f"{site_packages}/da_pkg/__init__.py".lstrip("/"), "a = 1")
+        fh.writestr(f"{site_packages}/db_pkg/other.py".lstrip("/"), "b = 2")
+
+    bundle = pyodide_pack_loader.ZipBundle(bundle_path)
+    bundle.duplicates = {
+        f"{site_packages}/db_pkg/__init__.py": f"{site_packages}/da_pkg/__init__.py",
+        f"{site_packages}/db_pkg/data.txt": f"{site_packages}/da_pkg/__init__.py",
+    }
+    assert bundle.read(f"{site_packages}/db_pkg/data.txt") == b"a = 1"
+
+    monkeypatch.setattr(sys, "path", [str(site_packages)])
+    monkeypatch.setattr(sys, "meta_path", list(sys.meta_path))
+    for name in ["da_pkg", "db_pkg", "db_pkg.other"]:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    bundle.mount()
+    finder = pyodide_pack_loader.DuplicateModuleFinder(bundle)
+    assert finder.modules == {"db_pkg": f"{site_packages}/db_pkg/__init__.py"}
+    sys.meta_path.insert(0, finder)
+
+    # Duplicate modules are extracted, with other modules of their package
+    # imported from the zip file
+    db_pkg = importlib.import_module("db_pkg")
+    assert db_pkg.a == 1
+    assert db_pkg.__file__ == f"{site_packages}/db_pkg/__init__.py"
+    assert importlib.import_module("db_pkg.other").b == 2
+    assert not (site_packages / "db_pkg" / "other.py").exists()
+
+
+def test_get_bundle_path(tmp_path, monkeypatch):
+    assert pyodide_pack_loader._get_bundle_path() is None
+
+    # A bundle merged with the stdlib, with the loader at its root
+    stdlib_path = tmp_path / "python311.zip"
+    loader_source = Path(pyodide_pack_loader.__file__).read_text()
+    with zipfile.ZipFile(stdlib_path, "w") as fh:
+        fh.writestr("zipped_pp_loader.py", loader_source)
+    monkeypatch.setattr(sys, "path", [str(stdlib_path)] + sys.path)
+    monkeypatch.delitem(sys.modules, "zipped_pp_loader", raising=False)
+    zipped_loader = importlib.import_module("zipped_pp_loader")
+    monkeypatch.delitem(sys.modules, "zipped_pp_loader")
+    assert zipped_loader._get_bundle_path() == str(stdlib_path)
+
+
+def test_lazy_chunk_importer(tmp_path, monkeypatch):
+    site_packages = tmp_path / "site-packages"
+    site_packages.mkdir()
+    chunk = "pyodide-package-bundle-lazy-lc_pkg.zip"
+    chunk_content = io.BytesIO()
+    with zipfile.ZipFile(chunk_content, "w") as fh:
+        fh.writestr(f"{site_packages}/lc_pkg/__init__.py".lstrip("/"), "")
+        fh.writestr(f"{site_packages}/lc_pkg/mod.py".lstrip("/"), "a = 1")
+    chunk_list = dump_chunk_list(
+        {
+            f"{site_packages}/lc_pkg/__init__.py".lstrip("/"): (chunk, "lc_pkg"),
+            f"{site_packages}/lc_pkg/mod.py".lstrip("/"): (chunk, "lc_pkg.mod"),
+        }
+    )
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return chunk_content.getvalue()
+
+    monkeypatch.setattr(pyodide_pack_loader.LazyChunkImporter, "tmp_dir", tmp_path)
+    importer = pyodide_pack_loader.LazyChunkImporter(
+        chunk_list, chunks_url="https://example.org", fetch=fetch
+    )
+    monkeypatch.setattr(sys, "path", [str(site_packages)])
+    monkeypatch.setattr(sys, "meta_path", [importer] + sys.meta_path)
+    for name in ["lc_pkg", "lc_pkg.mod"]:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+    assert importer.find_spec("os") is None
+    assert fetched == []
+    mod = importlib.import_module("lc_pkg.mod")
+    assert mod.a == 1
+    # The chunk is fetched once, and removed once extracted
+    assert fetched == [f"https://example.org/{chunk}"]
+    assert (site_packages / "lc_pkg" / "mod.py").exists()
+    assert not (tmp_path / chunk).exists()
+
+
+def _streamed_bundle(tmp_path):
+    bundle_path = tmp_path / "bundle.zip"
+    with zipfile.ZipFile(bundle_path, "w", compression=zipfile.ZIP_DEFLATED) as fh:
+        fh.writestr("bundle-startup.txt", "2\n")
+        fh.writestr("a/startup.py", "a = 1\n" * 100)
+        fh.writestr("a/later.py", bytes(range(256)) * 100)
+    return bundle_path.read_bytes()
+
+
+def test_zip_stream_extractor(tmp_path):
+    content = _streamed_bundle(tmp_path)
+    extractor = pyodide_pack_loader.ZipStreamExtractor(tmp_path / "out")
+    for idx in range(0, len(content), 100):
+        extractor.feed(content[idx : idx + 100])
+        if extractor.names == ["bundle-startup.txt", "a/startup.py"]:
+            assert extractor.startup_done
+            assert not (tmp_path / "out" / "a" / "later.py").exists()
+    assert extractor.done
+    assert extractor.names == ["bundle-startup.txt", "a/startup.py", "a/later.py"]
+    assert (tmp_path / "out" / "a" / "later.py").read_bytes() == (
+        bytes(range(256)) * 100
+    )
+
+
+def test_stream_bundle(tmp_path, monkeypatch):
+    content = _streamed_bundle(tmp_path)
+    received = asyncio.Event()
+
+    class Reader:
+        def __init__(self):
+            self.chunks = [content[:200], content[200:]]
+
+        async def read(self):
+            if not self.chunks:
+                return types.SimpleNamespace(done=True)
+            if len(self.chunks) == 1:
+                # The rest of the bundle is received after stream_bundle returns
+                await received.wait()
+            value = types.SimpleNamespace(to_bytes=lambda data=self.chunks.pop(0): data)
+            return types.SimpleNamespace(done=False, value=value)
+
+    async def pyfetch(url):
+        if url == "failing.zip":
+            # Streams are not supported, and the bundle can't be received
+            async def read_all():
+                raise OSError("Connection reset")
+
+            js_response = types.SimpleNamespace(body=None)
+            return types.SimpleNamespace(js_response=js_response, bytes=read_all)
+        body = types.SimpleNamespace(getReader=Reader)
+        return types.SimpleNamespace(js_response=types.SimpleNamespace(body=body))
+
+    pyodide_http = types.ModuleType("pyodide.http")
+    pyodide_http.pyfetch = pyfetch  # type: ignore[attr-defined]
+    monkeypatch.setitem(sys.modules, "pyodide", types.ModuleType("pyodide"))
+    monkeypatch.setitem(sys.modules, "pyodide.http", pyodide_http)
+
+    async def main():
+        task = await pyodide_pack_loader.stream_bundle("bundle.zip", tmp_path)
+        assert (tmp_path / "a" / "startup.py").exists()
+        assert not task.done()
+        received.set()
+        await task
+        assert (tmp_path / "a" / "later.py").exists()
+
+        with pytest.raises(OSError, match="Connection reset"):
+            await pyodide_pack_loader.stream_bundle("failing.zip", tmp_path)
+        # No task is left waiting for the startup files
+        await asyncio.sleep(0)
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(main())
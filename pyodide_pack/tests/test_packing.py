@@ -0,0 +1,187 @@
+import zipfile
+
+import pytest
+
+from pyodide_pack.archive import ArchiveFile
+from pyodide_pack.config import PackConfig
+from pyodide_pack.dynamic_lib import DynamicLib
+from pyodide_pack.packing import (
+    PackTask,
+    find_duplicates,
+    get_member_names,
+    merge_results,
+    run_pack_tasks,
+    split_in_shards,
+    sum_stats,
+)
+from pyodide_pack.runtime_detection import RuntimeResults
+
+SITE_PACKAGES = "/lib/python3.11/site-packages"
+
+
+def _wasm_dylib(needed: list[bytes]) -> bytes:
+    """A WebAssembly module with a dylink.0 section listing needed libraries"""
+
+    def name(value: bytes) -> bytes:
+        return bytes([len(value)]) + value
+
+    needed_data = bytes([len(needed)]) + b"".join(name(el) for el in needed)
+    section = name(b"dylink.0") + bytes([2, len(needed_data)]) + needed_data
+    return b"\0asm\x01\0\0\0" + bytes([0, len(section)]) + section + bytes(1000)
+
+
+@pytest.fixture
+def example_wheels(tmp_path):
+    paths = []
+    opened_file_names = []
+    for package in ["a", "b"]:
+        path = tmp_path / f"{package}-1.0-py3-none-any.whl"
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as fh:
+            for idx in range(10):
+                name = f"{package}/mod{idx}.py"
+                fh.writestr(name, f'"""Docstring"""\nx = {idx}\n')
+                if idx % 2:
+                    opened_file_names.append(f"{SITE_PACKAGES}/{name}")
+            fh.writestr(f"{package}/_lib.so", _wasm_dylib([b"libz.so"]))
+        paths.append(path)
+    db = RuntimeResults(
+        opened_file_names=opened_file_names,
+        dynamic_libs_map={
+            f"{SITE_PACKAGES}/b/_lib.so": DynamicLib(
+                f"{SITE_PACKAGES}/b/_lib.so", load_order=0
+            )
+        },
+    )
+    return paths, db
+
+
+def _pack(paths, db, out_path, tmp_dir, jobs, shard_size):
+    tasks = []
+    for archive_idx, path in enumerate(paths):
+        ar = ArchiveFile(path, name=None)
+        shards = split_in_shards(ar, sorted(ar.namelist()), shard_size=shard_size)
+        for shard_idx, shard in enumerate(shards):
+            tasks.append(
+                PackTask(
+                    archive_idx=archive_idx,
+                    shard_idx=shard_idx,
+                    archive_path=path,
+                    in_file_names=shard,
+                    out_path=tmp_dir / f"{jobs}-{archive_idx}-{shard_idx}.zip",
+                )
+            )
+    results = list(run_pack_tasks(tasks, db, PackConfig(), jobs=jobs))
+    assert len(results) == len(tasks)
+    with zipfile.ZipFile(out_path, "w") as fh_out:
+        merge_results(fh_out, results)
+    return results
+
+
+def test_pack_parallel_deterministic(example_wheels, tmp_path):
+    paths, db = example_wheels
+
+    results = _pack(
+        paths, db, tmp_path / "serial.zip", tmp_path, jobs=1, shard_size=10**9
+    )
+    _pack(paths, db, tmp_path / "parallel.zip", tmp_path, jobs=3, shard_size=20)
+
+    assert (tmp_path / "serial.zip").read_bytes() == (
+        tmp_path / "parallel.zip"
+    ).read_bytes()
+
+    with zipfile.ZipFile(tmp_path / "serial.zip") as fh:
+        assert fh.testzip() is None
+        assert fh.namelist() == [
+            f"{SITE_PACKAGES}/a/mod{idx}.py".lstrip("/") for idx in [1, 3, 5, 7, 9]
+        ] + [f"{SITE_PACKAGES}/b/_lib.so".lstrip("/")] + [
+            f"{SITE_PACKAGES}/b/mod{idx}.py".lstrip("/") for idx in [1, 3, 5, 7, 9]
+        ]
+        assert fh.read(f"{SITE_PACKAGES}/a/mod1.py".lstrip("/")) == b"x = 1"
+
+    stats = sum_stats(results)
+    assert stats["py_in"] == 20
+    assert stats["py_out"] == 10
+    assert stats["so_out"] == 1
+    assert [(dll.path, dll.needed) for res in results for dll in res.dynamic_libs] == [
+        (f"{SITE_PACKAGES}/b/_lib.so", ["libz.so"])
+    ]
+
+
+def test_split_in_shards(example_wheels):
+    paths, _ = example_wheels
+    ar = ArchiveFile(paths[0], name=None)
+    names = sorted(ar.namelist())
+    assert split_in_shards(ar, names) == [names]
+    shards = split_in_shards(ar, names, shard_size=1)
+    assert shards == [[name] for name in names]
+
+
+def test_merge_results_include(example_wheels, tmp_path):
+    paths, db = example_wheels
+    results = _pack(paths, db, tmp_path / "all.zip", tmp_path, jobs=1, shard_size=10**9)
+    names = get_member_names(results)
+    with zipfile.ZipFile(tmp_path / "all.zip") as fh:
+        assert names == fh.namelist()
+
+    with zipfile.ZipFile(tmp_path / "so.zip", "w") as fh_out:
+        merge_results(fh_out, results, include=lambda name: name.endswith(".so"))
+    with zipfile.ZipFile(tmp_path / "so.zip") as fh:
+        assert fh.namelist() == [f"{SITE_PACKAGES}/b/_lib.so".lstrip("/")]
+
+    # Files are merged in the given order, skipping unknown ones
+    order = [names[2], "unknown.py", names[0]]
+    with zipfile.ZipFile(tmp_path / "ordered.zip", "w") as fh_out:
+        merge_results(fh_out, results, order=order)
+    with zipfile.ZipFile(tmp_path / "ordered.zip") as fh:
+        assert fh.namelist() == [names[2], names[0]]
+
+
+def test_find_duplicates(example_wheels, tmp_path):
+    paths, db = example_wheels
+    results = _pack(paths, db, tmp_path / "all.zip", tmp_path, jobs=1, shard_size=10**9)
+    names = get_member_names(results)
+
+    duplicates, saved_size = find_duplicates(results, names)
+    # Modules with the same content in both packages, once docstrings removed
+    assert duplicates == {
+        f"{SITE_PACKAGES}/b/mod{idx}.py".lstrip("/"): (
+            f"{SITE_PACKAGES}/a/mod{idx}.py".lstrip("/")
+        )
+        for idx in [1, 3, 5, 7, 9]
+    }
+    assert saved_size > 0
+
+    # The first file in the given order is the original
+    duplicates, _ = find_duplicates(results, names[::-1])
+    assert set(duplicates.values()) == {
+        f"{SITE_PACKAGES}/b/mod{idx}.py".lstrip("/") for idx in [1, 3, 5, 7, 9]
+    }
+
+    # Data files are kept, as they couldn't be read with importlib.resources
+    # when the bundle is imported from its zip file
+    data_paths = []
+    for package in ["c", "d"]:
+        path = tmp_path / f"{package}-1.0-py3-none-any.whl"
+        with zipfile.ZipFile(path, "w") as fh:
+            fh.writestr(f"{package}/data.txt", "data")
+            fh.writestr(f"{package}/__init__.py", "x = 1\n")
+        data_paths.append(path)
+    db = RuntimeResults(
+        opened_file_names=[
+            f"{SITE_PACKAGES}/{package}/{name}"
+            for package in ["c", "d"]
+            for name in ["data.txt", "__init__.py"]
+        ],
+        dynamic_libs_map={},
+    )
+    results = _pack(
+        data_paths, db, tmp_path / "data.zip", tmp_path, jobs=1, shard_size=10**9
+    )
+    names = get_member_names(results)
+    assert f"{SITE_PACKAGES}/d/data.txt".lstrip("/") in names
+    duplicates, _ = find_duplicates(results, names)
+    assert duplicates == {
+        f"{SITE_PACKAGES}/d/__init__.py".lstrip("/"): (
+            f"{SITE_PACKAGES}/c/__init__.py".lstrip("/")
+        )
+    }
@@ -1,8 +1,20 @@
+import importlib.util
 import json
+import marshal
+import zipfile
 
+import pytest
+
+from pyodide_pack.bytecode import get_pyc_path
+from pyodide_pack.compression import compressed_size
 from pyodide_pack.config import PackConfig
 from pyodide_pack.dynamic_lib import DynamicLib
-from pyodide_pack.runtime_detection import PackageBundler, RuntimeResults
+from pyodide_pack.runtime_detection import (
+    PackageBundler,
+    RuntimeResults,
+    merge_raw_results,
+)
+from pyodide_pack.size_estimation import GZIP_OVERHEAD
 
 
 def test_runtime_results(tmp_path):
@@ -49,3 +61,182 @@ def test_bundler_process_path(tmp_path):
     assert bundler.process_path("a.py") == "a.py"
     assert bundler.process_path("b.py") == "d/b.py"
     assert bundler.process_path("f.so") == "d/f.so"
+
+
+def test_bundler_process_raw_content():
+    bundler = PackageBundler(RuntimeResults(), config=PackConfig())
+    assert bundler.needs_processing("a/b.py")
+    assert not bundler.needs_processing("a/b.so")
+
+    info = zipfile.ZipInfo("a/b.so")
+    info.file_size, info.compress_size = 100, 40
+    bundler.process_raw_content("a/b.so", info)
+    assert bundler.stats["fh_out"] == 1
+    assert bundler.stats["size_out"] == 100
+    assert bundler.stats["size_gzip_out"] == 40 + GZIP_OVERHEAD
+
+
+def test_bundler_stats_encodings():
+    pytest.importorskip("brotli")
+    bundler = PackageBundler(
+        RuntimeResults(), config=PackConfig(encodings=["gzip", "brotli"])
+    )
+    content = b"\0" * 100
+    info = zipfile.ZipInfo("a/b.so")
+    info.file_size, info.compress_size = 100, 40
+    # The content of copied files is only read for encodings other than gzip
+    bundler.process_raw_content("a/b.so", info, lambda: content)
+    assert bundler.stats["size_gzip_out"] == 40 + GZIP_OVERHEAD
+    assert bundler.stats["size_brotli_out"] == compressed_size(content, "brotli")
+
+
+@pytest.mark.parametrize("keep_source", [False, True])
+def test_bundler_process_file_py_compile(keep_source):
+    config = PackConfig()
+    config.py.py_compile = True
+    config.py.py_compile_keep_source = keep_source
+    bundler = PackageBundler(RuntimeResults(), config=config)
+
+    out_file_name = "lib/python3.11/site-packages/a/b.py"
+    outputs = dict(bundler.process_file("a/b.py", out_file_name, b"x = 1"))
+    assert (out_file_name in outputs) == keep_source
+    pyc_path = get_pyc_path(out_file_name, keep_source=keep_source)
+    assert outputs[pyc_path][:4] == importlib.util.MAGIC_NUMBER
+    assert bundler.stats["fh_out"] == len(outputs)
+
+    # Files with invalid syntax are kept as source
+    outputs = dict(bundler.process_file("a/c.py", "a/c.py", b"x ="))
+    assert outputs == {"a/c.py": b"x ="}
+
+
+def test_bundler_process_file_py_compile_bundle():
+    config = PackConfig()
+    config.py.py_compile = True
+    config.py.py_compile_bundle = True
+    bundler = PackageBundler(RuntimeResults(), config=config)
+
+    out_file_name = "lib/python3.11/site-packages/a/__init__.py"
+    assert bundler.process_file("a/__init__.py", out_file_name, b"x = 1") == []
+    is_package, path, code = bundler.bytecode["a"]
+    assert is_package
+    assert path == "/" + out_file_name
+    namespace: dict = {}
+    exec(marshal.loads(code), namespace)
+    assert namespace["x"] == 1
+
+
+def test_bundler_process_path_vendored():
+    db = RuntimeResults(
+        opened_file_names=[
+            "/lib/python3.11/site-packages/pandas/compat/numpy/__init__.py",
+            "/lib/python3.11/site-packages/numpy/__init__.py",
+            "/lib/python3.11/site-packages/mynumpy/__init__.py",
+        ],
+        dynamic_libs_map={},
+    )
+    bundler = PackageBundler(db, config=PackConfig())
+
+    # The shortest match is the most likely to not be vendored
+    assert (
+        bundler.process_path("numpy/__init__.py")
+        == "/lib/python3.11/site-packages/numpy/__init__.py"
+    )
+    assert (
+        bundler.process_path("compat/numpy/__init__.py")
+        == "/lib/python3.11/site-packages/pandas/compat/numpy/__init__.py"
+    )
+    assert bundler.process_path("ynumpy/__init__.py") is None
+
+
+def test_runtime_results_merge_scenarios():
+    scenario_1 = {
+        "opened_file_names": ["a.py"],
+        "load_dyn_lib_calls": [{"path": "c.so", "global": False}],
+        "dl_accessed_symbols": {},
+        "sys_modules": {"a": "a.py"},
+    }
+    scenario_2 = {
+        "opened_file_names": ["b.py", "a.py"],
+        "load_dyn_lib_calls": [
+            {"path": "c.so", "global": False},
+            {"path": "d.so", "global": False},
+        ],
+        "dl_accessed_symbols": {"c.so": ["f"]},
+        "sys_modules": {"b": "b.py"},
+        "executed_functions": {"a.py": [[1, "f"], [5, "g"]]},
+    }
+    scenario_1["executed_functions"] = {"a.py": [[5, "g"], [9, "h"]]}
+    scenario_1["import_times"] = {"a": 0.1, "b": 0.5}
+    scenario_2["import_times"] = {"b": 0.2, "c": 0.3}
+    res = RuntimeResults.from_json_string(
+        json.dumps(merge_raw_results([scenario_1, scenario_2]))
+    )
+    assert res["opened_file_names"] == ["a.py", "b.py"]
+    assert res["sys_modules"] == {"a": "a.py", "b": "b.py"}
+    assert res["dynamic_libs_map"] == {
+        "c.so": DynamicLib(path="c.so", load_order=0, shared=False),
+    }
+    assert res.get_executed_functions("a.py") == {(1, "f"), (5, "g"), (9, "h")}
+    # The slowest import time of each module is kept
+    assert res["import_times"] == {"a": 0.1, "b": 0.5, "c": 0.3}
+    assert res.get_slow_modules(0.25) == {"b", "c"}
+
+
+def test_runtime_results_compact(tmp_path):
+    prefix = "/lib/python311.zip"
+    site_packages = "/lib/python3.11/site-packages"
+    input_data = {
+        "opened_file_names": [f"{prefix}/pathlib.py", f"{site_packages}/a/b.py"],
+        "sys_modules": {
+            "pathlib": f"{prefix}/pathlib.py",
+            "a.b": f"{site_packages}/a/b.py",
+            "sys": None,
+        },
+        "load_dyn_lib_calls": [
+            {"path": f"{site_packages}/a/c.so", "global": False},
+            {"path": f"{site_packages}/a/d.so", "global": True},
+        ],
+        "dl_accessed_symbols": {f"{site_packages}/a/c.so": ["f"]},
+        "loaded_packages": {"a": "default channel"},
+        "executed_functions": {f"{site_packages}/a/b.py": [[1, "f"]]},
+        "LDSO_loaded_libs_by_handle": {
+            "1": {"refcount": 1, "name": f"{site_packages}/a/c.so", "global": False},
+            "2": {"refcount": 1, "global": True},
+        },
+    }
+    res = RuntimeResults.from_json_string(json.dumps(input_data))
+
+    assert RuntimeResults.from_bytes(res.to_bytes()) == res
+    res.to_json(tmp_path / "results.json", compact=True)
+    assert RuntimeResults.from_json(tmp_path / "results.json") == res
+    # Each path is stored once
+    compact = res.to_compact()
+    assert len(compact["paths"]) == 4
+    assert compact["data"]["LDSO_loaded_libs_by_handle"][0][:2] == [
+        "1",
+        compact["paths"].index(f"{site_packages}/a/c.so"),
+    ]
+
+    with pytest.raises(ValueError, match="Unsupported format"):
+        RuntimeResults.from_bytes(b"not a valid content")
+
+    assert res.stdlib_paths == {"pathlib.py"}
+
+
+def test_bundler_tree_shake(tmp_path):
+    db = RuntimeResults(
+        executed_functions={"/lib/python3.11/site-packages/a/b.py": [[1, "f"]]}
+    )
+    config = PackConfig()
+    config.py.tree_shake = 1
+    bundler = PackageBundler(db, config=config, originals_dir=tmp_path)
+
+    code = b"def f():\n    x = 1\n    return x\n\ndef g():\n    y = 2\n    return y\n"
+    out_file_name = "lib/python3.11/site-packages/a/b.py"
+    out_content = bundler.process_content("a/b.py", code, out_file_name)
+    assert out_content is not None
+    assert b"x = 1" in out_content
+    assert b"y = 2" not in out_content
+    assert b"load_function" in out_content
+    # The original source is kept for the stubs to fetch it
+    assert (tmp_path / out_file_name).read_bytes() == code
@@ -0,0 +1,77 @@
+import gzip
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from pyodide_pack.archive import ArchiveFile
+from pyodide_pack.compression import compressed_size
+from pyodide_pack.size_estimation import estimate_compressed_size, estimate_gzip_size
+
+
+def _make_tar(file_path, files: dict[str, bytes]):
+    with tarfile.open(file_path, "w") as fh:
+        for name, content in files.items():
+            tarinfo = tarfile.TarInfo(name=name)
+            tarinfo.size = len(content)
+            fh.addfile(tarinfo, fileobj=io.BytesIO(content))
+
+
+def test_estimate_gzip_size_parallel(tmp_path):
+    files = {f"a/{idx}.py": f"x = {idx}\n".encode() * (idx + 1) for idx in range(20)}
+    _make_tar(tmp_path / "test.tar", files)
+    expected = sum(len(gzip.compress(content)) for content in files.values())
+
+    ar = ArchiveFile(tmp_path / "test.tar", name="test")
+    assert estimate_gzip_size(ar, max_workers=1, use_cache=False) == expected
+    assert (
+        estimate_gzip_size(ar, max_workers=3, parallel_min_size=0, use_cache=False)
+        == expected
+    )
+
+
+def test_estimate_gzip_size_zip_metadata(tmp_path):
+    file_path = tmp_path / "test.zip"
+    content = b"import os\n" * 1000
+    with zipfile.ZipFile(file_path, "w") as fh:
+        fh.writestr("stored.py", content, compress_type=zipfile.ZIP_STORED)
+        fh.writestr(
+            "deflated.py", content, compress_type=zipfile.ZIP_DEFLATED, compresslevel=9
+        )
+
+    ar = ArchiveFile(file_path, name="test")
+    # With maximum compression level, the estimate from metadata is exact
+    assert estimate_gzip_size(ar, use_cache=False) == 2 * len(gzip.compress(content))
+
+
+@pytest.mark.parametrize("encoding", ["brotli", "zstd"])
+def test_estimate_compressed_size(tmp_path, encoding):
+    pytest.importorskip({"brotli": "brotli", "zstd": "zstandard"}[encoding])
+    file_path = tmp_path / "test.zip"
+    content = b"import os\n" * 1000
+    with zipfile.ZipFile(file_path, "w", compression=zipfile.ZIP_DEFLATED) as fh:
+        fh.writestr("a.py", content)
+
+    ar = ArchiveFile(file_path, name="test")
+    # Deflated members are compressed again, as the metadata only gives the gzip size
+    expected = compressed_size(content, encoding)
+    assert estimate_compressed_size(ar, encoding, use_cache=False) == expected
+    assert ar.total_size(compressed=True, encoding=encoding) == expected
+
+
+def test_estimate_gzip_size_cache(tmp_path, pyodide_pack_cache_dir, monkeypatch):
+    from pyodide_pack import size_estimation
+
+    _make_tar(tmp_path / "test.tar", {"a.py": b"a = 1"})
+    ar = ArchiveFile(tmp_path / "test.tar", name="test")
+    size = estimate_gzip_size(ar)
+    assert (pyodide_pack_cache_dir / "archive-gzip-9-sizes.json").exists()
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("cache was not used")
+
+    monkeypatch.setattr(size_estimation, "_compute_compressed_size", _fail)
+    # A copy of the same archive is served from the cache
+    (tmp_path / "copy.tar").write_bytes((tmp_path / "test.tar").read_bytes())
+    assert estimate_gzip_size(ArchiveFile(tmp_path / "copy.tar", name="test")) == size